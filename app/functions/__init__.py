@@ -1,5 +1,6 @@
 from .kf_inbound    import kf_inbound
 
 from .kf_ingester   import kf_ingest
-from .kf_evaluator  import kf_evaluateOCM
-
+from .kf_evaluator  import kf_evaluateOCM, evaluateOCMBatch
+from .kf_webcannon  import kf_fireWebhook, fireBatch
+from .kf_maintenance import kf_maintainPartitions
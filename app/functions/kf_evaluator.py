@@ -1,16 +1,28 @@
 import sys, os
 import base64
 import json
+import logging
 from datetime import datetime
 from itertools import chain
-
-from app.helpers.pubsub import publish
+from collections import OrderedDict
+
+from app.helpers.kflog  import getLogger, traceEnabled
+from app.helpers.pgdb   import getRuleSet
+from app.helpers.crate  import crateEntity, projectState
+from app.helpers.deliverylog import delivery_log
+from app.helpers.rollups import rollups, READY, NOGO, NO_WEBHOOKS
+from app.helpers.pubsub import publish, awaitPublished
+from app.helpers.rules  import getCompiledCondition, stateValue, getRuleIndex
+from app.helpers.rules  import expression_eval, isEqual, isNotEqual, isLessThan, isLessThanOrEqual
+from app.helpers.rules  import isGreaterThan, isGreaterThanOrEqual, isOneOf, isNotOneOf
 
 #############################################################################################################################
 
 WEBHOOK_NOGO_TOPIC  = os.getenv('KF_WEBHOOK_NOGO')
 WEBHOOK_READY_TOPIC = os.getenv('KF_WEBHOOK_READY')
 
+log = getLogger(__name__)
+
 #############################################################################################################################
 
 def kf_evaluateOCM(data, context):
@@ -24,11 +36,19 @@ def kf_evaluateOCM(data, context):
          The package pulled out of data has these keys:
             message_id
             action
-            payload
-            conditions
-            webhooks
+            sub_id
+            object_type
+            entity_id
+            ruleset         version of the sub_id/object_type rule set the ingester saw, None when it couldn't get it
+            webhook_ids     ids of the webhooks in that rule set (not there when ruleset is None)
+            condition_ids   ids of the conditions in that rule set (not there when ruleset is None)
+            ocm             the OCM request body as the ingester received it, the entity is under entity_id
+             or payload     the OCM entity (dict), when the request body held more than one entity
             processed_timestamp
 
+         Packages from earlier ingesters instead carry the payload, webhooks and conditions as JSON strings
+         and are still evaluated from those.
+
          From the kingfisher DB
            items queried from the webhook table have:
               0    1        2      3            4                    5
@@ -38,76 +58,247 @@ def kf_evaluateOCM(data, context):
               id   sub_id   attribute_uuid   attribute_name   operator   value'
     """
     if not 'data' in data:
-        print("Missing top level 'data' element in data parameter, no data published to output topic.")
+        log.warning("Missing top level 'data' element in data parameter, no data published to output topic.")
         return
 
     package  = json.loads(base64.b64decode(data['data']).decode('utf-8'))
     #print(f'keys for the provided message {repr(list(package.keys()))}')
+
+    # all of the publishes for this OCM are started before waiting on any of them
+    pending = []
+    try:
+        evaluatePackage(package, pending)
+    except RuleSetUnavailable as exception:
+        # as when the ingester can't get the rules, the OCM is logged and let go rather than failing the function
+        fields = {'message_id' : package.get('message_id'), 'sub_id' : package.get('sub_id'), 'object_type' : package.get('object_type'),
+                  'ruleset' : package.get('ruleset')}
+        log.error('message_id: %s not evaluated, %s', package.get('message_id'), exception, extra=fields)
+    reportPublished(awaitPublished(pending))
+    delivery_log.flushIfDue()
+    rollups.flushIfDue()
+
+#############################################################################################################################
+
+def evaluateOCMBatch(packages, timeout=60):
+    """
+        Evaluate a list of packages (as decoded from the KF_OCM_EVALUATE messages) in one pass, for draining
+        a backlog or replaying recorded packages without a function invocation per OCM.
+        The packages are grouped by subscription and rule set so the rule index for a group is obtained
+        once and then applied to every OCM in the group.  Every READY/NOGO message is published before
+        waiting on any of them, with a single deadline of timeout seconds for the whole batch.
+        A package that can't be evaluated (malformed, no action, ...) is logged and counted as 'error',
+        the rest of the batch is still evaluated and its publishes waited on.
+        Returns a dict of counts by outcome.
+    """
+    tally  = {}
+    groups = OrderedDict()  # rules key : [(package, payload)]
+    for package in packages:
+        try:
+            payload = packagePayload(package)
+            groups.setdefault(rulesKey(package, payload), []).append((package, payload))
+        except RuleSetUnavailable as exception:
+            log.warning('Skipping message_id: %s, %s', package.get('message_id'), exception, extra={'message_id' : package.get('message_id')})
+            tally['rules_unavailable'] = tally.get('rules_unavailable', 0) + 1
+        except Exception as exception:
+            reportFailed(package, exception)
+            tally['error'] = tally.get('error', 0) + 1
+
+    pending = []
+    for key, group in groups.items():
+        first_package = group[0][0]
+        try:
+            index = getRuleIndex(key, lambda: loadRules(first_package, key))
+        except RuleSetUnavailable as exception:
+            log.warning('Skipping %d packages, %s', len(group), exception)
+            tally['rules_unavailable'] = tally.get('rules_unavailable', 0) + len(group)
+            continue
+        except Exception as exception:
+            reportFailed(first_package, exception, len(group))
+            tally['error'] = tally.get('error', 0) + len(group)
+            continue
+        for package, payload in group:
+            try:
+                outcome = evaluatePackage(package, pending, payload=payload, index=index)
+            except Exception as exception:
+                reportFailed(package, exception)
+                outcome = 'error'
+            tally[outcome] = tally.get(outcome, 0) + 1
+
+    outcomes = awaitPublished(pending, timeout=timeout)
+    reportPublished(outcomes)
+    delivery_log.flush()
+    rollups.flush()
+    tally['published']     = len([exception for label, result, exception in outcomes if exception is None])
+    tally['publish_error'] = len(outcomes) - tally['published']
+    log.info('batch of %d packages in %d rule set groups: %s', len(packages), len(groups), tally)
+    return tally
+
+#############################################################################################################################
+
+class RuleSetUnavailable(Exception):
+    pass
+
+def packagePayload(package):
+    return crateEntity(package)
+
+def rulesKey(package, payload):
+    # the rule index for a subscription is reused for as long as the ingester keeps sending the same rule set,
+    # a package without one (the ingester's lookup failed) goes by the version the evaluator gets for itself
+    # so that its index is replaced when the rules change like any other
+    if 'ruleset' in package:
+        ruleset = package['ruleset']
+        if ruleset is None:
+            ruleset = currentRuleSet(package['sub_id'], package['object_type'])
+        return ('ruleset', package['sub_id'], package['object_type'], ruleset)
+    return (payload.get('subscription_id'), package.get('webhooks'), package.get('conditions'))
+
+def currentRuleSet(sub_id, object_type):
+    version, webhooks, conditions = getRuleSet(sub_id, object_type)
+    if version is None:
+        raise RuleSetUnavailable(f'unable to obtain the rule set for sub_id: {sub_id} object_type: {object_type}')
+    return version
+
+def loadRules(package, key):
+    if 'ruleset' in package:
+        return resolveRuleSet(package, key[3])
+    return json.loads(package.get('webhooks')), json.loads(package.get('conditions'))
+
+def resolveRuleSet(package, wanted):
+    """
+        Get the webhooks and conditions for the wanted version of the package's rule set from the qualifier
+        cache (and DB).  When the cached rule set isn't that version it is refreshed from the DB, and if the
+        version still differs the rules changed after ingestion and the current ones are used.
+    """
+    sub_id, object_type = package['sub_id'], package['object_type']
+    version, webhooks, conditions = getRuleSet(sub_id, object_type)
+    if version != wanted:
+        version, webhooks, conditions = getRuleSet(sub_id, object_type, refresh=True)
+    if version is None:
+        raise RuleSetUnavailable(f'unable to obtain rule set {wanted} for sub_id: {sub_id} object_type: {object_type}')
+    if version != wanted:
+        log.info('rule set %s for sub_id: %s object_type: %s has been superseded by %s', wanted, sub_id, object_type, version,
+                 extra={'sub_id' : sub_id, 'object_type' : object_type, 'ruleset' : version})
+    return webhooks, conditions
+
+def evaluatePackage(package, pending, payload=None, index=None):
+    """
+        Evaluate the OCM in the package against the webhooks and conditions in its rule set and publish a
+        READY or NOGO message for each applicable webhook, appending the (label, future) for each publish
+        to pending rather than waiting on it.
+        Returns one of 'ignored', 'no_webhooks' or 'evaluated'.
+    """
     message_id = package.get('message_id')
     action     = package.get('action')
-    payload    = json.loads(package.get('payload'))
-    conditions = json.loads(package.get('conditions'))
-    webhooks   = json.loads(package.get('webhooks'))
+    if payload is None:
+        payload = packagePayload(package)
     object_type = payload['object_type']
-    print(f'message_id: {message_id}  action: {action}  object_type: {object_type}')
+    fields = {'message_id' : message_id, 'sub_id' : package.get('sub_id', payload.get('subscription_id')), 'object_type' : object_type}
+    trace  = traceEnabled(log)  # the per rule and per condition output is written for a sample of the OCMs
+    log.debug('message_id: %s  action: %s  object_type: %s', message_id, action, object_type, extra=fields)
     #print(f'payload is a {type(payload)}')
     #print(f'payload has these keys {list(payload.keys())}')
     #payload keys: ['action', 'subscription_id', 'ref', 'detail_link', 'object_type', 'changes', 'state', 'project']
 
     if action.lower() not in ['created', 'updated']:
-        print(f'Ignoring OCM action: {action} for message_id: {message_id}')
-        return
-
-    print(f'webhooks   -> {webhooks}')
-    print(f'conditions -> {conditions}')
-
-    relevant_webhooks = getRelevantWebhooks(webhooks, object_type)
+        log.info('Ignoring OCM action: %s for message_id: %s', action, message_id, extra=fields)
+        return 'ignored'
+
+    if trace and 'ruleset' in package:
+        log.debug('ruleset %s webhooks -> %s conditions -> %s', package['ruleset'], package.get('webhook_ids'),
+                  package.get('condition_ids'), extra=fields)
+    elif trace:
+        log.debug('webhooks   -> %s', package.get('webhooks'), extra=fields)
+        log.debug('conditions -> %s', package.get('conditions'), extra=fields)
+
+    if index is None:
+        key = rulesKey(package, payload)
+        index = getRuleIndex(key, lambda: loadRules(package, key))
+
+    relevant_webhooks = index.webhooksFor(object_type)
+    webhook_ids = None
+    # without a ruleset the ingester's lookup failed, its empty webhook_ids don't mean there are no webhooks
+    if 'webhook_ids' in package and package.get('ruleset') is not None:
+        webhook_ids = set(package['webhook_ids'])
+        relevant_webhooks = [webhook for webhook in relevant_webhooks if webhook[0] in webhook_ids]
     if not relevant_webhooks:
-        print(f'message_id: {message_id} no relevant webhooks for object_type: {object_type}')
-        return None
-    print(f'message_id: {message_id} relevant_webhooks: {repr(relevant_webhooks)}')
-
-    relevant_conditions = getRelevantConditions(relevant_webhooks, conditions)
-    print(f'message_id: {message_id} relevant_conditions: {repr(relevant_conditions)}')
-
-    condition = evaluateItemAgainstConditions(payload, relevant_conditions)
-
+        log.info('message_id: %s no relevant webhooks for object_type: %s', message_id, object_type, extra=fields)
+        rollups.count(fields['sub_id'], object_type, NO_WEBHOOKS)
+        return 'no_webhooks'
+    if trace:
+        log.debug('message_id: %s relevant_webhooks: %r', message_id, relevant_webhooks, extra=fields)
+
+    if trace:
+        log.debug('message_id: %s relevant_conditions: %r', message_id,
+                  [cc.source for cc in index.conditionsFor(relevant_webhooks).values()], extra=fields)
+
+    decisions, status = index.decide(object_type, payload['state'], payload['changes'])
+    if webhook_ids is not None and len(relevant_webhooks) < len(decisions):
+        decisions = [(webhook, qualified) for webhook, qualified in decisions if webhook[0] in webhook_ids]
+    # the descriptions only go out with a NOGO, they are built for the first one (or up front when tracing)
+    condition = describeConditions(payload, index.compiled, status, trace=True) if trace else None
+
+    encoded_payload = json.dumps(payload)
+    workspace = projectState(payload['state'], ('Workspace',))['Workspace']
     endpoint = {}
-    for webhook in relevant_webhooks:
-        disqualified = False
-        for cond_id in webhook[-1]:    # all conditions specified by webhook must be true or the webhook is disqualified
-            if condition[cond_id]['status'] != True:
-                disqualified = True
+    ready = nogo = 0
+    for webhook, qualified in decisions:
+        disqualified = not qualified    # all conditions specified by webhook must be true or the webhook is disqualified
 
         message_dict = { "message_id"           : message_id,
                          "action"               : action,
                          "webhook"              : webhook,
-                         "payload"              : json.dumps(payload),
+                         "object_id"            : package.get('entity_id'),
+                         "object_type"          : object_type,
+                         "workspace"            : workspace,
+                         "payload"              : encoded_payload,
                          "processed_timestamp"  : datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
                        }
 
         if disqualified:
+            if condition is None:
+                condition = describeConditions(payload, index.compiled, status)
             message_dict['conditions'] = condition
             topic_name = WEBHOOK_NOGO_TOPIC
+            nogo += 1
+            delivery_log.record(message_id, webhook[1], webhook[0], NOGO, workspace=workspace, object_type=object_type,
+                                object_id=package.get('entity_id'), target_url=webhook[3])
+            rollups.count(webhook[1], object_type, NOGO)
             try:
-                future = publish(topic_name, message_dict)
-                result = future.result(timeout=10)
-                print(f'Published message -- {message_id} topic: WEBHOOK_NOGO result: {result}')
+                pending.append((('WEBHOOK_NOGO', message_id, webhook[0]), publish(topic_name, message_dict)))
             except Exception as exception:
-                print('Encountered error while publishing -- message_id: {message_id} topic: WEBHOOK_NOGO exception: {exception}')
+                log.error('Encountered error while publishing -- message_id: %s topic: WEBHOOK_NOGO exception: %s', message_id, exception,
+                          extra=dict(fields, webhook_id=webhook[0], topic=topic_name))
             continue
 
         if webhook[3] not in endpoint:  # A payload only gets fired on its target once per OCM
             endpoint[webhook[3]] = 1    # to ensure the above statement, cache the target endpoint
             topic_name = WEBHOOK_READY_TOPIC
+            ready += 1
+            rollups.count(webhook[1], object_type, READY)
             try:
                 message_dict['attempts'] = 0
                 message_dict['eligible'] = 1000 # artificially low timestamp value
-                future = publish(topic_name, message_dict)
-                result = future.result(timeout=10)
-                print('Published message -- {message_id} topic: WEBHOOK_READY result: {result}')
+                pending.append((('WEBHOOK_READY', message_id, webhook[0]), publish(topic_name, message_dict)))
             except Exception as exception:
-                print('Encountered error while publishing -- {message_id} topic: WEBHOOK_READY exception: {exception}')
+                log.error('Encountered error while publishing -- %s topic: WEBHOOK_READY exception: %s', message_id, exception,
+                          extra=dict(fields, webhook_id=webhook[0], topic=topic_name))
+
+    log.info('message_id: %s %d webhooks ready, %d nogo', message_id, ready, nogo, extra=fields)
+    return 'evaluated'
+
+def reportPublished(outcomes):
+    for (topic, message_id, webhook_id), result, exception in outcomes:
+        fields = {'message_id' : message_id, 'webhook_id' : webhook_id, 'topic' : topic}
+        if exception:
+            log.error('Encountered error while publishing -- %s webhook: %s topic: %s exception: %s',
+                      message_id, webhook_id, topic, exception, extra=fields)
+        else:
+            log.debug('Published message -- %s webhook: %s topic: %s result: %s', message_id, webhook_id, topic, result, extra=fields)
+
+def reportFailed(package, exception, count=1):
+    message_id = package.get('message_id') if isinstance(package, dict) else None
+    log.error('Encountered error while evaluating -- message_id: %s packages: %d exception: %r', message_id, count, exception,
+              extra={'message_id' : message_id})
 
 #############################################################################################################################
 
@@ -127,7 +318,7 @@ def getRelevantConditions(webhooks, conditions):
         identify and return the conditions that match the condition ids in each webhook
     """
     conds = [wh[-1]for wh in webhooks] # wh[-1] is a list of integers where each integer is the id value of a condition
-    cond_ids = list(set(chain(*conds)))
+    cond_ids = set(chain(*conds))
     relevant_conds = [cond for cond in conditions if cond[0] in cond_ids]
     return relevant_conds
 
@@ -138,184 +329,48 @@ def evaluateItemAgainstConditions(payload, relevant_conditions):
         Given a payload (dict) in which there is a 'state' key with a sub-dict with attr_name : attr_value pairs
         and a relevant_conditions sequence
     """
+    state     = payload['state']
+    changes   = payload['changes']
     condition = {}
     for cond in relevant_conditions:
-        cond_id, sub_id, condition_attr_uuid, condition_attr_name, condition_relation, condition_value = cond
-        attribute = payload['state'][condition_attr_uuid]
-        #attr_value = payload['state'][condition_attr_uuid]['value']['value']
-        attr_value = 'no such value key in attribute'
-        if 'value' in attribute:
-            attr_value = attribute['value']
-            if attr_value and isinstance(attr_value, dict):
-                if 'value' in attr_value:
-                    attr_value = attr_value['value']
-                elif 'name' in attr_value:
-                    attr_value = attr_value['name']
-
-        expression = f'{condition_attr_name}({attr_value}) {condition_relation} {condition_value}'
-        status = isQualified(payload, cond)
-        print(f'{expression} ? {status}')
-        condition[cond_id] = {'condition' : expression, 'status' : status}
+        compiled = getCompiledCondition(cond)
+        expression = conditionExpression(compiled, state)
+        status = compiled.test(state, changes)
+        log.debug('%s ? %s', expression, status)
+        condition[compiled.cond_id] = {'condition' : expression, 'status' : status}
 
     return condition
 
 #############################################################################################################################
 
-""" from the Pigeon Webhooks API documentation
-
-Operators
-The required fields in an Expression depend on the Operator.
-
- ------------
-The following operators require both a Value and exactly one of AttributeID or AttributeName.
-
-Operator	Description
-   =	        Equal
-   !=	        Not equal
-   <	        Less than
-   <=	        Less than or equal
-   >	        Greater than
-   >=	        Greater than or equal
-   changed-to	Value changed to
-   changed-from	Value changed from
-
-  ------------
-The following operators require an AttributeID or AttributeName, and a Value that is an Array of individual values.
-
-Operator	Description
-    ~	    "Equals one of". Matches when the object's value for the attribute 
-                             is equal to one of the values given in the Expression
-    !~	    "Equals none of". Matches when the object's value for the attribute 
-            is not equal to any of the values given in the Expression
-
-  -----------  
-The following operators require only an AttributeID or AttributeName (no Value)
-
-Operator	Description
-    has	        The object has some (non-null) value for the attribute
-    !has	    The object does not have the attribute, or its value is null
-    changed	    The value of the attribute was changed on the object
-"""
-
-
-def isEqual(ocm_attr_value, expression_value):
-    return ocm_attr_value == expression_value
-
-
-def isNotEqual(ocm_attr_value, expression_value):
-    return ocm_attr_value != expression_value
-
-
-def isLessThan(ocm_attr_value, expression_value):
-    return ocm_attr_value < expression_value
-
-
-def isLessThanOrEqual(ocm_attr_value, expression_value):
-    return ocm_attr_value <= expression_value
-
-
-def isGreaterThan(ocm_attr_value, expression_value):
-    return ocm_attr_value > expression_value
-
-
-def isGreaterThanOrEqual(ocm_attr_value, expression_value):
-    return ocm_attr_value >= expression_value
-
-
-# def isChangedTo(ocm, ocm_attr_id, expression_value):
-#    return False
-
-# def isChangedFrom(ocm, ocm_attr_id, expression_value):
-#    return False
-
-def isOneOf(ocm_attr_value, expression_value):
-    return ocm_attr_value in expression_value  # "cast" expression_value to a list
-
-
-def isNotOneOf(ocm_attr_value, expression_value):
-    return ocm_attr_value not in expression_value  # "cast" expression_value to a list
-
-
-# def hasSomeValue(ocm, ocm_attr_id, expression_value):
-#    return False
-
-# def hasNoValue(ocm, ocm_attr_id, expression_value):
-#    return False
+def describeConditions(payload, compiled, status, trace=False):
+    """
+        Given a payload, a dict of cond_id : CompiledCondition and the dict of cond_id : status for the conditions
+        the evaluation actually got to, return the cond_id : {'condition' : expression, 'status' : status} dict
+        that goes out with a NOGO message.  With trace each expression is also logged at DEBUG.
+    """
+    condition = {}
+    for cond_id, cond_status in status.items():
+        expression = conditionExpression(compiled[cond_id], payload['state'])
+        if trace:
+            log.debug('%s ? %s', expression, cond_status)
+        condition[cond_id] = {'condition' : expression, 'status' : cond_status}
+    return condition
 
+def conditionExpression(compiled, state):
+    attribute = state.get(compiled.attr_uuid, {})
+    #attr_value = payload['state'][condition_attr_uuid]['value']['value']
+    attr_value = 'no such value key in attribute'
+    if 'value' in attribute:
+        attr_value = stateValue(attribute)
+    return f'{compiled.attr_name}({attr_value}) {compiled.relation} {compiled.source[5]}'
 
-expression_eval = {'='   : isEqual,
-                   '!='  : isNotEqual,
-                   '<'   : isLessThan,
-                   '<='  : isLessThanOrEqual,
-                   '>'   : isGreaterThan,
-                   '>='  : isGreaterThanOrEqual,
-                   # 'changed-to'    : isChangedTo,
-                   # 'changed-from'  : isChangedFrom,
-                   # expressions that take an attribute_id|name and a list of possible values
-                   '~'   : isOneOf,
-                   '!~'  : isNotOneOf,
-                   # expressions that take just an attribute_id|name
-                   # 'has'     : hasSomeValue,
-                   # '!has'    : hasNoValue,
-                   # 'changed' : valueWasChanged
-                  }
+#############################################################################################################################
 
 def isQualified(ocm, condition):
     #ocm keys: ['action', 'subscription_id', 'ref', 'detail_link', 'object_type', 'changes', 'state', 'project']
-    cond_id, sub_id, condition_attr_uuid, condition_attr_name, condition_relation, condition_value = condition
-    state   = ocm['state']
-    changes = ocm['changes']
-    var_info   = state[condition_attr_uuid]
-    attr_value = var_info['value']
-    if attr_value and isinstance(attr_value, dict):
-        if 'value' in attr_value:
-            attr_value = attr_value['value']
-        elif 'name' in attr_value:
-            attr_value = attr_value['name']
-
-    try:
-        condition_value = int(condition_value)  # in case condition_value
-    except:
-        pass
-    # alternative to above is to attempt a rough determination of the type of the attr_value and coerce condition_value to same
-    #if attr_value and isinstance(attr_value, int)
-    #    if condition_value:
-    #        try:
-    #            condition_value = int(condition_value)
-    #        except:
-    #            pass
-    #elif attr_value and isinstance(attr_value, float)
-    #    if condition_value:
-    #        try:
-    #            condition_value = float(condition_value)
-    #        except:
-    #            pass
-
-    print(f'{condition_attr_name}({attr_value}) {condition_relation} {condition_value} ?')
-
-    if condition_relation not in ['changed-to', 'changed-from', 'has', '!has', 'changed']:
-        if not attr_value:
-            return False
-        take  = expression_eval[condition_relation](attr_value, condition_value)
-        return take
-
-    if condition_relation   == 'changed-to':
-        ac = [changes[attr_uuid]['value'] for attr_uuid in changes.keys() if attr_uuid == condition_attr_uuid]
-        if not ac:
-            return False
-        else:
-            return ac[0] == condition_value
-    elif condition_relation == 'changed-from':
-        ac = [changes[attr_uuid]['old_value'] for attr_uuid in changes.keys() if attr_uuid == condition_attr_uuid]
-        if not ac:
-            return False
-        else:
-            return ac[0] == condition_value
-    elif condition_relation == 'has':
-        return attr_value != None
-    elif condition_relation == '!has':
-        return attr_value == None
-    else: # must be 'changed'
-        ac = [changes[attr_uuid]['value'] for attr_uuid in changes.keys() if attr_uuid == condition_attr_uuid]
-        return len(ac) > 0
-
+    compiled = getCompiledCondition(condition)
+    if log.isEnabledFor(logging.DEBUG):
+        attr_value = stateValue(ocm['state'][compiled.attr_uuid]) if compiled.attr_uuid in ocm['state'] else None
+        log.debug('%s(%s) %s %s ?', compiled.attr_name, attr_value, compiled.relation, compiled.operand)
+    return compiled.test(ocm['state'], ocm['changes'])
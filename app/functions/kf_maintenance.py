@@ -0,0 +1,32 @@
+import sys, os
+
+from app.helpers.kflog      import getLogger
+from app.helpers.pgdb       import pooledConnection
+from app.helpers.partitions import partitionedTables, maintainPartitions
+from app.helpers.rollups    import expireRollups, ROLLUP_TABLE
+
+###################################################################################################
+
+log = getLogger(__name__)
+
+def kf_maintainPartitions(data, context):
+    """
+        Background Cloud Function to be triggered by Pub/Sub, published to on a schedule (Cloud Scheduler,
+        hourly is plenty for daily partitions) to create the partitions of the partitioned tables ahead of
+        time and drop those past their retention, and to delete the rollup minutes past theirs.
+    """
+    for table, spec in partitionedTables():
+        try:
+            with pooledConnection() as dbconn:
+                cursor = dbconn.cursor()
+                maintainPartitions(cursor, table, spec)
+                cursor.close()
+        except Exception as error:
+            log.error('unable to maintain the %s partitions, %s', table, error)
+
+    try:
+        expired = expireRollups()
+        if expired:
+            log.info('%d %s rows expired', expired, ROLLUP_TABLE)
+    except Exception as error:
+        log.error('unable to expire the %s rows, %s', ROLLUP_TABLE, error)
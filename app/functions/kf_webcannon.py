@@ -0,0 +1,190 @@
+import sys, os
+import base64
+import json
+import time
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from app.helpers.kflog    import getLogger
+from app.helpers.pubsub   import publish, awaitPublished
+from app.helpers.delivery import postWebhook, targetHost, parkedUntil, PARKED, DELIVERED
+from app.helpers.retry    import retryMessage, isEligible
+from app.helpers.coalesce import COALESCE_WINDOW, coalesceKey, coalesceBatch
+from app.helpers.deliverylog import delivery_log
+from app.helpers.rollups  import rollups, RETRIED
+
+#############################################################################################################################
+
+WEBHOOK_FIRED_TOPIC = os.getenv('KF_WEBHOOK_FIRED')
+WEBHOOK_RETRY_TOPIC = os.getenv('KF_WEBHOOK_RETRY')   # held by retrier.py until eligible, then republished to KF_WEBHOOK_READY
+FIRE_CONCURRENCY    = int(os.getenv('KF_FIRE_CONCURRENCY', '50'))  # POSTs in flight at once for a batch
+
+log = getLogger(__name__)
+
+fire_pool = None  # threads for fireBatch, kept across warm invocations
+
+#############################################################################################################################
+
+def kf_fireWebhook(data, context):
+    """
+        Background Cloud Function to be triggered by Pub/Sub on the kf-webhook-ready topic.
+        Args:
+         data (dict): The dictionary with data specific to this type of event.
+         context (google.cloud.functions.Context): The Cloud Functions event
+         metadata.
+
+         The READY message pulled out of data has these keys:
+            message_id
+            action
+            webhook         id   sub_id   name   target_url   object_types(list)   conditions(list of ids)
+            object_id       uuid of the OCM entity
+            object_type
+            workspace       name of the OCM entity's workspace
+            payload         the OCM entity as a JSON string, this is what gets POSTed to the target_url
+            processed_timestamp
+            attempts        number of times the webhook has already been fired for this OCM
+            eligible        epoch seconds before which the webhook is not to be fired
+            coalesced       when present, the number of READY messages for the target_url and object_id this one
+                            stands for (see coalesce.py)
+    """
+    if not 'data' in data:
+        log.warning("Missing top level 'data' element in data parameter, no webhook fired.")
+        return
+
+    ready = json.loads(base64.b64decode(data['data']).decode('utf-8'))
+    pending = []
+    fireReady(ready, pending)
+    reportPublished(awaitPublished(pending))
+    delivery_log.flushIfDue()
+    rollups.flushIfDue()
+
+#############################################################################################################################
+
+def fireBatch(readies, timeout=60):
+    """
+        Fire the webhooks for a list of READY messages (as decoded from the KF_WEBHOOK_READY messages) with up
+        to FIRE_CONCURRENCY POSTs in flight at a time, and no more than the per host limit to any one host.
+        The FIRED messages are all published before waiting on any of them.  In coalescing mode the messages
+        in the batch for the same target_url and object are collapsed into one POST of the latest of them.
+        A READY message that can't be fired (malformed) is logged and counted as 'error', the rest are fired.
+        Returns a dict of counts by outcome.
+    """
+    global fire_pool
+    if fire_pool is None:
+        fire_pool = ThreadPoolExecutor(max_workers=FIRE_CONCURRENCY)
+    if COALESCE_WINDOW:
+        readies = coalesceBatch(readies)
+
+    def fireOne(ready):
+        try:
+            return fireReady(ready, pending)
+        except Exception as exception:
+            message_id = ready.get('message_id') if isinstance(ready, dict) else None
+            log.error('Encountered error while firing -- message_id: %s exception: %r', message_id, exception,
+                      extra={'message_id' : message_id})
+            return 'error'
+
+    pending = []
+    fired = list(fire_pool.map(fireOne, readies))
+    tally = {}
+    for outcome in fired:
+        tally[outcome] = tally.get(outcome, 0) + 1
+
+    outcomes = awaitPublished(pending, timeout=timeout)
+    reportPublished(outcomes)
+    delivery_log.flush()
+    rollups.flush()
+    tally['published']     = len([exception for label, result, exception in outcomes if exception is None])
+    tally['publish_error'] = len(outcomes) - tally['published']
+    log.info('batch of %d webhooks fired: %s', len(readies), tally)
+    return tally
+
+#############################################################################################################################
+
+def fireReady(ready, pending):
+    """
+        POST the payload of a READY message to the webhook's target_url and publish the outcome to
+        KF_WEBHOOK_FIRED, appending the (label, future) for the publish to pending rather than waiting on it.
+        A POST that didn't succeed and has attempts left is also published to KF_WEBHOOK_RETRY with the time
+        it is eligible for the next attempt, as is a READY message that isn't eligible yet, rather than
+        waiting for that time here.  A READY message for a host whose circuit breaker is open is parked on
+        KF_WEBHOOK_RETRY until the breaker lets a POST through, without counting as an attempt.
+        In coalescing mode a first attempt is held on KF_WEBHOOK_RETRY for COALESCE_WINDOW seconds, where
+        retrier.py collapses it with the other READY messages for the same target_url and object.
+        Returns the outcome of the POST, 'deferred', 'held' or PARKED.
+    """
+    message_id = ready.get('message_id')
+    webhook    = ready['webhook']
+    target_url = webhook[3]
+    fields = {'message_id' : message_id, 'sub_id' : webhook[1], 'webhook_id' : webhook[0]}
+
+    if not isEligible(ready):
+        publishRetry(ready, pending, fields)
+        return 'deferred'
+
+    if COALESCE_WINDOW and 'coalesced' not in ready and not ready.get('attempts') and coalesceKey(ready):
+        publishRetry(dict(ready, coalesce=True, eligible=time.time() + COALESCE_WINDOW), pending, fields)
+        return 'held'
+
+    parked_until = parkedUntil(target_url)
+    if parked_until:
+        log.info('message_id: %s webhook: %s host: %s parked', message_id, webhook[0], targetHost(target_url), extra=fields)
+        publishRetry(dict(ready, eligible=parked_until), pending, fields)
+        return PARKED
+
+    body = ready['payload']
+    delivery = postWebhook(target_url, body.encode('utf-8') if isinstance(body, str) else json.dumps(body).encode())
+    log.info('message_id: %s webhook: %s host: %s %s %s in %d ms', message_id, webhook[0], targetHost(target_url),
+             delivery.outcome, delivery.status_code, delivery.elapsed_ms, extra=fields)
+
+    retry = retryMessage(ready, delivery)
+    fired_dict = firedMessage(ready, delivery, retry)
+    # the payload is kept for an undelivered webhook so it can be replayed
+    delivery_log.record(message_id, webhook[1], webhook[0], delivery.outcome, workspace=ready.get('workspace'),
+                        object_type=ready.get('object_type'), object_id=ready.get('object_id'), target_url=target_url,
+                        status_code=delivery.status_code, attempts=fired_dict['attempts'], elapsed_ms=delivery.elapsed_ms,
+                        payload=None if delivery.outcome == DELIVERED else body)
+    rollups.count(webhook[1], ready.get('object_type'), delivery.outcome)
+    if retry:
+        rollups.count(webhook[1], ready.get('object_type'), RETRIED)
+    try:
+        pending.append((('WEBHOOK_FIRED', message_id, webhook[0]), publish(WEBHOOK_FIRED_TOPIC, fired_dict)))
+    except Exception as exception:
+        log.error('Encountered error while publishing -- message_id: %s topic: WEBHOOK_FIRED exception: %s', message_id, exception,
+                  extra=dict(fields, topic=WEBHOOK_FIRED_TOPIC))
+    if retry:
+        publishRetry(retry, pending, fields)
+    return delivery.outcome
+
+def publishRetry(ready, pending, fields):
+    message_id = ready.get('message_id')
+    try:
+        pending.append((('WEBHOOK_RETRY', message_id, ready['webhook'][0]), publish(WEBHOOK_RETRY_TOPIC, ready)))
+    except Exception as exception:
+        log.error('Encountered error while publishing -- message_id: %s topic: WEBHOOK_RETRY exception: %s', message_id, exception,
+                  extra=dict(fields, topic=WEBHOOK_RETRY_TOPIC))
+
+def firedMessage(ready, delivery, retry=None):
+    return { "message_id"           : ready.get('message_id'),
+             "action"               : ready.get('action'),
+             "webhook"              : ready['webhook'],
+             "target_url"           : delivery.target_url,
+             "outcome"              : delivery.outcome,
+             "status_code"          : delivery.status_code,
+             "elapsed_ms"           : delivery.elapsed_ms,
+             "error"                : delivery.error,
+             "object_id"            : ready.get('object_id'),
+             "coalesced"            : ready.get('coalesced', 1),
+             "attempts"             : ready.get('attempts', 0) + 1,
+             "retry_eligible"       : retry['eligible'] if retry else None,  # None when it is not fired again
+             "fired_timestamp"      : datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+           }
+
+def reportPublished(outcomes):
+    for (topic, message_id, webhook_id), result, exception in outcomes:
+        fields = {'message_id' : message_id, 'webhook_id' : webhook_id, 'topic' : topic}
+        if exception:
+            log.error('Encountered error while publishing -- %s webhook: %s topic: %s exception: %s',
+                      message_id, webhook_id, topic, exception, extra=fields)
+        else:
+            log.debug('Published message -- %s webhook: %s topic: %s result: %s', message_id, webhook_id, topic, result, extra=fields)
@@ -0,0 +1,137 @@
+import os
+import time
+import threading
+
+from app.helpers.kflog import getLogger
+
+# A host whose POSTs fail (timeout, no response, 5xx) BREAKER_FAILURES times in a row is tripped and gets
+# no POSTs for BREAKER_OPEN_TIME seconds, after which one POST probes it.  A failed probe trips the host
+# again for twice as long, up to BREAKER_MAX_OPEN_TIME seconds.
+BREAKER_FAILURES      = int(os.getenv('KF_BREAKER_FAILURES',        '5'))
+BREAKER_OPEN_TIME     = float(os.getenv('KF_BREAKER_OPEN_TIME',     '30'))
+BREAKER_MAX_OPEN_TIME = float(os.getenv('KF_BREAKER_MAX_OPEN_TIME', '300'))
+BREAKER_PROBE_PARK    = 5.0   # seconds a POST is parked for while the probe of a tripped host is in flight
+
+CLOSED    = 'closed'
+OPEN      = 'open'
+HALF_OPEN = 'half_open'
+
+PROBE = 'probe'   # what acquire returns to the POST that is the probe of a tripped host
+
+log = getLogger(__name__)
+
+host_gates = {}
+gates_lock = threading.Lock()
+
+###################################################################################################
+
+class HostGate:
+    """
+        Circuit breaker and concurrency limit for the POSTs to one host.
+        The limit adapts to how the host is doing, it grows by 1/limit for each POST that gets a response
+        and is halved for each one that fails, between 1 and max_concurrency.  A slow host is held to a few
+        connections instead of tying up as many as it can, and a tripped host gets none at all.
+    """
+    def __init__(self, host, max_concurrency):
+        self.host      = host
+        self.max_limit = max_concurrency
+        self.limit     = float(max_concurrency)
+        self.in_flight = 0
+        self.state     = CLOSED
+        self.failures  = 0          # consecutive
+        self.opened_at = 0.0
+        self.open_time = BREAKER_OPEN_TIME
+        self.probing   = False
+        self.probed_at = 0.0
+        self.prober    = None       # the thread given the probe, until its acquire claims it
+        self.condition = threading.Condition()
+
+    def parkedUntil(self, now=None):
+        """
+            Return None when a POST to the host can go ahead, otherwise the epoch seconds until which a
+            POST is to be held back.  When the open time of a tripped host is up the first caller gets
+            None and its POST (the next acquire on the same thread) is the probe.
+        """
+        now = time.time() if now is None else now
+        with self.condition:
+            if self.state == CLOSED:
+                return None
+            if self.state == OPEN:
+                if now < self.opened_at + self.open_time:
+                    return self.opened_at + self.open_time
+                self.state = HALF_OPEN
+            # a probe that never reports back is given up on after a while
+            if self.probing and now < self.probed_at + 2 * BREAKER_PROBE_PARK:
+                return now + BREAKER_PROBE_PARK
+            self.probing   = True
+            self.probed_at = now
+            self.prober    = threading.get_ident()
+            return None
+
+    def acquire(self, timeout):
+        """
+            Wait up to timeout seconds for the number of POSTs in flight to the host to be under the limit.
+            Returns False when the wait timed out, otherwise the ticket to hand back to release: PROBE for
+            the POST that probes a tripped host, True for any other.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            probe = self.probing and self.prober == threading.get_ident()
+            if probe:
+                self.prober = None
+            while self.in_flight >= max(1, int(self.limit)):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    if probe:
+                        self.probing = False    # the probe never got to the host, the next POST can be it
+                    return False
+                self.condition.wait(remaining)
+            self.in_flight += 1
+            return PROBE if probe else True
+
+    def release(self, failed, ticket=True):
+        """
+            Record how the POST went, failed being True for a timeout, no response or a 5xx, ticket being
+            what acquire returned for it.  Only the probe's outcome settles a tripped host and lets another
+            POST probe it, a POST that was already in flight when the host tripped does neither.
+        """
+        with self.condition:
+            self.in_flight -= 1
+            probe = ticket == PROBE
+            if probe:
+                self.probing = False
+            if failed:
+                self.failures += 1
+                self.limit = max(1.0, self.limit / 2)
+                if self.state == HALF_OPEN and probe:
+                    self.trip(min(self.open_time * 2, BREAKER_MAX_OPEN_TIME))
+                elif self.state == CLOSED and self.failures >= BREAKER_FAILURES:
+                    self.trip(BREAKER_OPEN_TIME)
+            else:
+                self.failures = 0
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+                if self.state == HALF_OPEN and probe:
+                    self.state = CLOSED
+                    self.open_time = BREAKER_OPEN_TIME
+                    log.info('host %s recovered, POSTs resumed', self.host)
+            self.condition.notify_all()
+
+    def trip(self, open_time):
+        self.state     = OPEN
+        self.opened_at = time.time()
+        self.open_time = open_time
+        log.warning('host %s tripped after %d failures, POSTs parked for %d seconds', self.host, self.failures, open_time)
+
+    def snapshot(self):
+        with self.condition:
+            return {'host' : self.host, 'state' : self.state, 'limit' : round(self.limit, 2),
+                    'in_flight' : self.in_flight, 'failures' : self.failures}
+
+###################################################################################################
+
+def hostGate(host, max_concurrency):
+    gate = host_gates.get(host)
+    if gate is None:
+        with gates_lock:
+            gate = host_gates.setdefault(host, HostGate(host, max_concurrency))
+    return gate
@@ -0,0 +1,76 @@
+import os
+import threading
+from collections import OrderedDict
+
+# When COALESCE_WINDOW is more than 0, the READY messages for the same target_url and object that come in
+# within COALESCE_WINDOW seconds of the first one are collapsed into a single POST of the latest of them.
+COALESCE_WINDOW = float(os.getenv('KF_COALESCE_WINDOW', '0'))
+
+###################################################################################################
+
+def coalesceKey(ready):
+    """
+        Return the (target_url, object_id) a READY message is coalesced on, None when it has no object_id.
+    """
+    object_id = ready.get('object_id')
+    if not object_id:
+        return None
+    return (ready['webhook'][3], object_id)
+
+def isNewer(ready, other):
+    # the arrival order decides between messages evaluated in the same second
+    return ready.get('processed_timestamp', '') >= other.get('processed_timestamp', '')
+
+def coalesceBatch(readies):
+    """
+        Collapse a list of READY messages to one per coalesce key, the latest, in the order the keys first
+        appear.  Each message returned carries the number of messages it stands for in 'coalesced'.
+    """
+    latest = OrderedDict()
+    for ix, ready in enumerate(readies):
+        key = coalesceKey(ready) or ('uncoalesced', ix)
+        if key in latest:
+            held, count = latest[key]
+            latest[key] = (ready if isNewer(ready, held) else held, count + ready.get('coalesced', 1))
+        else:
+            latest[key] = (ready, ready.get('coalesced', 1))
+    return [dict(ready, coalesced=count) for ready, count in latest.values()]
+
+###################################################################################################
+
+class Coalescer:
+    """
+        Keeps the latest held item for each coalesce key.  offer() is given each item as it comes in and
+        release() takes the latest one for a key when the key's window is up.
+    """
+    def __init__(self):
+        self.held = {}    # key : [item, ready, count]
+        self.lock = threading.Lock()
+
+    def offer(self, key, item, ready):
+        """
+            Hold the item for the key.  Returns (first, dropped) where first is True when no item was held
+            for the key, so the caller is to schedule the key's release, and dropped is the item that is
+            no longer needed (the one that was held, or this one when the held one is newer) or None.
+        """
+        with self.lock:
+            if key not in self.held:
+                self.held[key] = [item, ready, ready.get('coalesced', 1)]
+                return True, None
+            entry = self.held[key]
+            entry[2] += ready.get('coalesced', 1)
+            if isNewer(ready, entry[1]):
+                dropped = entry[0]
+                entry[0], entry[1] = item, ready
+                return False, dropped
+            return False, item
+
+    def release(self, key):
+        """
+            Return (item, ready, count) for the latest item held for the key and stop holding it.
+        """
+        with self.lock:
+            return tuple(self.held.pop(key))
+
+    def __len__(self):
+        return len(self.held)
@@ -0,0 +1,51 @@
+import json
+
+# the only state attributes the ingesters look at, they go into the ingestion log line
+LOG_FIELDS = ('Workspace', 'FormattedID')
+
+###################################################################################################
+
+def projectState(state, names=LOG_FIELDS):
+    """
+        Return a dict of name : value for just the named attributes in an OCM's state (a reference
+        value is reduced to its 'name' or 'value'), scanning the state only until all of them are found.
+        An attribute that isn't in the state is given as None.
+    """
+    fields = dict.fromkeys(names)
+    remaining = len(fields)
+    for infoblock in state.values():
+        name = infoblock.get('name')
+        if name not in fields:
+            continue
+        value = infoblock.get('value')
+        if isinstance(value, dict):
+            value = value['name'] if 'name' in value else value['value'] if 'value' in value else value
+        fields[name] = value
+        remaining -= 1
+        if not remaining:
+            break
+    return fields
+
+def encodeCrate(crate, raw_ocm=None):
+    """
+        Encode the crate dict as the bytes published to the evaluate topic.  When raw_ocm (the bytes of the
+        OCM request body) is given it goes into the crate untouched as "ocm" rather than being decoded
+        and encoded again, and the evaluator picks the entity out of it by the crate's entity_id.
+    """
+    encoded = json.dumps(crate).encode('utf-8')
+    if raw_ocm is None:
+        return encoded
+    return encoded[:-1] + b', "ocm" : ' + raw_ocm + b'}'
+
+def crateEntity(crate):
+    """
+        The OCM entity a decoded crate is about, whichever way the ingester packed it.
+    """
+    if 'ocm' in crate:
+        return crate['ocm']['value']['entities'][crate['entity_id']]
+    payload = crate.get('payload')
+    if isinstance(payload, str):  # earlier ingesters sent the payload JSON encoded inside the crate
+        payload = json.loads(payload)
+    return payload
+
+###################################################################################################
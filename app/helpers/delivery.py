@@ -0,0 +1,174 @@
+import os
+import time
+import socket
+import threading
+from collections import namedtuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.timeout import Timeout
+
+from app.helpers.breaker import hostGate
+
+# A webhook POST has FIRE_TIMEOUT seconds in all, from waiting for the host to be under its concurrency limit
+# through connecting and sending to the end of the response, a response still coming in at the deadline is cut off.
+FIRE_TIMEOUT          = float(os.getenv('KF_FIRE_TIMEOUT', '5'))
+# kept-alive connections are pooled per host, for up to FIRE_POOL_HOSTS hosts at a time
+FIRE_POOL_HOSTS       = int(os.getenv('KF_FIRE_POOL_HOSTS', '100'))
+# no more than this many POSTs to the same host are in flight at once, from this instance, fewer when
+# the host is slow or failing (see breaker.HostGate)
+FIRE_HOST_CONCURRENCY = int(os.getenv('KF_FIRE_HOST_CONCURRENCY', '10'))
+
+RESPONSE_CHUNK = 8192  # bytes of a response body read at a time between checks of the deadline
+
+DELIVERED = 'delivered'   # 2xx response
+FAILED    = 'failed'      # any other response, or no response (refused, no route, DNS, TLS, ...)
+TIMEOUT   = 'timeout'     # no connection or no response status within FIRE_TIMEOUT
+THROTTLED = 'throttled'   # the host was at its concurrency limit for FIRE_TIMEOUT seconds
+PARKED    = 'parked'      # the host's circuit breaker is open, no POST was made
+INVALID   = 'invalid'     # the target_url has no host or isn't a URL that can be POSTed to, no POST was made
+
+# a target_url without a scheme (e.g. boneyard.com/munch) is POSTed to over https
+DEFAULT_SCHEME = 'https'
+
+Delivery = namedtuple('Delivery', ['target_url', 'outcome', 'status_code', 'elapsed_ms', 'error'])
+
+# one session per process so connections stay open across warm invocations
+session      = None
+session_lock = threading.Lock()
+
+###################################################################################################
+
+def getSession():
+    global session
+    if session is None:
+        with session_lock:
+            if session is None:
+                adapter = HTTPAdapter(pool_connections=FIRE_POOL_HOSTS, pool_maxsize=FIRE_HOST_CONCURRENCY,
+                                      max_retries=0, pool_block=True)
+                fire_session = requests.Session()
+                fire_session.mount('http://',  adapter)
+                fire_session.mount('https://', adapter)
+                fire_session.headers.update({'Content-Type' : 'application/json', 'User-Agent' : 'kingfisher'})
+                session = fire_session
+    return session
+
+def fireURL(target_url):
+    """
+        Return the URL a webhook's target_url is POSTed to, target_urls are often entered without the scheme.
+    """
+    target_url = (target_url or '').strip()
+    if target_url and '://' not in target_url:
+        return f'{DEFAULT_SCHEME}://{target_url}'
+    return target_url
+
+def targetHost(target_url):
+    """
+        Return the host (and port) a target_url is POSTed to, '' when it has none.
+    """
+    try:
+        return urlsplit(fireURL(target_url)).netloc.lower()
+    except ValueError:
+        return ''
+
+def parkedUntil(target_url):
+    """
+        Return the epoch seconds until which POSTs to the target_url's host are held back, or None.
+    """
+    host = targetHost(target_url)
+    return hostGate(host, FIRE_HOST_CONCURRENCY).parkedUntil() if host else None
+
+###################################################################################################
+
+def postWebhook(target_url, body, timeout=FIRE_TIMEOUT):
+    """
+        POST body (bytes or str) to the target_url using the pooled session and return a Delivery.
+        Waiting for the host to be under its concurrency limit counts against the timeout, so a host that
+        is saturated gives a THROTTLED outcome rather than an ever longer queue of waiting POSTs.
+        The outcome is recorded against the host's circuit breaker.  A target_url that has no host or that
+        requests won't take as a URL gives an INVALID outcome, which isn't the host's doing and isn't replayed.
+    """
+    started  = time.time()
+    deadline = started + timeout
+    host = targetHost(target_url)
+    if not host:
+        return Delivery(target_url, INVALID, None, elapsedMillis(started), 'no host in the target_url')
+    gate = hostGate(host, FIRE_HOST_CONCURRENCY)
+    ticket = gate.acquire(timeout)
+    if not ticket:
+        return Delivery(target_url, THROTTLED, None, elapsedMillis(started), 'no free connection to the host')
+    delivery = None
+    try:
+        # total covers connecting and reading the status and headers, the body is streamed against the deadline
+        remaining = max(0.1, deadline - time.time())
+        response = getSession().post(fireURL(target_url), data=body, stream=True, timeout=Timeout(total=remaining))
+        outcome = DELIVERED if 200 <= response.status_code < 300 else FAILED
+        error   = None if outcome == DELIVERED else response.reason
+        if not readResponse(response, deadline):
+            error = 'response cut off at the deadline' if error is None else f'{error}, response cut off at the deadline'
+        delivery = Delivery(target_url, outcome, response.status_code, elapsedMillis(started), error)
+    except requests.Timeout as exception:
+        delivery = Delivery(target_url, TIMEOUT, None, elapsedMillis(started), str(exception))
+    except (requests.exceptions.MissingSchema, requests.exceptions.InvalidSchema, requests.exceptions.InvalidURL) as exception:
+        delivery = Delivery(target_url, INVALID, None, elapsedMillis(started), str(exception))
+    except (requests.RequestException, ValueError) as exception:
+        delivery = Delivery(target_url, FAILED, None, elapsedMillis(started), str(exception))
+    finally:
+        gate.release(failed=delivery is None or isHostFailure(delivery), ticket=ticket)
+    return delivery
+
+def readResponse(response, deadline):
+    """
+        Read the body of a streamed response until it ends or the deadline passes, returns False when the
+        deadline cut it off.  A read blocked on a host that is trickling the body out is ended at the deadline
+        by shutting the response's socket.  A response read to the end leaves its connection in the pool for
+        the next POST, one that is cut off is closed.
+    """
+    sock = responseSocket(response)
+    # without a socket to shut (a response type that doesn't keep one), closing the response is the next best
+    cutoff, target = (shutSocket, sock) if sock is not None else (closeResponse, response)
+    watchdog = threading.Timer(max(0.0, deadline - time.time()), cutoff, (target,))
+    watchdog.daemon = True
+    watchdog.start()
+    try:
+        for chunk in response.iter_content(RESPONSE_CHUNK):
+            if time.time() > deadline:
+                return False
+        return time.time() <= deadline
+    except requests.RequestException:
+        return False
+    finally:
+        watchdog.cancel()
+        response.close()
+
+def responseSocket(response):
+    """
+        Return the socket a streamed response is read from.  The connection lets go of its socket once the
+        response says the connection will close (Connection: close, HTTP/1.0), but the file the body is
+        read through still holds it.
+    """
+    sock = getattr(getattr(response.raw, '_connection', None), 'sock', None)
+    if sock is None:
+        reader = getattr(getattr(response.raw, '_fp', None), 'fp', None)   # the http.client response's buffered file
+        sock = getattr(getattr(reader, 'raw', None), '_sock', None)
+    return sock
+
+def shutSocket(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+def closeResponse(response):
+    try:
+        response.raw.close()
+    except Exception:
+        pass
+
+def isHostFailure(delivery):
+    # a 4xx is the host answering, it is the request it doesn't like
+    return delivery.outcome == TIMEOUT or (delivery.outcome == FAILED and (delivery.status_code or 500) >= 500)
+
+def elapsedMillis(started):
+    return int((time.time() - started) * 1000)
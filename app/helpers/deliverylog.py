@@ -0,0 +1,113 @@
+import os
+import io
+import csv
+import time
+import atexit
+import threading
+from datetime import datetime
+
+from app.helpers.kflog   import getLogger
+from app.helpers.pgdb    import copyRows
+from app.helpers.rollups import FAILURE_OUTCOMES
+
+# Rows are buffered in memory and written with one COPY when DELIVERY_LOG_BATCH of them have accumulated or
+# the oldest has waited DELIVERY_LOG_INTERVAL seconds.  If the table can't be written to the rows are kept
+# for the next flush, up to DELIVERY_LOG_MAX_BUFFER of them with the oldest dropped beyond that.
+# A row for a webhook that wasn't delivered is written as the invocation that recorded it finishes.
+DELIVERY_LOG_TABLE      = os.getenv('KF_DELIVERY_LOG_TABLE', 'delivery_log')
+DELIVERY_LOG_BATCH      = int(os.getenv('KF_DELIVERY_LOG_BATCH',        '500'))
+DELIVERY_LOG_INTERVAL   = float(os.getenv('KF_DELIVERY_LOG_INTERVAL',   '5'))
+DELIVERY_LOG_MAX_BUFFER = int(os.getenv('KF_DELIVERY_LOG_MAX_BUFFER',   '20000'))
+
+# same order as the delivery_log entry in configs/schemas.json
+DELIVERY_LOG_COLUMNS = ('logged_at', 'message_id', 'sub_id', 'webhook_id', 'workspace', 'object_type', 'object_id',
+                        'target_url', 'outcome', 'status_code', 'attempts', 'elapsed_ms', 'payload')
+
+log = getLogger(__name__)
+
+###################################################################################################
+
+class DeliveryLogWriter:
+    """
+        Buffers delivery_log rows and writes them to the table in batches with COPY, so recording the
+        outcome of a webhook doesn't cost a DB round trip.
+        A function instance gets no CPU between invocations, so there is no background flushing thread,
+        the functions call flushIfDue() as an invocation finishes instead.  Rows for failed deliveries (the
+        FAILURE_OUTCOMES, the rows a replay works from) make a flush due straight away.  Cloud Functions
+        doesn't run atexit handlers when it shuts an idle instance down, so the rows lost with an instance
+        are at most DELIVERY_LOG_BATCH - 1 DELIVERED and NOGO rows from its last DELIVERY_LOG_INTERVAL
+        seconds, plus any rows kept after a failed COPY.
+    """
+    def __init__(self, table=DELIVERY_LOG_TABLE, batch=DELIVERY_LOG_BATCH, interval=DELIVERY_LOG_INTERVAL,
+                 max_buffer=DELIVERY_LOG_MAX_BUFFER, copier=copyRows):
+        self.table      = table
+        self.batch      = batch
+        self.interval   = interval
+        self.max_buffer = max_buffer
+        self.copier     = copier
+        self.rows       = []
+        self.oldest     = None   # time.time() when the oldest buffered row was recorded
+        self.dropped    = 0
+        self.failures   = 0      # buffered rows with one of the FAILURE_OUTCOMES
+        self.lock       = threading.Lock()
+        self.flush_lock = threading.Lock()  # one COPY at a time, rows keep being recorded meanwhile
+
+    def record(self, message_id, sub_id, webhook_id, outcome, workspace=None, object_type=None, object_id=None,
+               target_url=None, status_code=None, attempts=None, elapsed_ms=None, payload=None):
+        row = (datetime.utcnow().isoformat(), message_id, sub_id, webhook_id, workspace, object_type, object_id,
+               target_url, outcome, status_code, attempts, elapsed_ms, payload)
+        with self.lock:
+            if not self.rows:
+                self.oldest = time.time()
+            self.rows.append(row)
+            if outcome in FAILURE_OUTCOMES:
+                self.failures += 1
+            full = len(self.rows) >= self.batch
+        if full:
+            self.flush()
+
+    def isDue(self):
+        with self.lock:
+            return bool(self.rows) and (self.failures > 0 or len(self.rows) >= self.batch or
+                                        time.time() - self.oldest >= self.interval)
+
+    def flushIfDue(self):
+        if self.isDue():
+            self.flush()
+
+    def flush(self):
+        """
+            Write the buffered rows to the table, returns the number of rows written.
+        """
+        with self.flush_lock:
+            with self.lock:
+                rows, self.rows, self.oldest, self.failures = self.rows, [], None, 0
+            if not rows:
+                return 0
+            csv_file = io.StringIO()
+            csv.writer(csv_file).writerows(rows)
+            csv_file.seek(0)
+            try:
+                self.copier(self.table, DELIVERY_LOG_COLUMNS, csv_file)
+                return len(rows)
+            except Exception as error:
+                log.warning('unable to write %d rows to %s, keeping them for the next flush, %s', len(rows), self.table, error)
+                self.requeue(rows)
+                return 0
+
+    def requeue(self, rows):
+        with self.lock:
+            self.rows = rows + self.rows
+            if len(self.rows) > self.max_buffer:
+                excess = len(self.rows) - self.max_buffer
+                self.rows = self.rows[excess:]
+                self.dropped += excess
+                log.error('%d %s rows dropped, %d in all', excess, self.table, self.dropped)
+            self.failures = sum(1 for row in self.rows if row[8] in FAILURE_OUTCOMES)  # row[8] is the outcome
+            if self.rows:
+                self.oldest = time.time()
+
+###################################################################################################
+
+delivery_log = DeliveryLogWriter()
+atexit.register(delivery_log.flush)   # scripts (replay, retrier) write what's left when they finish
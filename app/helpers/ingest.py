@@ -0,0 +1,213 @@
+import os
+import json
+import datetime
+
+from app.helpers.kflog   import getLogger, traceEnabled
+from app.helpers.pgdb    import getRuleSet
+from app.helpers.pubsub  import publishEncoded, awaitPublished
+from app.helpers.crate   import projectState, encodeCrate
+
+###################################################################################################
+
+# Per deployment settings of the ingest pipeline, keyed by the function entry point.
+#   topic_env    environment variable naming the topic crates are published to, read at publish time
+#   topic        the topic when topic_env isn't set
+#   topic_label  how the topic is named in the log
+#   verbose      whether every condition and webhook found for an OCM is logged (at DEBUG, for the sampled OCMs)
+INGEST_PROFILES = {
+    'kf_ingest'  : {'topic_env'   : 'KF_OCM_EVALUATE',
+                    'topic'       : None,
+                    'topic_label' : 'KF_OCM_EVALUATE',
+                    'verbose'     : True,
+                   },
+    'kf_inbound' : {'topic_env'   : 'KF_INBOUND_TOPIC',
+                    'topic'       : 'kf-blowhole',
+                    'topic_label' : 'INGESTION TOPIC',
+                    'verbose'     : False,
+                   },
+}
+
+log = getLogger(__name__)
+
+###################################################################################################
+
+class IngestPipeline:
+    """
+        Takes an OCM request through the stages
+            parse    request body -> (raw_ocm, message_id, entities)
+            enrich   entity       -> context dict of the fields the later stages and the log need
+            lookup   context      -> (ruleset, webhooks, conditions)
+            publish  crate bytes  -> future for the publish to the profile's topic
+        Any stage can be replaced by passing a callable with the same signature as the method.
+    """
+    def __init__(self, profile_name, parse=None, enrich=None, lookup=None, publish=None, **settings):
+        profile = dict(INGEST_PROFILES[profile_name])
+        profile.update(settings)
+        self.topic_env     = profile['topic_env']
+        self.default_topic = profile['topic']
+        self.topic_label   = profile['topic_label']
+        self.verbose       = profile['verbose']
+        if os.getenv('KF_INGEST_VERBOSE'):
+            self.verbose = os.getenv('KF_INGEST_VERBOSE').lower() in ('1', 'true', 'yes')
+        self.parse   = parse   or self.parse
+        self.enrich  = enrich  or self.enrich
+        self.lookup  = lookup  or self.lookup
+        self.publish = publish or self.publish
+
+    @property
+    def topic(self):
+        return os.getenv(self.topic_env, self.default_topic)
+
+    def run(self, request):
+        raw_ocm, message_id, entities = self.parse(request)
+        pending = []  # every entity in the body is published before waiting on any of them
+        for item_uuid, info in entities.items():
+            context = self.enrich(message_id, item_uuid, info)
+            fields  = {'message_id' : message_id, 'sub_id' : context['sub_id'],
+                       'object_type' : context['object_type'], 'entity_id' : item_uuid}
+            ruleset, webhooks, conditions = self.lookup(context)
+            fields['ruleset'] = ruleset
+            log.info('message_id: %s  %s-%s-%s-%s-%s-%s  %d conditions  %d webhooks', message_id, context['sub_id'],
+                     context['workspace'], context['project'], context['action'], context['object_type'],
+                     context['formatted_id'], len(conditions), len(webhooks), extra=fields)
+            if self.verbose and traceEnabled(log):
+                for ix, condition in enumerate(conditions):
+                    log.debug('%d : %s', ix+1, condition, extra=fields)
+                for ix, webhook in enumerate(webhooks):
+                    log.debug('%d : %s', ix+1, webhook, extra=fields)
+
+            if len(entities) == 1:
+                message_data = self.package(context, ruleset, webhooks, conditions, raw_ocm=raw_ocm)
+            else:
+                message_data = self.package(context, ruleset, webhooks, conditions, info=info)
+            try:
+                pending.append((item_uuid, self.publish(message_data)))
+            except Exception as exception:
+                log.error('Encountered error while publishing to %s -- message_id: %s topic: %s exception: %s',
+                          self.topic_label, message_id, self.topic, exception, extra=dict(fields, topic=self.topic))
+
+        for item_uuid, result, exception in awaitPublished(pending):
+            fields = {'message_id' : message_id, 'entity_id' : item_uuid, 'topic' : self.topic}
+            if exception:
+                log.error('Encountered error while publishing to %s -- message_id: %s entity: %s topic: %s exception: %s',
+                          self.topic_label, message_id, item_uuid, self.topic, exception, extra=fields)
+            else:
+                log.debug('Published message to %s -- message_id: %s entity: %s topic: %s result: %s',
+                          self.topic_label, message_id, item_uuid, self.topic, result, extra=fields)
+
+    ###############################################################################################
+
+    def parse(self, request):
+        raw_ocm = request.data if isinstance(request.data, bytes) else request.data.encode('utf-8')
+        ocm = json.loads(raw_ocm)
+        #ocm looks like {'value' : {'transaction' : { ... stuff ...},
+        #                           'entities'    : { ... stuff ...} }
+        #'transaction': {'message_id': '47902511-5a2b-4b6a-a118-7fa78c4c7d4c',
+        #                'trace_id': 'd3d3af5f-9dc7-4ded-af84-98289f77e408',
+        #                'span_id': '9842532a-f9d3-4a91-ad4e-0f1c16135153',
+        #                'parent_span_id': 'd0a32084-3f91-4562-8ebd-ebe757969e7f',
+        #                'oracle_schema': 'wombat',
+        #                'timestamp': 1536079376526,
+        #                'user': { 'username': 'ue@test.com', 'email': 'ue@test.com',
+        #                          'uuid': '19591e98-5287-46e5-aac2-93e3791abb3a' }
+        #               }
+        # entities will usually have a single key in the form of a uuid whose associated value is a dict of:
+        #       action, subscription_id, project, object_type, detail_link, ref, state, changes
+        #       the state and changes will be keyed by the attribute id
+        message_id = ocm['value']['transaction']['message_id']
+        return raw_ocm, message_id, ocm['value']['entities']
+
+    def enrich(self, message_id, item_uuid, info):
+        # only the fields for the log line are pulled out of the state, the rest goes to the evaluator untouched
+        fields = projectState(info['state'])
+        return {'message_id'   : message_id,
+                'entity_id'    : item_uuid,
+                'action'       : info['action'],
+                'sub_id'       : info['subscription_id'],
+                'project'      : info['project']['name'],
+                'object_type'  : info['object_type'],
+                'workspace'    : fields['Workspace'],
+                'formatted_id' : fields['FormattedID'],
+               }
+
+    def lookup(self, context):
+        return getRuleSet(context['sub_id'], context['object_type'])
+
+    def publish(self, message_data):
+        return publishEncoded(self.topic, message_data)
+
+    def package(self, context, ruleset, webhooks, conditions, raw_ocm=None, info=None):
+        """
+            Encode the crate for an entity.  The evaluator gets the rules themselves from its own cache,
+            the crate only identifies them.  With raw_ocm the request body rides along as is, otherwise
+            the entity in info is embedded.  When the lookup failed (ruleset None) the crate has no
+            webhook_ids or condition_ids and the evaluator goes by the rules it gets for itself.
+        """
+        crate = { "message_id"            : context['message_id'],
+                  "action"                : context['action'],
+                  "sub_id"                : context['sub_id'],
+                  "object_type"           : context['object_type'],
+                  "entity_id"             : context['entity_id'],
+                  "ruleset"               : ruleset,
+                  "processed_timestamp"   : datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+                }
+        if ruleset is not None:
+            crate.update(webhook_ids=[webhook[0] for webhook in webhooks], condition_ids=[condition[0] for condition in conditions])
+        if raw_ocm is not None:
+            return encodeCrate(crate, raw_ocm)
+        crate['payload'] = info
+        return encodeCrate(crate)
+
+###################################################################################################
+
+# The state of an entity in an OCM, reduced to name : value pairs, looks like
+# {
+#  'ObjectID': 181899,
+#  'ObjectUUID': 'f51b234a-d248-4069-be68-25ae7e874124',
+#  'FormattedID': 'DE1',
+#  'Name': 'some artifact to get the security token',
+#  'Description': '',
+#  'CreationDate': '2018-08-30T22:10:11.568Z',
+#  'OpenedDate': '2018-08-30T23:00:42.175Z',
+#  'Ready': False,
+#  'Notes': '',
+#  'CreatedBy': {'ref': 'http://stack.local:8999/slm/webservice/v2.x/user/19591e98-5287-46e5-aac2-93e3791abb3a',
+#                'detail_link': 'http://stack.local:8999/slm/#/detail/user/164934', 'object_type': 'User',
+#                'name': 'ue', 'id': '19591e98-5287-46e5-aac2-93e3791abb3a'},
+#  'FlowState': {
+#     'ref': 'http://stack.local:8999/slm/webservice/v2.x/flowstate/dc66d240-1be4-4f19-8ed6-dd767585abd9',
+#     'detail_link': None,
+#     'object_type': 'FlowState',
+#     'name': 'Completed',
+#     'id': 'dc66d240-1be4-4f19-8ed6-dd767585abd9'},
+#  'FlowStateChangedDate': '2018-09-04T16:42:56.246Z',
+#
+#  'InProgressDate': '2018-08-31T18:15:07.513Z',
+#  'AffectsDoc': False, 'TaskStatus': 'NONE', 'LastUpdateDate': '2018-09-04T16:42:56.442Z',
+#  'PlanEstimate': {'units': 'Points', 'value': 3.0},
+#  'TaskEstimateTotal': {'units': 'Hours', 'value': 0.0},
+#  'TaskActualTotal': {'units': 'Hours', 'value': 0.0},
+#  'TaskRemainingTotal': {'units': 'Hours', 'value': 0.0},
+#  'DisplayColor': '#f9a814',
+#
+#  'Expedite': False,
+#  'Workspace': {
+#     'ref': 'http://stack.local:8999/slm/webservice/v2.x/workspace/c4ace4af-92a5-467d-9f12-62c40a5ae049',
+#     'detail_link': 'http://stack.local:8999/slm/#/detail/workspace/164973', 'object_type': 'Workspace',
+#     'name': 'Workspace 1', 'id': 'c4ace4af-92a5-467d-9f12-62c40a5ae049'},
+#  'FormattedIDID': 1,
+#
+#  'ScheduleState': {'ref': 'http://stack.local:8999/slm/webservice/v2.x//43781a87-12a8-4fd0-8ef6-ac87b05a7cc4',
+#                    'detail_link': None, 'object_type': 'State', 'name': 'Completed',
+#                    'id': '43781a87-12a8-4fd0-8ef6-ac87b05a7cc4', 'order_index': 3},
+#  'ScheduleStatePrefix': 'C',
+#  'TestCaseStatus': 'NONE', 'Blocked': False, 'ReleaseNote': False,
+#  'TestCaseCount': 0,
+#  'PassingTestCaseCount': 0,
+#  'VersionId': 20,
+#
+#  'FormattedIDPrefix': 'DE',
+# }
+#
+
+###################################################################################################
@@ -0,0 +1,55 @@
+import os
+import sys
+import json
+import random
+import logging
+
+# Cloud Logging takes each line a function writes to stdout as a log entry, and a line that is a JSON
+# object as a structured entry with the severity and any other keys as searchable fields.
+LOG_LEVEL        = os.getenv('KF_LOG_LEVEL', 'INFO').upper()
+# fraction of OCMs for which the per-condition / per-rule DEBUG output is written when DEBUG is enabled
+LOG_DEBUG_SAMPLE = float(os.getenv('KF_LOG_DEBUG_SAMPLE', '1.0'))
+
+# the keys passed in extra={...} that are written as fields of the log entry
+LOG_FIELDS = ('message_id', 'sub_id', 'object_type', 'entity_id', 'webhook_id', 'topic', 'ruleset')
+
+###################################################################################################
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'severity' : record.levelname,
+                 'message'  : record.getMessage(),
+                 'logger'   : record.name,
+                }
+        for field in LOG_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+kf_logger = logging.getLogger('kingfisher')
+if not kf_logger.handlers:
+    log_handler = logging.StreamHandler(sys.stdout)
+    log_handler.setFormatter(JsonFormatter())
+    kf_logger.addHandler(log_handler)
+    kf_logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    kf_logger.propagate = False  # the runtime's own root handlers would write every entry a second time
+
+def getLogger(name):
+    """
+        Return the logger for a module, under the 'kingfisher' logger that writes the JSON entries.
+        Pass the message arguments separately, log.info('%d webhooks', len(webhooks)), so nothing
+        is formatted for an entry below the level.
+    """
+    return kf_logger.getChild(name.split('.')[-1])
+
+def traceEnabled(logger):
+    """
+        Decide once per OCM whether its DEBUG output (conditions, rule rows, expressions) is written,
+        True for a LOG_DEBUG_SAMPLE fraction of OCMs when DEBUG is enabled for the logger.
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return False
+    return LOG_DEBUG_SAMPLE >= 1.0 or random.random() < LOG_DEBUG_SAMPLE
@@ -0,0 +1,131 @@
+import os
+import json
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from app.helpers.kflog import getLogger
+
+SCHEMA_FILE = os.path.join(os.path.dirname(__file__), '..', '..', 'configs', 'schemas.json')
+
+# A table with a "partitioned" entry in configs/schemas.json is range partitioned on its key column into a
+# table per day (or hour), named <table>_<YYYYMMDD>[HH].  PARTITIONS_AHEAD intervals past the current one
+# are kept created, and partitions that end more than retention_days ago are dropped whole, which
+# reclaims the space at once instead of leaving a table bloated by DELETEs for vacuum to work through.
+PARTITIONS_AHEAD = int(os.getenv('KF_PARTITIONS_AHEAD', '2'))
+
+INTERVALS = {'day'  : (timedelta(days=1),  '%Y%m%d'),
+             'hour' : (timedelta(hours=1), '%Y%m%d%H'),
+            }
+
+SQL = {
+        "create parent"    : "CREATE TABLE IF NOT EXISTS {table} ({columns}) PARTITION BY RANGE ({key});",
+        "create partition" : "CREATE TABLE IF NOT EXISTS {partition} PARTITION OF {table} FOR VALUES FROM ('{start}') TO ('{end}');",
+        "create index"     : "CREATE INDEX IF NOT EXISTS {table}_{name}_idx ON {table} ({columns});",
+        "drop partition"   : "DROP TABLE IF EXISTS {partition};",
+        "partitions"       : "SELECT child.relname FROM pg_inherits "
+                             "JOIN pg_class parent ON pg_inherits.inhparent = parent.oid "
+                             "JOIN pg_class child  ON pg_inherits.inhrelid  = child.oid "
+                             "WHERE parent.relname = %(table)s;",
+      }
+
+log = getLogger(__name__)
+
+###################################################################################################
+
+def readSchema(schema_file=SCHEMA_FILE):
+    with open(schema_file) as json_data:
+        return json.load(json_data, object_pairs_hook=OrderedDict)['schema']
+
+def partitionSpec(table, schema_file=SCHEMA_FILE):
+    """
+        Return the "partitioned" entry for the table in the schema file, None when it isn't partitioned.
+        The entry has the key column, the interval ("day" or "hour"), retention_days and the indexes,
+        each a list of columns.
+    """
+    for entry in readSchema(schema_file):
+        if table in entry:
+            return entry.get('partitioned')
+    return None
+
+def partitionedTables(schema_file=SCHEMA_FILE):
+    """
+        Return a list of (table, spec) for the partitioned tables in the schema file.
+    """
+    tables = []
+    for entry in readSchema(schema_file):
+        if 'partitioned' in entry:
+            table = [name for name in entry if name != 'partitioned'][0]
+            tables.append((table, entry['partitioned']))
+    return tables
+
+def columnDefinitions(schema):
+    # a data type ending in NULL is for a column that can be empty, every other column is NOT NULL
+    return ', '.join(f"{column_name} {data_type}" if data_type.endswith(' NULL') else f"{column_name} {data_type} NOT NULL"
+                     for column_name, data_type in schema.items())
+
+###################################################################################################
+
+def partitionStart(moment, interval):
+    if interval == 'hour':
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def partitionName(table, start, interval):
+    return f"{table}_{start.strftime(INTERVALS[interval][1])}"
+
+def partitionsWanted(table, spec, now=None):
+    """
+        Return the (name, start, end) of the partitions from the one for now through PARTITIONS_AHEAD more.
+    """
+    step = INTERVALS[spec['interval']][0]
+    start = partitionStart(now or datetime.utcnow(), spec['interval'])
+    wanted = []
+    for ix in range(PARTITIONS_AHEAD + 1):
+        wanted.append((partitionName(table, start, spec['interval']), start, start + step))
+        start += step
+    return wanted
+
+def isExpired(table, partition, spec, now=None):
+    """
+        True when all of the partition's range is older than the retention period.
+    """
+    step, name_format = INTERVALS[spec['interval']]
+    try:
+        start = datetime.strptime(partition[len(table) + 1:], name_format)
+    except ValueError:
+        return False    # not one of ours
+    return start + step <= (now or datetime.utcnow()) - timedelta(days=spec['retention_days'])
+
+###################################################################################################
+
+def createPartitionedTable(cursor, table, schema, spec, now=None):
+    cursor.execute(SQL['create parent'].format(table=table, columns=columnDefinitions(schema), key=spec['key']))
+    # an index on the parent is created on every partition, those there now and those created later
+    for columns in spec.get('indexes', []):
+        cursor.execute(SQL['create index'].format(table=table, name='_'.join(columns), columns=', '.join(columns)))
+    return maintainPartitions(cursor, table, spec, now)
+
+def maintainPartitions(cursor, table, spec, now=None):
+    """
+        Create the partitions for now and PARTITIONS_AHEAD intervals ahead that don't exist yet and drop the
+        expired ones.  Returns (created, dropped) lists of partition names.
+    """
+    cursor.execute(SQL['partitions'], {'table' : table})
+    existing = set(row[0] for row in cursor.fetchall())
+
+    created = []
+    for partition, start, end in partitionsWanted(table, spec, now):
+        if partition not in existing:
+            cursor.execute(SQL['create partition'].format(partition=partition, table=table,
+                                                           start=start.isoformat(), end=end.isoformat()))
+            created.append(partition)
+
+    dropped = []
+    for partition in sorted(existing):
+        if isExpired(table, partition, spec, now):
+            cursor.execute(SQL['drop partition'].format(partition=partition))
+            dropped.append(partition)
+
+    if created or dropped:
+        log.info('%s partitions created: %s dropped: %s', table, created, dropped)
+    return created, dropped
@@ -1,10 +1,23 @@
 import sys, os, io
+import json
+import time
+import hashlib
+import select
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 
 save_stderr = sys.stderr
 sys.stderr = io.StringIO()
 import psycopg2
+import psycopg2.pool
+import psycopg2.extras
 sys.stderr = save_stderr
 
+from app.helpers.kflog import getLogger
+
+log = getLogger(__name__)
+
 TEMPLATE_DB_URL = "postgresql://{DB_USER}:{DB_PASSWORD}@/{DB_NAME}?host=/cloudsql/{GCP_PROJECT}:{GCP_ZONE}:{GCLOUD_SQL_INSTANCE}"
 
 #from app.utils.confenv import setVariables
@@ -18,6 +31,93 @@ SELECT = {'webhook'   : WEBHOOK_ATTRIBUTES,
           'condition' : CONDITION_ATTRIBUTES
          }
 
+# Webhooks for a sub_id that apply to the object_type (a webhook with no object_types applies to all of them)
+# along with only the conditions those webhooks reference, both row sets in a single round trip.
+# Each row set comes back as a JSON array of arrays, which psycopg2 hands back as a list of lists.
+QUALIFIERS_QUERY = \
+"""
+WITH relevant_webhook AS (
+    SELECT {webhook_columns}
+      FROM webhook
+     WHERE sub_id = %(sub_id)s
+       AND (%(object_type)s::TEXT IS NULL
+            OR %(object_type)s = ANY(object_types)
+            OR coalesce(cardinality(object_types), 0) = 0)
+)
+SELECT (SELECT coalesce(json_agg(json_build_array({webhook_columns}) ORDER BY id), '[]')
+          FROM relevant_webhook),
+       (SELECT coalesce(json_agg(json_build_array({condition_columns}) ORDER BY id), '[]')
+          FROM condition
+         WHERE sub_id = %(sub_id)s
+           AND id IN (SELECT unnest(conditions) FROM relevant_webhook))
+""".format(webhook_columns=WEBHOOK_ATTRIBUTES, condition_columns=CONDITION_ATTRIBUTES)
+
+# A GCF instance handles KF_FUNCTION_CONCURRENCY requests at a time (1 for the python37 runtime),
+# so the pool never needs more connections than that.  An instance that looks up qualifiers in Postgres
+# also holds one connection outside the pool, the qualifier_listener LISTENing for changes.  Keep
+#     max function instances * (KF_DB_POOL_MAX + 1)  <=  Cloud SQL max_connections
+DB_POOL_MIN   = int(os.getenv('KF_DB_POOL_MIN', '0'))
+DB_POOL_MAX   = int(os.getenv('KF_DB_POOL_MAX', os.getenv('KF_FUNCTION_CONCURRENCY', '1')))
+DB_POOL_IDLE_CHECK = int(os.getenv('KF_DB_POOL_IDLE_CHECK', '30'))    # seconds idle before a connection gets pinged
+DB_POOL_RECYCLE    = int(os.getenv('KF_DB_POOL_RECYCLE',    '1800'))  # seconds before a connection is replaced
+
+RECONNECTABLE_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+# webhook and condition rows change rarely, so qualifiers are cached per (sub_id, object_type) for up to
+# KF_QUALIFIER_CACHE_TTL seconds, and dropped sooner when a change is announced on QUALIFIER_CHANNEL
+QUALIFIER_CACHE_SIZE   = int(os.getenv('KF_QUALIFIER_CACHE_SIZE',   '1024'))
+QUALIFIER_CACHE_TTL    = float(os.getenv('KF_QUALIFIER_CACHE_TTL',  '60'))
+QUALIFIER_CACHE_REPORT = int(os.getenv('KF_QUALIFIER_CACHE_REPORT', '1000'))  # print the cache stats every n lookups
+QUALIFIER_CHANNEL      = 'kf_qualifiers_changed'
+LISTENER_RETRY_DELAY   = 30  # seconds to wait before trying to re-establish a failed LISTEN connection
+
+# installed on the webhook and condition tables (see crpgtable.py) so that every change
+# sends the affected sub_id (or '' for a TRUNCATE) to the listeners on QUALIFIER_CHANNEL
+QUALIFIER_NOTIFY_FUNCTION = \
+"""
+CREATE OR REPLACE FUNCTION kf_notify_qualifiers_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        PERFORM pg_notify('{channel}', '');
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('{channel}', OLD.sub_id::TEXT);
+    ELSE
+        PERFORM pg_notify('{channel}', NEW.sub_id::TEXT);
+        IF TG_OP = 'UPDATE' AND NEW.sub_id IS DISTINCT FROM OLD.sub_id THEN
+            PERFORM pg_notify('{channel}', OLD.sub_id::TEXT);
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+""".format(channel=QUALIFIER_CHANNEL)
+
+QUALIFIER_NOTIFY_TRIGGERS = \
+"""
+CREATE TRIGGER {table}_qualifiers_changed AFTER INSERT OR UPDATE OR DELETE ON {table}
+    FOR EACH ROW EXECUTE PROCEDURE kf_notify_qualifiers_changed();
+CREATE TRIGGER {table}_qualifiers_truncated AFTER TRUNCATE ON {table}
+    FOR EACH STATEMENT EXECUTE PROCEDURE kf_notify_qualifiers_changed();
+"""
+
+# the pool and the bookkeeping about its connections live at module level so they survive
+# across invocations of a warm function instance
+db_pool = None
+connection_birth = {}   # id(conn) : time the connection was opened
+connection_used  = {}   # id(conn) : time the connection was last returned to the pool
+
+qualifier_listener = None   # dedicated connection LISTENing on QUALIFIER_CHANNEL
+listener_attempted = 0      # time of the last attempt to establish the qualifier_listener
+listener_lock = threading.Lock()  # held by the thread polling the qualifier_listener
+
+# a stand-in for the qualifiers query such as the SQLite tables of harness.py, a callable
+# (sub_id, object_type) -> (webhooks, conditions); None queries Postgres
+qualifier_source = None
+
+def setQualifierSource(source):
+    global qualifier_source
+    qualifier_source = source
+
 #####################################################################################################
 
 def getQualifiers(target_table, sub_id):
@@ -30,30 +130,304 @@ def getQualifiers(target_table, sub_id):
     query_data  = {'sub_id' : sub_id }
     conditions  = 'WHERE '
     conditions += ' AND '.join([f'{item} {relation} {value_holder}' for item, relation, value_holder in criteria])
-    dbconn = dbConnection()
+    query_statement = f"select {columns} from {target_table} {conditions}"
     rows = []
     try:
+        rows = runQuery(query_statement, query_data)
+    except Exception as error:
+        log.error('%s', error, extra={'sub_id' : sub_id})
+    return rows
+
+#####################################################################################################
+
+def fetchSubscriptionQualifiers(sub_id, object_type=None):
+    """
+        Return a (webhooks, conditions) pair for the sub_id where webhooks are only those that
+        can apply to the object_type (all of them when object_type is None) and conditions are
+        only those referenced by the returned webhooks.  Errors are raised to the caller.
+    """
+    if qualifier_source is not None:
+        return qualifier_source(sub_id, object_type)
+    query_data = {'sub_id' : sub_id, 'object_type' : object_type}
+    rows = runQuery(QUALIFIERS_QUERY, query_data)
+    if not rows:
+        return [], []
+    webhooks, conditions = rows[0]
+    return webhooks, conditions
+
+#####################################################################################################
+
+class QualifierCache:
+    """
+        A bounded LRU of (version, webhooks, conditions) rule sets keyed by (sub_id, object_type),
+        with each entry expiring ttl seconds after it was loaded.
+    """
+    def __init__(self, max_size=QUALIFIER_CACHE_SIZE, ttl=QUALIFIER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl      = ttl
+        self.entries  = OrderedDict()  # (sub_id, object_type) : (expiration, (version, webhooks, conditions))
+        self.lock     = threading.Lock()
+        self.stats    = {'hits' : 0, 'misses' : 0, 'evictions' : 0, 'expirations' : 0, 'invalidations' : 0}
+
+    def get(self, sub_id, object_type):
+        key = (sub_id, object_type)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            expiration, ruleset = entry
+            if expiration <= time.time():
+                del self.entries[key]
+                self.stats['expirations'] += 1
+                self.stats['misses']      += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return ruleset
+
+    def put(self, sub_id, object_type, ruleset):
+        key = (sub_id, object_type)
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, ruleset)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, sub_id=None, object_type=None):
+        """
+            Drop every entry for the sub_id (only the one for the object_type when that is given),
+            or every entry in the cache when sub_id is None.
+        """
+        with self.lock:
+            if object_type is not None:
+                dropped = [key for key in self.entries if key == (sub_id, object_type)]
+            elif sub_id is None:
+                dropped = list(self.entries.keys())
+            else:
+                dropped = [key for key in self.entries if str(key[0]) == str(sub_id)]
+            for key in dropped:
+                del self.entries[key]
+            self.stats['invalidations'] += len(dropped)
+
+    def lookups(self):
+        return self.stats['hits'] + self.stats['misses']
+
+qualifier_cache = QualifierCache()
+
+def getRuleSet(sub_id, object_type=None, refresh=False):
+    """
+        Return a (version, webhooks, conditions) triple for the sub_id and object_type, where the webhooks and
+        conditions are as for fetchSubscriptionQualifiers and version is a short digest of them that changes
+        whenever they do.  The rule set comes from the qualifier_cache unless it isn't there or refresh is True.
+        A failed DB lookup yields a None version and empty lists that are not cached.
+    """
+    if qualifier_source is None:
+        pollQualifierChanges()
+    if refresh:
+        qualifier_cache.invalidate(sub_id, object_type)
+    cached = qualifier_cache.get(sub_id, object_type)
+    if qualifier_cache.lookups() % QUALIFIER_CACHE_REPORT == 0:
+        log.info('qualifier cache: %d entries, stats: %s', len(qualifier_cache.entries), qualifier_cache.stats)
+    if cached is not None:
+        return cached
+    try:
+        webhooks, conditions = fetchSubscriptionQualifiers(sub_id, object_type)
+    except Exception as error:
+        log.error('%s', error, extra={'sub_id' : sub_id})
+        return None, [], []
+    ruleset = (rulesetVersion(webhooks, conditions), webhooks, conditions)
+    qualifier_cache.put(sub_id, object_type, ruleset)
+    return ruleset
+
+def rulesetVersion(webhooks, conditions):
+    return hashlib.sha1(json.dumps([webhooks, conditions]).encode()).hexdigest()[:16]
+
+def pollQualifierChanges():
+    """
+        Without blocking, consume any change notifications that have arrived on the LISTEN connection
+        and invalidate the affected cache entries.  Whenever the LISTEN connection has to be (re)established
+        notifications may have been missed, so the whole cache is invalidated.
+        One thread polls at a time, the others carry on with the cache as it is rather than wait.
+    """
+    if not listener_lock.acquire(blocking=False):
+        return
+    try:
+        pollListener()
+    finally:
+        listener_lock.release()
+
+def pollListener():
+    global qualifier_listener, listener_attempted
+    if qualifier_listener is None:
+        if time.time() - listener_attempted < LISTENER_RETRY_DELAY:
+            return
+        listener_attempted = time.time()
+        qualifier_listener = dbConnection()
+        if qualifier_listener is None:
+            return
+        try:
+            qualifier_listener.autocommit = True
+            cur = qualifier_listener.cursor()
+            cur.execute(f'LISTEN {QUALIFIER_CHANNEL}')
+            cur.close()
+        except Exception as error:
+            log.warning('unable to LISTEN for qualifier changes, %s', error)
+            discardListener()
+            return
+        qualifier_cache.invalidate()
+    try:
+        if select.select([qualifier_listener], [], [], 0)[0]:
+            qualifier_listener.poll()
+        while qualifier_listener.notifies:
+            notification = qualifier_listener.notifies.pop(0)
+            qualifier_cache.invalidate(notification.payload or None)
+    except Exception as error:
+        log.warning('lost the LISTEN connection for qualifier changes, %s', error)
+        discardListener()
+        qualifier_cache.invalidate()
+
+def discardListener():
+    global qualifier_listener
+    try:
+        qualifier_listener.close()
+    except Exception:
+        pass
+    qualifier_listener = None
+
+#####################################################################################################
+
+def runQuery(query_statement, query_data):
+    """
+        Execute the query_statement on a pooled connection and return all the resulting rows.
+        A connection that turns out to be dead (Cloud SQL restart, idle timeout, proxy hiccup)
+        is thrown away and the query is attempted once more on a fresh connection.
+    """
+    for attempt in (1, 2):
+        try:
+            with pooledConnection() as dbconn:
+                cur = dbconn.cursor()
+                cur.execute(query_statement, query_data)
+                rows = cur.fetchall()
+                cur.close()
+                return rows
+        except RECONNECTABLE_ERRORS as error:
+            if attempt == 2:
+                raise
+            log.warning('discarding a broken Postgres connection and retrying the query, %s', error)
+
+def copyRows(table, columns, csv_file):
+    """
+        Load the CSV rows in csv_file (a file like object positioned at the start) into the columns
+        of the table with a single COPY on a pooled connection.
+    """
+    copy_statement = f"COPY {table} ({','.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '')"
+    with pooledConnection() as dbconn:
         cur = dbconn.cursor()
-        # query
-        query_statement = f"select {columns} from {target_table} {conditions}"
-        cur.execute(query_statement, query_data)
-        rows = cur.fetchall()
-        #print(rows)
+        cur.copy_expert(copy_statement, csv_file)
+        cur.close()
 
-        # close communication with the PostgreSQL database server
+def executeValues(statement, rows, page_size=1000):
+    """
+        Execute an INSERT statement whose VALUES %s is filled from the sequence of row tuples, with
+        page_size rows per statement, on a pooled connection.
+    """
+    with pooledConnection() as dbconn:
+        cur = dbconn.cursor()
+        psycopg2.extras.execute_values(cur, statement, rows, page_size=page_size)
         cur.close()
-        ## commit the changes
-        #dbconn.commit()
-    except Exception as error:
-        print(error)
+
+def executeStatement(statement, data=None):
+    """
+        Execute a statement that returns no rows on a pooled connection, returns the rowcount.
+    """
+    with pooledConnection() as dbconn:
+        cur = dbconn.cursor()
+        cur.execute(statement, data)
+        rowcount = cur.rowcount
+        cur.close()
+        return rowcount
+
+#####################################################################################################
+
+@contextmanager
+def pooledConnection():
+    """
+        Check out a healthy connection from the module level pool and hand it back when done.
+        Connections that raise a connection level error are closed rather than returned to the pool.
+    """
+    dbconn = checkoutConnection()
+    broken = False
+    try:
+        yield dbconn
+    except RECONNECTABLE_ERRORS:
+        broken = True
+        raise
     finally:
-        if dbconn is not None:
-            dbconn.close()
-    return rows
+        checkinConnection(dbconn, discard=broken or dbconn.closed)
+
+def connectionPool():
+    global db_pool
+    if db_pool is None or db_pool.closed:
+        db_pool = psycopg2.pool.ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, databaseURI())
+    return db_pool
+
+def checkoutConnection():
+    pool = connectionPool()
+    # every connection sitting in the pool may have gone stale, so allow for trying each of them plus a fresh one
+    for attempt in range(DB_POOL_MAX + 1):
+        dbconn = pool.getconn()
+        key = id(dbconn)
+        now = time.time()
+        if key not in connection_birth:
+            dbconn.autocommit = True   # lookups only, never leave a connection idle in a transaction
+            connection_birth[key] = now
+            connection_used[key]  = now
+            return dbconn
+        if isHealthy(dbconn, now):
+            return dbconn
+        checkinConnection(dbconn, discard=True)
+    raise psycopg2.OperationalError("Unable to obtain a healthy Postgres connection from the pool")
+
+def checkinConnection(dbconn, discard=False):
+    key = id(dbconn)
+    if discard:
+        connection_birth.pop(key, None)
+        connection_used.pop(key, None)
+    else:
+        connection_used[key] = time.time()
+    try:
+        connectionPool().putconn(dbconn, close=discard)
+    except psycopg2.pool.PoolError as error:
+        log.warning('unable to return a connection to the pool, %s', error)
+
+def isHealthy(dbconn, now):
+    if dbconn.closed:
+        return False
+    if now - connection_birth[id(dbconn)] > DB_POOL_RECYCLE:
+        return False
+    if now - connection_used[id(dbconn)] < DB_POOL_IDLE_CHECK:
+        return True
+    try:
+        cur = dbconn.cursor()
+        cur.execute('SELECT 1')
+        cur.close()
+        return True
+    except RECONNECTABLE_ERRORS:
+        return False
+
+def closePool():
+    global db_pool
+    if db_pool is not None and not db_pool.closed:
+        db_pool.closeall()
+    db_pool = None
+    connection_birth.clear()
+    connection_used.clear()
 
 #####################################################################################################
 
-def dbConnection():
+def databaseURI():
     gcp_project = os.getenv('GCP_PROJECT')
     gcp_zone    = os.getenv('GCP_ZONE')
     db_instance = os.getenv('GCLOUD_SQL_INSTANCE')
@@ -63,6 +437,10 @@ def dbConnection():
     database_uri = TEMPLATE_DB_URL.format( GCP_PROJECT=gcp_project, GCP_ZONE=gcp_zone,
                                            GCLOUD_SQL_INSTANCE=db_instance, DB_NAME=db_name,
                                            DB_USER=db_user, DB_PASSWORD=db_password)
+    return database_uri
+
+def dbConnection():
+    database_uri = databaseURI()
     #print("Database URI: %s" % database_uri)
     # connect to the PostgreSQL server
 
@@ -70,7 +448,7 @@ def dbConnection():
        dbconn = psycopg2.connect(database_uri)
        return dbconn
     except:
-       print("ERROR: Unable to get a Postgres DB Connection to %s / %s" % (db_instance, db_name))
+       log.error("Unable to get a Postgres DB Connection to %s / %s", os.getenv('GCLOUD_SQL_INSTANCE'), os.getenv('DB_NAME'))
        return None
 
 #####################################################################################################
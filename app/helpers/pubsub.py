@@ -1,17 +1,92 @@
 import json
+import time
+import threading
 from os import getenv
 
 from google.cloud import pubsub_v1
 
+from app.helpers.kflog import getLogger
+
+log = getLogger(__name__)
+
+# Messages published within PUBLISH_MAX_LATENCY seconds of each other go out in a single RPC
+# of up to PUBLISH_MAX_MESSAGES messages / PUBLISH_MAX_BYTES bytes.
+PUBLISH_MAX_MESSAGES    = int(getenv('KF_PUBSUB_MAX_MESSAGES',    '100'))
+PUBLISH_MAX_BYTES       = int(getenv('KF_PUBSUB_MAX_BYTES',       str(1024 * 1024)))
+PUBLISH_MAX_LATENCY     = float(getenv('KF_PUBSUB_MAX_LATENCY',   '0.01'))
+# the publisher in this version of google-cloud-pubsub has no flow control of its own, so publish()
+# blocks once this many messages are waiting on a result
+PUBLISH_MAX_OUTSTANDING = int(getenv('KF_PUBSUB_MAX_OUTSTANDING', '1000'))
+PUBLISH_TIMEOUT = 10  # seconds
+
+# one publisher (gRPC channel, credentials, batching threads) per process, reused by warm invocations
+publisher   = None
+topic_paths = {}
+publisher_lock   = threading.Lock()
+outstanding_slot = threading.BoundedSemaphore(PUBLISH_MAX_OUTSTANDING)
+
+# a stand-in for Pub/Sub such as the in-process bus of harness.py, an object whose
+# publish(topic_name, message_data) returns a future; None publishes to Pub/Sub
+transport = None
+
+def setTransport(bus):
+    global transport
+    transport = bus
+
+def getPublisher():
+    global publisher
+    if publisher is None:
+        with publisher_lock:
+            if publisher is None:
+                batch_settings = pubsub_v1.types.BatchSettings(max_messages=PUBLISH_MAX_MESSAGES,
+                                                               max_bytes=PUBLISH_MAX_BYTES,
+                                                               max_latency=PUBLISH_MAX_LATENCY)
+                publisher = pubsub_v1.PublisherClient(batch_settings=batch_settings)
+    return publisher
+
+def getTopicPath(topic_name):
+    if topic_name not in topic_paths:
+        topic_paths[topic_name] = getPublisher().topic_path(getenv('GCP_PROJECT'), topic_name)
+    return topic_paths[topic_name]
+
 def publish(topic_name, message_dict):
-    publisher = pubsub_v1.PublisherClient()
-    topic_path = publisher.topic_path(getenv('GCP_PROJECT'), topic_name)
-    message_future = publisher.publish(topic_path, json.dumps(message_dict).encode())
+    return publishEncoded(topic_name, json.dumps(message_dict).encode())
+
+def publishEncoded(topic_name, message_data):
+    """
+        Publish message_data, bytes that are already encoded, to the topic.
+    """
+    if transport is not None:
+        return transport.publish(topic_name, message_data)
+    topic_path = getTopicPath(topic_name)
+    outstanding_slot.acquire()
+    try:
+        message_future = getPublisher().publish(topic_path, message_data)
+    except:
+        outstanding_slot.release()
+        raise
+    message_future.add_done_callback(lambda x: outstanding_slot.release())
     message_future.add_done_callback(lambda x: __handle_pubsub_exceptions(topic_name, x))
     return message_future
 
+def awaitPublished(pending, timeout=PUBLISH_TIMEOUT):
+    """
+        Wait on a set of messages that were all published before waiting on any of them, with one deadline
+        for the whole set.  pending is a sequence of (label, message_future) pairs; the return is a list of
+        (label, result, exception) triples in the same order where result is the Pub/Sub message id
+        and exception is None for a message that was published.
+    """
+    deadline = time.time() + timeout
+    outcomes = []
+    for label, message_future in pending:
+        try:
+            result = message_future.result(timeout=max(0, deadline - time.time()))
+            outcomes.append((label, result, None))
+        except Exception as exception:
+            outcomes.append((label, None, exception))
+    return outcomes
+
 def __handle_pubsub_exceptions(topic, message_future):
     # When timeout is unspecified, the exception method waits indefinitely.
     if message_future.exception(timeout=10):
-        print('Publishing message on {} threw an Exception {}.'.format(
-            topic, message_future.exception()))
+        log.error('Publishing message on %s threw an Exception %s.', topic, message_future.exception(), extra={'topic' : topic})
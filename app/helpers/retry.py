@@ -0,0 +1,106 @@
+import os
+import time
+import heapq
+import threading
+from itertools import count
+
+from app.helpers.delivery import DELIVERED, FAILED, TIMEOUT, THROTTLED
+
+# Seconds to wait before each automatic replay of a webhook whose POST didn't succeed, the first replay
+# is RETRY_DELAYS[0] seconds after the first attempt failed and so on.  Once all of them have been
+# used the webhook is not fired again.
+RETRY_DELAYS       = [float(delay) for delay in os.getenv('KF_RETRY_DELAYS', '0,2,10').split(',') if delay.strip()]
+RETRY_MAX_ATTEMPTS = int(os.getenv('KF_RETRY_MAX_ATTEMPTS', str(len(RETRY_DELAYS) + 1)))
+
+# a READY message this close to its eligible time is fired rather than deferred, for clock differences between machines
+ELIGIBLE_SLACK = 1.0  # seconds
+
+# a response with one of these statuses is not going to be any different on a replay
+PERMANENT_STATUS = (400, 401, 403, 404, 405, 410, 413, 414, 415, 422)
+
+###################################################################################################
+
+def isRetryable(delivery):
+    if delivery.outcome in (TIMEOUT, THROTTLED):
+        return True
+    if delivery.outcome == FAILED:
+        return delivery.status_code not in PERMANENT_STATUS
+    return False
+
+def retryMessage(ready, delivery, now=None):
+    """
+        Given the READY message for an attempt and the Delivery the attempt got, return the READY message
+        for the next attempt, with attempts counting the attempts made so far and eligible the epoch seconds
+        at which the next attempt can be made, or None when the webhook isn't to be fired again.
+    """
+    if delivery.outcome == DELIVERED or not isRetryable(delivery):
+        return None
+    attempts = ready.get('attempts', 0) + 1
+    if attempts >= RETRY_MAX_ATTEMPTS or attempts > len(RETRY_DELAYS):
+        return None
+    now = time.time() if now is None else now
+    return dict(ready, attempts=attempts, eligible=now + RETRY_DELAYS[attempts - 1])
+
+def isEligible(ready, now=None):
+    now = time.time() if now is None else now
+    return ready.get('eligible', 0) <= now + ELIGIBLE_SLACK
+
+###################################################################################################
+
+class RetryScheduler:
+    """
+        Holds items until their eligible time, in a heap ordered by that time so adding an item and
+        taking the next due one are O(log n) however many are waiting.
+        Items are added by one thread (a Pub/Sub callback) and taken by another, take() waits on a
+        condition for the next item to come due instead of polling.
+    """
+    def __init__(self):
+        self.heap      = []         # (eligible, sequence, item)
+        self.sequence  = count()    # keeps the order of items with the same eligible time and keeps items out of comparisons
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def add(self, item, eligible):
+        with self.condition:
+            heapq.heappush(self.heap, (eligible, next(self.sequence), item))
+            if self.heap[0][2] is item:
+                self.condition.notify()
+
+    def due(self, now=None):
+        """
+            Remove and return the items whose eligible time has been reached, earliest first.
+        """
+        now = time.time() if now is None else now
+        items = []
+        with self.condition:
+            while self.heap and self.heap[0][0] <= now:
+                items.append(heapq.heappop(self.heap)[2])
+        return items
+
+    def nextDue(self):
+        """
+            Seconds until the earliest item comes due (0 when one already has), or None when empty.
+        """
+        with self.condition:
+            if not self.heap:
+                return None
+            return max(0.0, self.heap[0][0] - time.time())
+
+    def take(self, timeout=None):
+        """
+            Wait up to timeout seconds (forever when None) for items to come due and return them.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while True:
+                now = time.time()
+                if self.heap and self.heap[0][0] <= now:
+                    return self.due(now)
+                wait = self.heap[0][0] - now if self.heap else None
+                if deadline is not None:
+                    if now >= deadline:
+                        return []
+                    wait = deadline - now if wait is None else min(wait, deadline - now)
+                self.condition.wait(wait)
@@ -0,0 +1,160 @@
+import os
+import time
+import atexit
+import threading
+from datetime import datetime, timedelta
+
+from app.helpers.kflog import getLogger
+from app.helpers.pgdb  import executeValues, executeStatement, runQuery
+
+# Counts of outcomes per minute, sub_id, object_type and outcome are kept in memory by each function
+# instance and added to the delivery_rollup table every ROLLUP_INTERVAL seconds, so the monitoring and
+# reporting windows are sums over at most a few thousand minute rows rather than scans of delivery_log.
+ROLLUP_TABLE          = os.getenv('KF_ROLLUP_TABLE', 'delivery_rollup')
+ROLLUP_INTERVAL       = float(os.getenv('KF_ROLLUP_INTERVAL',     '10'))
+ROLLUP_RETENTION_DAYS = int(os.getenv('KF_ROLLUP_RETENTION_DAYS', '31'))
+
+# outcomes, from the evaluator and from the firing stage
+READY       = 'ready'
+NOGO        = 'nogo'
+NO_WEBHOOKS = 'no_webhooks'
+RETRIED     = 'retried'
+SUCCESS_OUTCOMES = ('delivered',)
+FAILURE_OUTCOMES = ('failed', 'timeout', 'throttled', 'invalid')
+
+# the windows of the monitoring views, the minute windows end at the current minute
+WINDOW_MINUTES = {'1m' : 1, '5m' : 5, '10m' : 10, '30m' : 30, '1h' : 60, '4h' : 240, '8h' : 480}
+WINDOW_NAMES   = list(WINDOW_MINUTES) + ['today', 'yesterday']
+
+SQL = {
+        "upsert"     : "INSERT INTO {table} (minute, sub_id, object_type, outcome, total) VALUES %s "
+                       "ON CONFLICT (minute, sub_id, object_type, outcome) DO UPDATE SET total = {table}.total + EXCLUDED.total",
+        "totals"     : "SELECT outcome, SUM(total) FROM {table} WHERE minute >= %(start)s AND minute < %(end)s {sub_clause}"
+                       "GROUP BY outcome",
+        "by type"    : "SELECT object_type, outcome, SUM(total) FROM {table} WHERE minute >= %(start)s AND minute < %(end)s "
+                       "{sub_clause}GROUP BY object_type, outcome",
+        "top"        : "SELECT sub_id, SUM(total) AS volume FROM {table} WHERE minute >= %(start)s AND minute < %(end)s "
+                       "AND outcome IN %(outcomes)s GROUP BY sub_id ORDER BY volume DESC LIMIT %(limit)s",
+        "expire"     : "DELETE FROM {table} WHERE minute < %(before)s",
+      }
+
+log = getLogger(__name__)
+
+###################################################################################################
+
+class RollupCounter:
+    """
+        Minute buckets of outcome counts keyed by (minute, sub_id, object_type, outcome), flushed by
+        adding them to the rollup table with an upsert, so any number of instances can flush the same
+        minute.  As with the delivery log, the functions call flushIfDue() as an invocation finishes.
+    """
+    def __init__(self, table=ROLLUP_TABLE, interval=ROLLUP_INTERVAL, writer=executeValues):
+        self.table      = table
+        self.interval   = interval
+        self.writer     = writer
+        self.counts     = {}
+        self.last_flush = time.time()
+        self.lock       = threading.Lock()
+
+    def count(self, sub_id, object_type, outcome, amount=1, at=None):
+        minute = int((time.time() if at is None else at) // 60) * 60
+        key = (minute, sub_id, object_type or '', outcome)
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + amount
+
+    def flushIfDue(self):
+        if self.counts and time.time() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """
+            Add the counts to the rollup table, returns the number of rows upserted.
+        """
+        with self.lock:
+            counts, self.counts = self.counts, {}
+            self.last_flush = time.time()
+        if not counts:
+            return 0
+        rows = [(datetime.utcfromtimestamp(minute), sub_id, object_type, outcome, total)
+                for (minute, sub_id, object_type, outcome), total in counts.items()]
+        try:
+            self.writer(SQL['upsert'].format(table=self.table), rows)
+            return len(rows)
+        except Exception as error:
+            log.warning('unable to add %d rows to %s, keeping them for the next flush, %s', len(rows), self.table, error)
+            with self.lock:
+                for key, total in counts.items():
+                    self.counts[key] = self.counts.get(key, 0) + total
+            return 0
+
+###################################################################################################
+
+def windowRange(window, now=None):
+    """
+        Return the (start, end) UTC datetimes of a named window.
+    """
+    now = now or datetime.utcnow()
+    this_minute = now.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    if window in WINDOW_MINUTES:
+        return this_minute - timedelta(minutes=WINDOW_MINUTES[window]), this_minute
+    if window == 'today':
+        return today, this_minute
+    if window == 'yesterday':
+        return today - timedelta(days=1), today
+    raise ValueError(f"unknown window {window}, one of {WINDOW_NAMES}")
+
+def subClause(sub_id):
+    return 'AND sub_id = %(sub_id)s ' if sub_id is not None else ''
+
+def summarize(by_outcome):
+    summary = {'total'     : sum(by_outcome.get(outcome, 0) for outcome in SUCCESS_OUTCOMES + FAILURE_OUTCOMES),
+               'successes' : sum(by_outcome.get(outcome, 0) for outcome in SUCCESS_OUTCOMES),
+               'failures'  : sum(by_outcome.get(outcome, 0) for outcome in FAILURE_OUTCOMES),
+               'retried'   : by_outcome.get(RETRIED, 0),
+              }
+    summary['outcomes'] = by_outcome
+    return summary
+
+def windowTotals(window, sub_id=None, now=None, table=ROLLUP_TABLE):
+    """
+        Return the total / successes / failures / retried of the webhook POSTs in the window (for the sub_id
+        when given), and the count of every outcome under 'outcomes'.
+    """
+    start, end = windowRange(window, now)
+    rows = runQuery(SQL['totals'].format(table=table, sub_clause=subClause(sub_id)),
+                    {'start' : start, 'end' : end, 'sub_id' : sub_id})
+    return summarize({outcome : int(total) for outcome, total in rows})
+
+def windowTotalsByType(window, sub_id=None, now=None, table=ROLLUP_TABLE):
+    """
+        Return a dict of object_type : the windowTotals summary for that artifact type.
+    """
+    start, end = windowRange(window, now)
+    rows = runQuery(SQL['by type'].format(table=table, sub_clause=subClause(sub_id)),
+                    {'start' : start, 'end' : end, 'sub_id' : sub_id})
+    by_type = {}
+    for object_type, outcome, total in rows:
+        by_type.setdefault(object_type, {})[outcome] = int(total)
+    return {object_type : summarize(by_outcome) for object_type, by_outcome in by_type.items()}
+
+def topSubscriptions(window, measure='volume', limit=10, now=None, table=ROLLUP_TABLE):
+    """
+        Return the [(sub_id, count)] of the top subscriptions in the window by 'volume', 'successes' or 'failures'.
+    """
+    outcomes = {'volume'    : SUCCESS_OUTCOMES + FAILURE_OUTCOMES,
+                'successes' : SUCCESS_OUTCOMES,
+                'failures'  : FAILURE_OUTCOMES}[measure]
+    start, end = windowRange(window, now)
+    rows = runQuery(SQL['top'].format(table=table),
+                    {'start' : start, 'end' : end, 'outcomes' : tuple(outcomes), 'limit' : limit})
+    return [(sub_id, int(volume)) for sub_id, volume in rows]
+
+def expireRollups(retention_days=ROLLUP_RETENTION_DAYS, table=ROLLUP_TABLE):
+    before = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=retention_days)
+    return executeStatement(SQL['expire'].format(table=table), {'before' : before})
+
+###################################################################################################
+
+rollups = RollupCounter()
+atexit.register(rollups.flush)
@@ -0,0 +1,430 @@
+import os
+import operator
+from collections import namedtuple, OrderedDict
+
+#############################################################################################################################
+
+""" from the Pigeon Webhooks API documentation
+
+Operators
+The required fields in an Expression depend on the Operator.
+
+ ------------
+The following operators require both a Value and exactly one of AttributeID or AttributeName.
+
+Operator	Description
+   =	        Equal
+   !=	        Not equal
+   <	        Less than
+   <=	        Less than or equal
+   >	        Greater than
+   >=	        Greater than or equal
+   changed-to	Value changed to
+   changed-from	Value changed from
+
+  ------------
+The following operators require an AttributeID or AttributeName, and a Value that is an Array of individual values.
+
+Operator	Description
+    ~	    "Equals one of". Matches when the object's value for the attribute
+                             is equal to one of the values given in the Expression
+    !~	    "Equals none of". Matches when the object's value for the attribute
+            is not equal to any of the values given in the Expression
+
+  -----------
+The following operators require only an AttributeID or AttributeName (no Value)
+
+Operator	Description
+    has	        The object has some (non-null) value for the attribute
+    !has	    The object does not have the attribute, or its value is null
+    changed	    The value of the attribute was changed on the object
+"""
+
+
+def isEqual(ocm_attr_value, expression_value):
+    return ocm_attr_value == expression_value
+
+
+def isNotEqual(ocm_attr_value, expression_value):
+    return ocm_attr_value != expression_value
+
+
+def isLessThan(ocm_attr_value, expression_value):
+    return ocm_attr_value < expression_value
+
+
+def isLessThanOrEqual(ocm_attr_value, expression_value):
+    return ocm_attr_value <= expression_value
+
+
+def isGreaterThan(ocm_attr_value, expression_value):
+    return ocm_attr_value > expression_value
+
+
+def isGreaterThanOrEqual(ocm_attr_value, expression_value):
+    return ocm_attr_value >= expression_value
+
+
+# def isChangedTo(ocm, ocm_attr_id, expression_value):
+#    return False
+
+# def isChangedFrom(ocm, ocm_attr_id, expression_value):
+#    return False
+
+def isOneOf(ocm_attr_value, expression_value):
+    return ocm_attr_value in expression_value  # "cast" expression_value to a list
+
+
+def isNotOneOf(ocm_attr_value, expression_value):
+    return ocm_attr_value not in expression_value  # "cast" expression_value to a list
+
+
+# def hasSomeValue(ocm, ocm_attr_id, expression_value):
+#    return False
+
+# def hasNoValue(ocm, ocm_attr_id, expression_value):
+#    return False
+
+
+expression_eval = {'='   : isEqual,
+                   '!='  : isNotEqual,
+                   '<'   : isLessThan,
+                   '<='  : isLessThanOrEqual,
+                   '>'   : isGreaterThan,
+                   '>='  : isGreaterThanOrEqual,
+                   # 'changed-to'    : isChangedTo,
+                   # 'changed-from'  : isChangedFrom,
+                   # expressions that take an attribute_id|name and a list of possible values
+                   '~'   : isOneOf,
+                   '!~'  : isNotOneOf,
+                   # expressions that take just an attribute_id|name
+                   # 'has'     : hasSomeValue,
+                   # '!has'    : hasNoValue,
+                   # 'changed' : valueWasChanged
+                  }
+
+# same comparisons as expression_eval, bound to the C implementations where there is one
+compiled_eval = {'='   : operator.eq,
+                 '!='  : operator.ne,
+                 '<'   : operator.lt,
+                 '<='  : operator.le,
+                 '>'   : operator.gt,
+                 '>='  : operator.ge,
+                 '~'   : isOneOf,
+                 '!~'  : isNotOneOf,
+                }
+
+CHANGE_RELATIONS = ('changed-to', 'changed-from', 'changed')
+
+#############################################################################################################################
+
+# A condition row (id, sub_id, attribute_uuid, attribute_name, operator, value) compiled into a predicate.
+#   operand is the condition value coerced the way isQualified always has (int when possible)
+#   test(state, changes) returns the truth of the condition for an OCM's state and changes dicts
+#   source is the condition row the predicate was built from
+CompiledCondition = namedtuple('CompiledCondition', 'cond_id attr_uuid attr_name relation operand test source')
+
+COMPILED_CACHE_SIZE = int(os.getenv('KF_COMPILED_CACHE_SIZE', '50000'))
+
+compiled_conditions = {}  # cond_id : CompiledCondition
+
+def stateValue(var_info):
+    """
+        Given the info block for an attribute in an OCM's state, return the value a condition is checked against,
+        which for a reference value is the 'value' or 'name' in the referenced item.
+    """
+    attr_value = var_info['value']
+    if attr_value and isinstance(attr_value, dict):
+        if 'value' in attr_value:
+            return attr_value['value']
+        elif 'name' in attr_value:
+            return attr_value['name']
+    return attr_value
+
+def coerceOperand(condition_value):
+    try:
+        return int(condition_value)  # in case condition_value
+    except:
+        return condition_value
+
+def compileCondition(condition):
+    """
+        Turn a condition row into a CompiledCondition whose test does no more than
+        a dict lookup or two and a single comparison for each OCM it is applied to.
+    """
+    cond_id, sub_id, attr_uuid, attr_name, relation, condition_value = condition
+    operand = coerceOperand(condition_value)
+
+    if relation == 'changed-to':
+        def test(state, changes):
+            change = changes.get(attr_uuid)
+            return change is not None and change['value'] == operand
+    elif relation == 'changed-from':
+        def test(state, changes):
+            change = changes.get(attr_uuid)
+            return change is not None and change['old_value'] == operand
+    elif relation == 'changed':
+        def test(state, changes):
+            return attr_uuid in changes
+    elif relation == 'has':
+        def test(state, changes):
+            return stateValue(state[attr_uuid]) is not None
+    elif relation == '!has':
+        def test(state, changes):
+            return stateValue(state[attr_uuid]) is None
+    else:
+        compare = compiled_eval[relation]
+        def test(state, changes):
+            attr_value = stateValue(state[attr_uuid])
+            if not attr_value:
+                return False
+            return compare(attr_value, operand)
+
+    return CompiledCondition(cond_id, attr_uuid, attr_name, relation, operand, test, tuple(condition))
+
+def getCompiledCondition(condition):
+    """
+        Return the CompiledCondition for the condition row, compiling it only when the row
+        hasn't been seen before under its id or has changed since it was compiled.
+    """
+    compiled = compiled_conditions.get(condition[0])
+    if compiled is not None and compiled.source == tuple(condition):
+        return compiled
+    if len(compiled_conditions) >= COMPILED_CACHE_SIZE:
+        compiled_conditions.clear()
+    compiled = compileCondition(condition)
+    compiled_conditions[compiled.cond_id] = compiled
+    return compiled
+
+#############################################################################################################################
+
+# Relative cost of evaluating a condition, cheapest first.  The changed* relations and has/!has are
+# a dict lookup or two, the comparisons also unwrap the state value, and ~/!~ scan the operand.
+RELATION_COST = {'changed'      : 1,
+                 'changed-to'   : 1,
+                 'changed-from' : 1,
+                 'has'          : 2,
+                 '!has'         : 2,
+                 '='            : 3,
+                 '!='           : 3,
+                 '<'            : 3,
+                 '<='           : 3,
+                 '>'            : 3,
+                 '>='           : 3,
+                 '~'            : 4,
+                 '!~'           : 4,
+                }
+STATS_HALF_LIFE = 1000  # evaluations of a condition after which its counts are halved so the pass rate can drift
+
+condition_stats = {}  # cond_id : [times evaluated, times true]
+
+def rejectionRank(compiled):
+    """
+        Expected cost of a condition per rejection it produces, cost / (1 - pass rate).  Checking the
+        conditions of a webhook in ascending rank order is the cheapest way to find the one that disqualifies it.
+        The pass rate is observed across evaluations in this process, starting from an even chance.
+    """
+    evaluated, passed = condition_stats.get(compiled.cond_id, (0, 0))
+    pass_rate = (passed + 1) / (evaluated + 2)
+    return RELATION_COST.get(compiled.relation, 3) / (1 - pass_rate)
+
+def recordOutcome(cond_id, status):
+    stats = condition_stats.get(cond_id)
+    if stats is None:
+        stats = condition_stats[cond_id] = [0, 0]
+    stats[0] += 1
+    if status == True:
+        stats[1] += 1
+    if stats[0] >= STATS_HALF_LIFE:
+        stats[0] //= 2
+        stats[1] //= 2
+
+def decideGroup(conditions, state, changes, status):
+    """
+        Decide a group of webhooks that share the conditions, a list of (CompiledCondition, on_value) in the order
+        to try them (None when one of them wasn't compiled and the group can't qualify), on_value being True for a
+        condition on the value of an attribute rather than a change to it.  Each condition is evaluated at most
+        once per OCM, its status kept in status, and the group is decided as soon as one of them is not true.
+        A condition on the value of an attribute that isn't in the state at all holds only if it is !has.
+    """
+    if conditions is None:
+        return False
+    for compiled, on_value in conditions:
+        cond_id = compiled.cond_id
+        if cond_id in status:
+            result = status[cond_id]
+        elif on_value and compiled.attr_uuid not in state:
+            result = status[cond_id] = compiled.relation == '!has'
+        else:
+            result = status[cond_id] = compiled.test(state, changes)
+            recordOutcome(cond_id, result)
+        if result != True:
+            return False
+    return True
+
+#############################################################################################################################
+
+RULE_INDEX_CACHE_SIZE = int(os.getenv('KF_RULE_INDEX_CACHE_SIZE', '256'))
+RERANK_INTERVAL       = int(os.getenv('KF_RERANK_INTERVAL', '1000'))   # OCMs decided by an index between re-orderings
+                                                                        # of its conditions by rejectionRank
+
+rule_indexes = OrderedDict()  # rule set key : RuleIndex
+
+# The rules of an index for one object_type
+#   webhooks     [(webhook, group number)] for the webhooks that apply to the object_type, in webhooksFor order
+#   untriggered  group numbers of the groups that are decided for every OCM
+#   by_change    attr_uuid : [group number] for the groups triggered by a change to the attribute
+#   by_value     attr_uuid : [group number] for the groups triggered by a value of the attribute
+TypedRules = namedtuple('TypedRules', 'webhooks untriggered by_change by_value')
+
+class RuleIndex:
+    """
+        The webhooks and conditions of a subscription indexed so that matching an OCM against them
+        costs in proportion to the object_type and the attributes present in the OCM rather than
+        the number of webhooks and conditions.
+    """
+    def __init__(self, webhooks, conditions):
+        self.webhooks = webhooks
+        self.by_object_type  = {}   # object_type : [position of webhook in webhooks]
+        self.any_object_type = []   # positions of the webhooks that have no object_types (and so apply to all)
+        for position, webhook in enumerate(webhooks):
+            if not webhook[4]:
+                self.any_object_type.append(position)
+            for object_type in webhook[4]:
+                self.by_object_type.setdefault(object_type, []).append(position)
+
+        self.compiled = {}          # cond_id : CompiledCondition
+        for condition in conditions:
+            compiled = getCompiledCondition(condition)
+            self.compiled[compiled.cond_id] = compiled
+
+        # webhooks with the same set of condition ids are decided together as a group
+        self.group_of   = []        # position of webhook : group number
+        self.group_keys = {}        # sorted tuple of cond_ids : group number
+        for webhook in webhooks:
+            key = tuple(sorted(set(webhook[-1])))
+            self.group_of.append(self.group_keys.setdefault(key, len(self.group_keys)))
+        self.group_conditions = [None] * len(self.group_keys)  # group number : [(CompiledCondition, on_value)] in
+                                                                # rejectionRank order, None when a condition is missing
+        self.rank()
+
+        # A group can only qualify when its trigger condition can be true, a changed* condition when its attribute
+        # is in the OCM's changes, any other condition but !has when its attribute has a value in the OCM's state.
+        # The groups are indexed by the attribute of their trigger so an OCM only visits the groups its changes
+        # and state can satisfy.  A group with no trigger (no conditions, or only !has ones) is always visited.
+        self.group_trigger = [None] * len(self.group_keys)     # group number : (on_value, attr_uuid) or None
+        for key, group in self.group_keys.items():
+            conditions = [self.compiled.get(cond_id) for cond_id in key]
+            triggers = [(compiled.relation not in CHANGE_RELATIONS, compiled.attr_uuid) for compiled in conditions
+                        if compiled is not None and compiled.relation != '!has']
+            if triggers:
+                self.group_trigger[group] = min(triggers)   # a change trigger first, changes are few
+        self.relevant = {}          # object_type : relevant webhooks, filled in as object_types are seen
+        self.typed    = {}          # object_type : TypedRules, filled in as object_types are seen
+
+    def webhooksFor(self, object_type):
+        """
+            The webhooks that apply to the object_type, in the same order as getRelevantWebhooks returns them.
+        """
+        relevant = self.relevant.get(object_type)
+        if relevant is None:
+            relevant = self.relevant[object_type] = [self.webhooks[position] for position in self.positionsFor(object_type)]
+        return relevant
+
+    def positionsFor(self, object_type):
+        return sorted(self.by_object_type.get(object_type, []) + self.any_object_type)
+
+    def rank(self):
+        """
+            Order the conditions of every group by rejectionRank, cheapest way to a rejection first.
+        """
+        for key, group in self.group_keys.items():
+            conditions = [self.compiled.get(cond_id) for cond_id in key]
+            self.group_conditions[group] = None if None in conditions else \
+                [(compiled, compiled.relation not in CHANGE_RELATIONS) for compiled in sorted(conditions, key=rejectionRank)]
+        self.decided = 0
+
+    def conditionsFor(self, webhooks):
+        """
+            A dict of cond_id : CompiledCondition for the conditions referenced by the webhooks.
+        """
+        return {cond_id : self.compiled[cond_id] for webhook in webhooks for cond_id in webhook[-1]
+                                                 if cond_id in self.compiled}
+
+    def typedRules(self, object_type):
+        typed = self.typed.get(object_type)
+        if typed is None:
+            grouped = [(webhook, self.group_of[position])
+                       for position, webhook in zip(self.positionsFor(object_type), self.webhooksFor(object_type))]
+            typed = TypedRules(grouped, [], {}, {})
+            for group in sorted({group for webhook, group in grouped}):
+                if self.group_conditions[group] is None:
+                    continue                    # can't qualify, never visited
+                trigger = self.group_trigger[group]
+                if trigger is None:
+                    typed.untriggered.append(group)
+                else:
+                    on_value, attr_uuid = trigger
+                    (typed.by_value if on_value else typed.by_change).setdefault(attr_uuid, []).append(group)
+            self.typed[object_type] = typed
+        return typed
+
+    def candidates(self, typed, state, changes):
+        """
+            The groups that can qualify for an OCM, found from the attributes in its changes and state (whichever of
+            the state and the index of value triggers is smaller is walked).
+        """
+        groups = list(typed.untriggered)
+        for attr_uuid in changes:
+            groups.extend(typed.by_change.get(attr_uuid, ()))
+        by_value = typed.by_value
+        if len(state) <= len(by_value):
+            for attr_uuid, info in state.items():
+                triggered = by_value.get(attr_uuid)
+                if triggered and stateValue(info) is not None:
+                    groups.extend(triggered)
+        else:
+            for attr_uuid, triggered in by_value.items():
+                info = state.get(attr_uuid)
+                if info is not None and stateValue(info) is not None:
+                    groups.extend(triggered)
+        return groups
+
+    def decide(self, object_type, state, changes):
+        """
+            Decide which of the webhooks applicable to the object_type qualify for an OCM with the given state
+            and changes.  Returns a list of (webhook, qualified) pairs in the order of webhooksFor and a dict of
+            cond_id : status for the conditions that were looked at.  A condition id without a compiled condition
+            is treated as not true.  Only the groups the OCM's attributes can satisfy are decided, the webhooks of
+            the other groups don't qualify.
+        """
+        typed = self.typedRules(object_type)
+        if not typed.webhooks:
+            return [], {}
+        self.decided += 1
+        if self.decided >= RERANK_INTERVAL:
+            self.rank()
+
+        status   = {}
+        verdicts = {}   # group number : qualified, for the groups decided
+        for group in self.candidates(typed, state, changes):
+            if group not in verdicts:
+                verdicts[group] = decideGroup(self.group_conditions[group], state, changes, status)
+        return [(webhook, verdicts.get(group, False)) for webhook, group in typed.webhooks], status
+
+def getRuleIndex(key, loader):
+    """
+        Return the RuleIndex cached under key (which must change whenever the rule set does),
+        building it from the (webhooks, conditions) pair returned by loader() when it isn't cached.
+    """
+    index = rule_indexes.get(key)
+    if index is not None:
+        rule_indexes.move_to_end(key)
+        return index
+    webhooks, conditions = loader()
+    index = rule_indexes[key] = RuleIndex(webhooks, conditions)
+    while len(rule_indexes) > RULE_INDEX_CACHE_SIZE:
+        rule_indexes.popitem(last=False)
+    return index
+
+#############################################################################################################################
@@ -13,10 +13,14 @@ sys.stderr = save_stderr
 from app.utils.confenv import setVariables
 setVariables('environment/dev.env.yml')
 
+from app.helpers.pgdb import QUALIFIER_NOTIFY_FUNCTION, QUALIFIER_NOTIFY_TRIGGERS
+from app.helpers.partitions import columnDefinitions, createPartitionedTable
+
 TEMPLATE_DB_URL = "postgresql://{DB_USER}:{DB_PASSWORD}@/{DB_NAME}?host={CLOUD_SQL_DIR}/{GCP_PROJECT}:{GCP_ZONE}:{GCLOUD_SQL_INSTANCE}"
 
 SQL = {
         "create table" : "CREATE TABLE {table} ();",
+        "create log table" : "CREATE TABLE IF NOT EXISTS {table} ({columns});",
         "drop table"   : "DROP TABLE {table};",
         "add column"   : "ALTER TABLE {table} ADD COLUMN {column} {datatype} NOT NULL",
         "copy"         : "COPY {table} FROM STDIN NULL '' DELIMITER ',' CSV;",
@@ -25,14 +29,22 @@ SQL = {
 
 SCHEMA = 'configs/schemas.json'
 
+# tables the functions write to, created empty and left in place when they already exist
+LOG_TABLES = ['delivery_log', 'delivery_rollup']
+
 ################################################################################################################
 
 def main(args):
     table_name = args[0] or "webhook"
-    if table_name not in ['condition', 'webhook']:
+    if table_name not in ['condition', 'webhook'] + LOG_TABLES:
         sys.exit(0)
 
-    schema = [table for table in read_schema(SCHEMA) if table_name in table][0][table_name]
+    entry  = [table for table in read_schema(SCHEMA) if table_name in table][0]
+    schema = entry[table_name]
+    if table_name in LOG_TABLES:
+        createLogTable(table_name, schema, entry.get('partitioned'), entry.get('primary_key'))
+        return
+
     file_name = "data/csv/%s.csv" % table_name
     full_path = '%s/%s' % (os.getcwd(), file_name)
     print("filename: %s exists? %s" % (full_path, os.path.exists(full_path)))
@@ -51,6 +63,27 @@ def main(args):
             copy_command = SQL['copy'].format(table=table_name)
             cursor.copy_expert(copy_command, csvf)
             csvf.close()
+
+            # let the functions caching webhook/condition rows know when they change
+            cursor.execute(QUALIFIER_NOTIFY_FUNCTION)
+            cursor.execute(QUALIFIER_NOTIFY_TRIGGERS.format(table=table_name))
+        dbConn.commit()
+
+################################################################################################################
+
+def createLogTable(table_name, schema, partitioned=None, primary_key=None):
+    with dbConnection() as dbConn:
+        cursor = dbConn.cursor()
+        if partitioned:
+            created, dropped = createPartitionedTable(cursor, table_name, schema, partitioned)
+            print("created table: %s partitioned by %s on %s, partitions: %s" % (table_name, partitioned['interval'],
+                                                                                partitioned['key'], created))
+        else:
+            columns = columnDefinitions(schema)
+            if primary_key:
+                columns += ', PRIMARY KEY (%s)' % ', '.join(primary_key)
+            cursor.execute(SQL['create log table'].format(table=table_name, columns=columns))
+            print("created table: %s" % table_name)
         dbConn.commit()
 
 ################################################################################################################
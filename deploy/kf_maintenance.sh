@@ -0,0 +1,17 @@
+#!/usr/bin/env bash
+GCP_PROJECT="saas-rally-dev-integrations"
+FUNC_NAME=kf_maintenance
+ENTRY_POINT=kf_maintainPartitions
+ENV_VARS_FILE=environment/dev.env.yml
+RUNTIME=python37
+TRIGGER_TOPIC=kf-maintenance
+TRIGGER_EVENT=providers/cloud.pubsub/eventTypes/topic.publish
+
+COMMAND="gcloud functions deploy ${FUNC_NAME} --entry-point ${ENTRY_POINT} --runtime ${RUNTIME} --env-vars-file ${ENV_VARS_FILE} \
+         --trigger-resource ${TRIGGER_TOPIC} --trigger-event ${TRIGGER_EVENT}"
+
+echo $COMMAND
+eval $COMMAND
+
+# the schedule that triggers it
+#gcloud scheduler jobs create pubsub kf-maintenance --schedule "0 * * * *" --topic ${TRIGGER_TOPIC} --message-body "maintain"
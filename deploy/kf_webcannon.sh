@@ -0,0 +1,14 @@
+#!/usr/bin/env bash
+GCP_PROJECT="saas-rally-dev-integrations"
+FUNC_NAME=kf_webcannon
+ENTRY_POINT=kf_fireWebhook
+ENV_VARS_FILE=environment/dev.env.yml
+RUNTIME=python37
+TRIGGER_TOPIC=kf-webhook-ready
+TRIGGER_EVENT=providers/cloud.pubsub/eventTypes/topic.publish
+
+COMMAND="gcloud functions deploy ${FUNC_NAME} --entry-point ${ENTRY_POINT} --runtime ${RUNTIME} --env-vars-file ${ENV_VARS_FILE} \
+         --trigger-resource ${TRIGGER_TOPIC} --trigger-event ${TRIGGER_EVENT}"
+
+echo $COMMAND
+eval $COMMAND
@@ -0,0 +1,225 @@
+#
+# evalbench.py - micro-benchmarks of the evaluator's per OCM work:  getRelevantWebhooks, getRelevantConditions,
+#                evaluateItemAgainstConditions, isQualified and RuleIndex.decide, run against one subscription's
+#                rule set scaled up from data/csv (10, 100, 1000 and 10000 webhooks by default) and the recorded
+#                OCMs in ocm-messages-3.raw, plus a sample from an OCM corpus when one is given.
+#
+#                A scaled rule set is the webhooks of webhook.csv repeated with new ids until there are as many
+#                as wanted, each copy with its own copies of the conditions it refers to.  The OCMs are given
+#                every attribute the conditions look at (as None when they don't have it), as evaluateItemAgainst-
+#                Conditions and isQualified expect.
+#
+#                Each benchmark is repeated for at least -time seconds, -repeat times, the best ops/sec is kept.
+#                The results are written as JSON with -out, and with -baseline they are compared to an earlier
+#                run's results, exiting with status 1 when any benchmark's ops/sec is down by more than the
+#                -threshold fraction.
+#
+#########################################################################################
+USAGE = """
+Usage: evalbench.py [-scales <webhook counts>] [-corpus <corpus file>] [-time <seconds>] [-repeat <n>]
+                    [-out <results.json>] [-baseline <baseline.json>] [-threshold <fraction>]
+"""
+import sys, os
+import csv
+import json
+import time
+import platform
+from datetime import datetime
+
+from app.utils.confenv import read_config
+
+# the evaluator's settings come from the dev environment, with the log kept to warnings
+ENV_FILE = 'environment/dev.env.yml'
+os.environ.setdefault('KF_LOG_LEVEL', 'WARNING')
+for name, value in read_config(ENV_FILE).items():
+    os.environ.setdefault(name, str(value))
+
+from app.functions.kf_evaluator import getRelevantWebhooks, getRelevantConditions, evaluateItemAgainstConditions, isQualified
+from app.helpers.rules import RuleIndex
+
+from ocmcorpus import readOCMSource, OCMCorpus, OCM_SOURCE
+
+#########################################################################################
+
+WEBHOOK_CSV   = "data/csv/webhook.csv"
+CONDITION_CSV = "data/csv/condition.csv"
+
+SCALES        = [10, 100, 1000, 10000]
+BENCH_SUB_ID  = 100
+MIN_TIME      = 0.5      # seconds each repetition of a benchmark runs for at least
+REPEATS       = 3
+THRESHOLD     = 0.10     # a drop in ops/sec beyond this fraction of the baseline is a regression
+CORPUS_SAMPLE = 100      # OCMs taken from a corpus
+
+#########################################################################################
+
+def main(args):
+    if args and args[0] in ['-h', '-help']:
+        sys.stderr.write(USAGE)
+        sys.exit(1)
+    options   = dict(zip(args[::2], args[1::2]))
+    scales    = [int(scale) for scale in options['-scales'].split(',')] if '-scales' in options else SCALES
+    min_time  = float(options.get('-time', MIN_TIME))
+    repeats   = int(options.get('-repeat', REPEATS))
+    threshold = float(options.get('-threshold', THRESHOLD))
+
+    entities = recordedEntities(OCM_SOURCE)
+    if '-corpus' in options:
+        entities += corpusEntities(options['-corpus'])
+
+    results = {'timestamp' : datetime.utcnow().isoformat(), 'python' : platform.python_version(),
+               'ocms' : len(entities), 'benchmarks' : {}}
+    for scale in scales:
+        webhooks, conditions = scaledRuleSet(scale)
+        ocms = [withAttributes(entity, conditions) for entity in entities]
+        for name, bench in benchmarks(webhooks, conditions, ocms).items():
+            key = f'{name}[{scale}]'
+            ops, per_call = timeBenchmark(bench, min_time, repeats)
+            results['benchmarks'][key] = {'ops' : round(ops, 1), 'usec' : round(per_call * 1e6, 2)}
+            print(f"{key:>44}  {ops:>12.1f} ops/sec  {per_call * 1e6:>12.2f} usec")
+
+    if '-out' in options:
+        with open(options['-out'], 'w') as out:
+            json.dump(results, out, indent=2)
+    if '-baseline' in options:
+        with open(options['-baseline']) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compareResults(results, baseline, threshold)
+        for key, ops, baseline_ops, change in regressions:
+            print(f"REGRESSION {key}: {ops} ops/sec against {baseline_ops} in the baseline ({change:+.1%})")
+        if regressions:
+            sys.exit(1)
+        print(f"no benchmark more than {threshold:.0%} below the baseline {options['-baseline']}")
+
+#########################################################################################
+
+def readRuleRows(webhook_csv=WEBHOOK_CSV, condition_csv=CONDITION_CSV):
+    def pgArray(text):
+        return [item for item in text.strip('{}').split(',') if item]
+
+    with open(webhook_csv, newline='') as csvf:
+        webhooks = [[int(wh_id), int(sub_id), name, target_url, pgArray(object_types), [int(ix) for ix in pgArray(cond_ids)]]
+                    for wh_id, sub_id, name, target_url, object_types, cond_ids in csv.reader(csvf)]
+    with open(condition_csv, newline='') as csvf:
+        conditions = {int(row[0]) : [int(row[0]), int(row[1])] + row[2:] for row in csv.reader(csvf)}
+    return webhooks, conditions
+
+def scaledRuleSet(scale, sub_id=BENCH_SUB_ID):
+    """
+        Return (webhooks, conditions) for a subscription with scale webhooks, the rows of data/csv repeated
+        with new ids, each webhook with its own copies of its conditions.
+    """
+    csv_webhooks, csv_conditions = readRuleRows()
+    webhooks, conditions = [], []
+    for ix in range(scale):
+        wh_id, wh_sub_id, name, target_url, object_types, cond_ids = csv_webhooks[ix % len(csv_webhooks)]
+        copied = []
+        for cond_id in cond_ids:
+            if cond_id in csv_conditions:
+                condition = [len(conditions) + 1, sub_id] + csv_conditions[cond_id][2:]
+                conditions.append(condition)
+                copied.append(condition[0])
+        webhooks.append([ix + 1, sub_id, f'{name} #{ix + 1}', target_url, object_types, copied])
+    return webhooks, conditions
+
+def recordedEntities(source_file):
+    return [entity for item in readOCMSource(source_file) for entity in item['value']['entities'].values()]
+
+def corpusEntities(corpus_file, sample=CORPUS_SAMPLE):
+    corpus = OCMCorpus(corpus_file)
+    step = max(1, len(corpus) // sample)
+    return [entity for ix in range(0, len(corpus), step)[:sample]
+                   for entity in json.loads(corpus[ix])['value']['entities'].values()]
+
+def withAttributes(entity, conditions):
+    state = dict(entity['state'])
+    for condition in conditions:
+        if condition[2] not in state:
+            state[condition[2]] = {'value' : None, 'type' : 'String', 'name' : condition[3],
+                                   'display_name' : condition[3], 'ref' : None}
+    return dict(entity, state=state)
+
+#########################################################################################
+
+def benchmarks(webhooks, conditions, ocms):
+    """
+        Return a dict of name : function, each function doing a pass over the OCMs and returning the number
+        of calls it made of the function being measured.
+    """
+    relevant_webhooks   = [getRelevantWebhooks(webhooks, ocm['object_type']) for ocm in ocms]
+    relevant_conditions = [getRelevantConditions(relevant, conditions) for relevant in relevant_webhooks]
+    index = RuleIndex(webhooks, conditions)
+
+    def relevantWebhooks():
+        for ocm in ocms:
+            getRelevantWebhooks(webhooks, ocm['object_type'])
+        return len(ocms)
+
+    def relevantConditions():
+        for relevant in relevant_webhooks:
+            getRelevantConditions(relevant, conditions)
+        return len(ocms)
+
+    def evaluateConditions():
+        for ocm, relevant in zip(ocms, relevant_conditions):
+            evaluateItemAgainstConditions(ocm, relevant)
+        return len(ocms)
+
+    def qualified():
+        calls = 0
+        for ocm, relevant in zip(ocms, relevant_conditions):
+            for condition in relevant:
+                isQualified(ocm, condition)
+            calls += len(relevant)
+        return calls
+
+    def decide():
+        for ocm in ocms:
+            index.decide(ocm['object_type'], ocm['state'], ocm['changes'])
+        return len(ocms)
+
+    return {'getRelevantWebhooks'           : relevantWebhooks,
+            'getRelevantConditions'         : relevantConditions,
+            'evaluateItemAgainstConditions' : evaluateConditions,
+            'isQualified'                   : qualified,
+            'RuleIndex.decide'              : decide,
+           }
+
+def timeBenchmark(bench, min_time=MIN_TIME, repeats=REPEATS):
+    """
+        Return the best (calls per second, seconds per call) over the repetitions of bench.
+    """
+    best = None
+    for repetition in range(repeats):
+        calls = 0
+        started = time.perf_counter()
+        while True:
+            calls += bench()
+            elapsed = time.perf_counter() - started
+            if elapsed >= min_time:
+                break
+        ops = calls / elapsed if calls else 0.0
+        if best is None or ops > best:
+            best = ops
+    return best, (1 / best if best else 0.0)
+
+def compareResults(results, baseline, threshold=THRESHOLD):
+    """
+        Return a list of (benchmark, ops, baseline ops, change) for the benchmarks whose ops/sec is more than
+        threshold below the baseline.  Benchmarks missing from either run are not compared.
+    """
+    regressions = []
+    for key, result in results['benchmarks'].items():
+        baseline_result = baseline.get('benchmarks', {}).get(key)
+        if not baseline_result or not baseline_result['ops']:
+            continue
+        change = result['ops'] / baseline_result['ops'] - 1
+        if change < -threshold:
+            regressions.append((key, result['ops'], baseline_result['ops'], change))
+    return regressions
+
+#########################################################################################
+#########################################################################################
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -5,13 +5,14 @@ import json
 import time
 from random import randint
 from pprint import pprint
-import ast
 import requests
 
+from ocmcorpus import OCMCorpus
+
 ###################################################################################################
 
 GCP_PROJECT = "saas-rally-dev-integrations"
-OCM_DATA    = "data/ocm-messages.dat"
+OCM_DATA    = "data/ocm-messages.jsonl"   # made from data/ocm-messages-3.raw by ocmcorpus.py
 SUB_ID_MULT = 100
 
 KF_INGESTION_ENDPOINT = f"https://us-central1-{GCP_PROJECT}.cloudfunctions.net/kf_ingester"
@@ -32,27 +33,17 @@ def main(args):
     started  = time.time()
 
     #for ocm in ocms:
-    for ocm in ocms[:limit]:
+    for ix in range(min(limit, len(ocms))):
         if not args:
             pseudo_sub_id = randint(1, 100) * SUB_ID_MULT # 1 -> 100, 50 -> 5000, 95 -> 9500
         print(f'pseudo_sub_id: {pseudo_sub_id}')
-        #print(ocm)
-        #item = json.loads(ocm)
-        item_dict = ast.literal_eval(ocm)
-
-        first_item = list(item_dict['value']['entities'].keys())[0]
-        item_dict['value']['entities'][first_item]['subscription_id'] = pseudo_sub_id #
-
-        #print(list(item_dict['value']['entities'][first_item].keys()))
-        #{'username': 'dfdsfdsf'}
-
-        #pprint(item_dict['value']['entities'][first_key])
 
-        jsonable_string = json.dumps(item_dict)
-        #print(jsonable_string)
+        # the pre-encoded OCM with the subscription_id patched in, no literal_eval / json.dumps
+        body = bytes(ocms.patched(ix, subscription_id=pseudo_sub_id))
+        #print(body)
         headers = {'X-TransitionSpectrum' : "Blue4600a"}
-        result = requests.post(KF_INGESTION_ENDPOINT, data=json.dumps(item_dict), headers=headers)
-        #result = requests.post(KF_INBOUND_ENDPOINT, data=json.dumps(item_dict), headers=headers)
+        result = requests.post(KF_INGESTION_ENDPOINT, data=body, headers=headers)
+        #result = requests.post(KF_INBOUND_ENDPOINT, data=body, headers=headers)
         print(result)
         shipped += 1
         if shipped >= limit:
@@ -65,10 +56,7 @@ def main(args):
 ###################################################################################################
 
 def getOCMItems(source_file):
-    OCM_SEPARATOR = "-" * 80 + "\n"
-    with open(source_file, 'r') as ocmf:
-        ocm_blob = ocmf.read()
-    return ocm_blob.split(OCM_SEPARATOR)[:-1]
+    return OCMCorpus(source_file)
 
 ###################################################################################################
 ###################################################################################################
@@ -0,0 +1,96 @@
+#
+# firer.py - fire the webhooks of the READY messages on the kf-webhook-ready subscription in batches with
+#            fireBatch, FIRE_CONCURRENCY POSTs in flight at a time and the FIRED and RETRY messages of a
+#            batch published together, rather than one kf_webcannon invocation per message.  Runs as a long
+#            lived process (a GCE VM or a container) or, with -drain, until the subscription comes back empty.
+#
+#            It is an alternative to the kf_webcannon function, not a companion of it: each subscription on
+#            kf-webhook-ready gets every message, so with both in place every webhook would be fired twice.
+#            The messages of a batch are acknowledged once the batch has been fired, a batch that raises is
+#            left to be redelivered.
+#
+#########################################################################################
+USAGE = """
+Usage: firer.py [<ready_subscription_name>] [-batch <size>] [-limit <total>] [-drain]
+"""
+import sys, os
+import json
+import time
+
+from app.utils.confenv import setVariables
+setVariables('environment/dev.env.yml')
+
+from google.cloud import pubsub_v1
+
+from app.helpers.kflog          import getLogger
+from app.helpers.delivery       import FIRE_TIMEOUT
+from app.functions.kf_webcannon import fireBatch, FIRE_CONCURRENCY
+
+#########################################################################################
+
+BATCH_SIZE = 500
+IDLE_TIME  = 1       # seconds to wait after an empty pull before pulling again
+
+log = getLogger('firer')
+
+#########################################################################################
+
+def main(args):
+    if args and args[0] in ['-h', '-help', '--help']:
+        sys.stderr.write(USAGE)
+        sys.exit(1)
+    subscription_name = os.getenv('KF_WEBHOOK_READY_SUB')
+    if args and not args[0].startswith('-'):
+        subscription_name = args.pop(0)
+    drain = '-drain' in args
+    args = [arg for arg in args if arg != '-drain']
+    options    = dict(zip(args[::2], args[1::2]))
+    batch_size = int(options.get('-batch', BATCH_SIZE))
+    limit      = int(options.get('-limit', 0)) or None
+
+    started = time.time()
+    try:
+        fired = fireSubscription(subscription_name, batch_size, limit, drain)
+    except KeyboardInterrupt:
+        return
+    elapsed = round(time.time() - started, 1)
+    print(f"{fired} READY messages fired in {elapsed} seconds")
+
+#########################################################################################
+
+def fireSubscription(subscription_name, batch_size, limit=None, drain=False):
+    """
+        Pull READY messages from the subscription, firing each pull as a batch and acknowledging its messages
+        once the batch has been fired.  The lease on a batch is extended to cover the time firing it can take.
+        Stops when the subscription comes back empty in drain mode, otherwise waits for more.
+    """
+    subscriber = pubsub_v1.SubscriberClient()
+    subscription_path = subscriber.subscription_path(os.getenv('GCP_PROJECT'), subscription_name)
+    fired = 0
+    while not limit or fired < limit:
+        wanted = min(batch_size, limit - fired) if limit else batch_size
+        response = subscriber.pull(subscription_path, max_messages=wanted, return_immediately=drain)
+        if not response.received_messages:
+            if drain:
+                break
+            time.sleep(IDLE_TIME)
+            continue
+        ack_ids = [received.ack_id for received in response.received_messages]
+        subscriber.modify_ack_deadline(subscription_path, ack_ids, leaseSeconds(len(ack_ids)))
+        readies = [json.loads(received.message.data.decode('utf-8')) for received in response.received_messages]
+        tally = fireBatch(readies)
+        subscriber.acknowledge(subscription_path, ack_ids)
+        fired += len(readies)
+        log.info('%d READY messages fired from %s, last batch: %s', fired, subscription_name, tally)
+    return fired
+
+def leaseSeconds(count):
+    # every POST can take up to FIRE_TIMEOUT, FIRE_CONCURRENCY of them at a time, Pub/Sub allows up to 600
+    waves = -(-count // FIRE_CONCURRENCY)
+    return int(min(600, max(60, 2 * waves * FIRE_TIMEOUT)))
+
+#########################################################################################
+#########################################################################################
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -17,15 +17,15 @@ import sys
 import time
 from multiprocessing import Process, Queue
 from random import randint
-import ast
-import json
 import requests
 import urllib3
 
+from ocmcorpus import OCMCorpus
+
 #########################################################################################
 
 GCP_PROJECT = "saas-rally-dev-integrations"
-OCM_DATA    = "data/ocm-messages.dat"
+OCM_DATA    = "data/ocm-messages.jsonl"   # made from data/ocm-messages-3.raw by ocmcorpus.py
 SUB_ID_MULT = 100
 
 LETTERS = [char for char in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ']
@@ -67,8 +67,7 @@ def main(args):
         if worker_ident == worker_identifiers[0]:
             wi += 1  # increment the work item index each time we begin the cycle in the worker_identifiers
         task_tag = f'{worker_ident}-{wi}'
-        item_dict = shaveAndShine(raw_ocm)
-        package = (task_tag, EXAMPLE_HEADERS, json.dumps(item_dict))
+        package = (task_tag, EXAMPLE_HEADERS, shaveAndShine(ocm_gen.corpus, raw_ocm))
         task_queue.put(package)
         work_items_produced += 1
         if work_items_produced >= total_items:
@@ -132,25 +131,27 @@ def obtainAndCheckArguments(args):
 
 ##################################################################################################
 
-def OCMItemGen(source_file):
-    OCM_SEPARATOR = "-" * 80 + "\n"
-    with open(source_file, 'r') as ocmf:
-        ocm_blob = ocmf.read()
-    items = ocm_blob.split(OCM_SEPARATOR)[:-1]
-    while True:
-        for item in items:
-            yield item
+class OCMItemGen:
+    """
+        Endless iteration over the indexes of the OCMs in the memory mapped corpus
+    """
+    def __init__(self, corpus_file):
+        self.corpus = OCMCorpus(corpus_file)
 
-#########################################################################################
+    def __iter__(self):
+        while True:
+            for ix in range(len(self.corpus)):
+                yield ix
 
-def shaveAndShine(bloated_ocm):
-    item_dict = ast.literal_eval(bloated_ocm)
-    first_item = list(item_dict['value']['entities'].keys())[0]
+#########################################################################################
 
+def shaveAndShine(corpus, ix):
+    # the encoded OCM with its subscription_id patched in place, no parsing per message,
+    # a synthocm.py corpus has no subscription_id slots and its OCMs go as written
+    if not corpus.subscriptionSlots(ix):
+        return bytes(corpus[ix])
     pseudo_sub_id = randint(1, 100) * SUB_ID_MULT  # 1 -> 100, 50 -> 5000, 95 -> 9500
-    item_dict['value']['entities'][first_item]['subscription_id'] = pseudo_sub_id  #
-
-    return item_dict
+    return bytes(corpus.patched(ix, subscription_id=pseudo_sub_id))
 
 #########################################################################################
 
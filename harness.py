@@ -0,0 +1,329 @@
+#
+# harness.py - run the ingest -> evaluate -> READY/NOGO pipeline in one process with no network:  kf_ingest
+#              and kf_evaluateOCM are wired together through an in-process topic bus standing in for Pub/Sub,
+#              the qualifiers come from SQLite tables loaded from data/csv (or the configured Postgres with
+#              -db postgres) and the delivery log / rollup writes are only counted.
+#
+#              An OCM corpus (ocmcorpus.py / synthocm.py) is pushed through open loop at the given rate, each
+#              OCM with a message_id of its own, to a number of ingest workers, the crates published to the
+#              evaluate topic are taken by a number of evaluate workers (each worker standing in for a
+#              function instance), and the READY / NOGO topics are drained as they are published to.
+#
+#              Reports the throughput of each stage, the depth of the arrival queue and the evaluate topic
+#              sampled over time, and the latency from the intended send of an OCM to the end of its
+#              ingestion and to the end of its evaluation.  With -out all of it is written as JSON.
+#
+#              The functions can instead be pointed at the Pub/Sub emulator by setting PUBSUB_EMULATOR_HOST
+#              and running them as usual, the bus here just avoids needing one.
+#
+#########################################################################################
+USAGE = """
+Usage: harness.py <corpus_file> [-count <messages>] [-rate <per second>] [-ingesters <n>] [-evaluators <n>]
+                  [-db <sqlite|postgres>] [-sample <seconds>] [-drain <seconds>] [-out <results.json>]
+"""
+import sys, os
+import re
+import csv
+import json
+import time
+import base64
+import sqlite3
+import threading
+from queue import Queue, Empty
+from collections import Counter
+from concurrent.futures import Future
+
+from app.utils.confenv import read_config
+
+# the topic names and settings the functions read at import come from the dev environment, the log is
+# kept to warnings so that it doesn't swamp the measurements
+ENV_FILE = 'environment/dev.env.yml'
+os.environ.setdefault('KF_LOG_LEVEL', 'WARNING')
+for name, value in read_config(ENV_FILE).items():
+    os.environ.setdefault(name, str(value))
+
+from app.helpers         import pubsub, pgdb
+from app.helpers.deliverylog import delivery_log
+from app.helpers.rollups import rollups
+from app.functions.kf_ingester  import kf_ingest
+from app.functions.kf_evaluator import kf_evaluateOCM
+
+from ocmcorpus import OCMCorpus
+from loadgen   import percentiles
+
+#########################################################################################
+
+WEBHOOK_CSV   = "data/csv/webhook.csv"
+CONDITION_CSV = "data/csv/condition.csv"
+
+SAMPLE_TIME = 1.0    # seconds between queue depth samples
+DRAIN_TIME  = 60     # seconds allowed after the last send for the queues to empty
+
+MESSAGE_ID = re.compile(rb'"message_id": "([^"]+)"')
+
+#########################################################################################
+
+def main(args):
+    if not args or args[0] in ['-h', '-help']:
+        sys.stderr.write(USAGE)
+        sys.exit(1)
+    corpus_file = args.pop(0)
+    options = dict(zip(args[::2], args[1::2]))
+    corpus     = OCMCorpus(corpus_file)
+    count      = int(options.get('-count', len(corpus)))
+    rate       = float(options.get('-rate', 100))
+    ingesters  = int(options.get('-ingesters', 4))
+    evaluators = int(options.get('-evaluators', 4))
+
+    bus = InProcessBus(sinks=[os.getenv('KF_WEBHOOK_READY'), os.getenv('KF_WEBHOOK_NOGO')])
+    pubsub.setTransport(bus)
+    if options.get('-db', 'sqlite') == 'sqlite':
+        pgdb.setQualifierSource(SQLiteQualifiers())
+    else:
+        # every worker can be in a lookup at once, the pool is made on first use so this is in time
+        pgdb.DB_POOL_MAX = max(pgdb.DB_POOL_MAX, ingesters + evaluators)
+    delivery_log.copier = lambda table, columns, csv_file: None
+    rollups.writer      = lambda statement, rows: None
+
+    harness = PipelineHarness(bus, corpus, ingesters=ingesters, evaluators=evaluators,
+                              sample_time=float(options.get('-sample', SAMPLE_TIME)))
+    results = harness.run(count, rate, drain_time=float(options.get('-drain', DRAIN_TIME)))
+
+    print(f"{count} OCMs at {rate}/s through {ingesters} ingesters and {evaluators} evaluators in {results['elapsed']} seconds")
+    for stage, stats in results['stages'].items():
+        print(f"  {stage:>10}  {stats['count']:>8}  {stats['throughput']:>8}/s")
+    print(f"  max depth  arrivals: {results['max_depth']['arrivals']}  evaluate: {results['max_depth']['evaluate']}")
+    for kind in ['ingested', 'evaluated']:
+        print(f"  {kind:>9} latency ms  " + '  '.join(f"p{p}: {v}" for p, v in results['latency'][kind].items()))
+    if results['unfinished']:
+        print(f"  {results['unfinished']} OCMs not evaluated within the drain time")
+    if '-out' in options:
+        with open(options['-out'], 'w') as out:
+            json.dump(dict(results, corpus=corpus_file, rate=rate, ingesters=ingesters, evaluators=evaluators), out, indent=2)
+
+#########################################################################################
+
+class InProcessBus:
+    """
+        Topics as in-process queues, in place of Pub/Sub for pubsub.setTransport().  A publish returns
+        a Future that is already resolved with a message id.  Messages to the sink topics are counted
+        and dropped rather than queued, as nothing in the harness consumes them.
+    """
+    def __init__(self, sinks=()):
+        self.topics    = {}
+        self.sinks     = set(sinks)
+        self.published = Counter()
+        self.lock      = threading.Lock()
+
+    def topic(self, topic_name):
+        with self.lock:
+            if topic_name not in self.topics:
+                self.topics[topic_name] = Queue()
+            return self.topics[topic_name]
+
+    def publish(self, topic_name, message_data):
+        with self.lock:
+            self.published[topic_name] += 1
+            message_id = str(self.published[topic_name])
+        if topic_name not in self.sinks:
+            self.topic(topic_name).put(message_data)
+        future = Future()
+        future.set_result(message_id)
+        return future
+
+    def pull(self, topic_name, timeout):
+        try:
+            return self.topic(topic_name).get(timeout=timeout)
+        except Empty:
+            return None
+
+    def depth(self, topic_name):
+        return self.topic(topic_name).qsize()
+
+#########################################################################################
+
+class SQLiteQualifiers:
+    """
+        The webhook and condition tables loaded from data/csv into an in-memory SQLite DB, called with
+        (sub_id, object_type) it returns the same (webhooks, conditions) as the Postgres qualifiers query.
+    """
+    def __init__(self, webhook_csv=WEBHOOK_CSV, condition_csv=CONDITION_CSV):
+        self.db = sqlite3.connect(':memory:', check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute("CREATE TABLE webhook (id INTEGER PRIMARY KEY, sub_id INTEGER, name TEXT, target_url TEXT, "
+                        "object_types TEXT, conditions TEXT)")
+        self.db.execute("CREATE TABLE condition (id INTEGER PRIMARY KEY, sub_id INTEGER, attribute_uuid TEXT, "
+                        "attribute_name TEXT, operator TEXT, value TEXT)")
+        self.db.execute("CREATE INDEX webhook_sub_id ON webhook (sub_id)")
+        with open(webhook_csv, newline='') as csvf:
+            # the Postgres array columns are kept as JSON arrays
+            self.db.executemany("INSERT INTO webhook VALUES (?, ?, ?, ?, ?, ?)",
+                                [(int(wh_id), int(sub_id), name, target_url, json.dumps(pgArray(object_types)),
+                                  json.dumps([int(ix) for ix in pgArray(cond_ids)]))
+                                 for wh_id, sub_id, name, target_url, object_types, cond_ids in csv.reader(csvf)])
+        with open(condition_csv, newline='') as csvf:
+            self.db.executemany("INSERT INTO condition VALUES (?, ?, ?, ?, ?, ?)",
+                                [(int(row[0]), int(row[1])) + tuple(row[2:]) for row in csv.reader(csvf)])
+
+    def __call__(self, sub_id, object_type=None):
+        with self.lock:
+            rows = self.db.execute("SELECT id, sub_id, name, target_url, object_types, conditions FROM webhook "
+                                   "WHERE sub_id = ? ORDER BY id", (sub_id,)).fetchall()
+            webhooks = [[wh_id, wh_sub_id, name, target_url, json.loads(object_types), json.loads(cond_ids)]
+                        for wh_id, wh_sub_id, name, target_url, object_types, cond_ids in rows]
+            webhooks = [webhook for webhook in webhooks
+                        if object_type is None or object_type in webhook[4] or not webhook[4]]
+            cond_ids = sorted(set(cond_id for webhook in webhooks for cond_id in webhook[5]))
+            conditions = []
+            if cond_ids:
+                rows = self.db.execute("SELECT id, sub_id, attribute_uuid, attribute_name, operator, value FROM condition "
+                                       f"WHERE sub_id = ? AND id IN ({','.join('?' * len(cond_ids))}) ORDER BY id",
+                                       [sub_id] + cond_ids).fetchall()
+                conditions = [list(row) for row in rows]
+        return webhooks, conditions
+
+def pgArray(text):
+    return [item for item in text.strip('{}').split(',') if item]
+
+#########################################################################################
+
+class Request:
+    # as much of a flask request as kf_ingest uses
+    def __init__(self, data, headers=None):
+        self.data    = data
+        self.headers = headers or {}
+
+class PipelineHarness:
+    """
+        The producer, the ingest and evaluate workers and the sampler as threads around an InProcessBus.
+    """
+    def __init__(self, bus, corpus, ingesters=4, evaluators=4, sample_time=SAMPLE_TIME):
+        self.bus         = bus
+        self.corpus      = corpus
+        self.ingesters   = ingesters
+        self.evaluators  = evaluators
+        self.sample_time = sample_time
+        self.evaluate_topic = os.getenv('KF_OCM_EVALUATE')
+        self.arrivals    = Queue()
+        self.intended    = {}          # message_id : intended send time
+        self.ingested    = {}          # message_id : time its ingestion finished
+        self.evaluated   = {}          # message_id : time its evaluation finished
+        self.errors      = Counter()
+        self.samples     = []
+        self.stopping    = threading.Event()
+        self.lock        = threading.Lock()
+
+    def run(self, count, rate, drain_time=DRAIN_TIME):
+        run_id = f'H{int(time.time())}'
+        self.start_at = time.time() + 0.5
+        workers = [threading.Thread(target=self.ingestWorker, daemon=True) for ix in range(self.ingesters)]
+        workers += [threading.Thread(target=self.evaluateWorker, daemon=True) for ix in range(self.evaluators)]
+        sampler = threading.Thread(target=self.sampler, daemon=True)
+        for worker in workers + [sampler]:
+            worker.start()
+
+        for sequence in range(count):
+            intended = self.start_at + sequence / rate
+            delay = intended - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            message_id = f'{run_id}-{sequence:08d}'
+            with self.lock:
+                self.intended[message_id] = intended
+            self.arrivals.put(bytes(self.corpus.patched(sequence, message_id=message_id)))
+        sent_at = time.time()
+
+        # evaluations and ingestions that fail are counted as done so the drain doesn't wait on them
+        while time.time() - sent_at < drain_time:
+            with self.lock:
+                done = len(self.evaluated) + self.errors['evaluate'] + self.errors['ingest']
+            if done >= count and self.arrivals.empty() and self.bus.depth(self.evaluate_topic) == 0:
+                break
+            time.sleep(0.05)
+        self.stopping.set()
+        for worker in workers + [sampler]:
+            worker.join()
+        return self.results(count)
+
+    def ingestWorker(self):
+        while not self.stopping.is_set():
+            try:
+                body = self.arrivals.get(timeout=0.1)
+            except Empty:
+                continue
+            try:
+                kf_ingest(Request(body))
+                done = time.time()
+                with self.lock:
+                    self.ingested[messageId(body)] = done
+            except Exception as exception:
+                with self.lock:
+                    self.errors['ingest'] += 1
+                sys.stderr.write(f"ingest failed, {exception}\n")
+
+    def evaluateWorker(self):
+        while not self.stopping.is_set():
+            crate = self.bus.pull(self.evaluate_topic, timeout=0.1)
+            if crate is None:
+                continue
+            try:
+                kf_evaluateOCM({'data' : base64.b64encode(crate)}, None)
+                done = time.time()
+                with self.lock:
+                    self.evaluated[messageId(crate)] = done
+            except Exception as exception:
+                with self.lock:
+                    self.errors['evaluate'] += 1
+                sys.stderr.write(f"evaluate failed, {exception}\n")
+
+    def sampler(self):
+        while not self.stopping.wait(self.sample_time):
+            with self.lock:
+                ingested, evaluated = len(self.ingested), len(self.evaluated)
+            self.samples.append({'second'    : round(time.time() - self.start_at, 1),
+                                 'arrivals'  : self.arrivals.qsize(),
+                                 'evaluate'  : self.bus.depth(self.evaluate_topic),
+                                 'ingested'  : ingested,
+                                 'evaluated' : evaluated,
+                                 'ready'     : self.bus.published[os.getenv('KF_WEBHOOK_READY')],
+                                 'nogo'      : self.bus.published[os.getenv('KF_WEBHOOK_NOGO')]})
+
+    #########################################################################################
+
+    def results(self, count):
+        elapsed = time.time() - self.start_at
+        latency = {}
+        for kind, finished in [('ingested', self.ingested), ('evaluated', self.evaluated)]:
+            histogram = Counter(int((done - self.intended[message_id]) * 1000)
+                                for message_id, done in finished.items() if message_id in self.intended)
+            latency[kind] = percentiles(histogram)
+
+        def stage(finished_times, total):
+            # throughput over the span from the first send to the last completion of the stage
+            span = (max(finished_times) - self.start_at) if finished_times else 0
+            return {'count' : total, 'throughput' : round(total / span, 1) if span > 0 else 0}
+
+        ready_topic, nogo_topic = os.getenv('KF_WEBHOOK_READY'), os.getenv('KF_WEBHOOK_NOGO')
+        last_evaluated = list(self.evaluated.values())
+        return {'elapsed'    : round(elapsed, 1),
+                'stages'     : {'ingest'   : stage(list(self.ingested.values()), len(self.ingested)),
+                                'evaluate' : stage(last_evaluated, len(self.evaluated)),
+                                'ready'    : stage(last_evaluated, self.bus.published[ready_topic]),
+                                'nogo'     : stage(last_evaluated, self.bus.published[nogo_topic])},
+                'errors'     : dict(self.errors),
+                'unfinished' : count - len(self.evaluated) - sum(self.errors.values()),
+                'max_depth'  : {'arrivals' : max([sample['arrivals'] for sample in self.samples] or [0]),
+                                'evaluate' : max([sample['evaluate'] for sample in self.samples] or [0])},
+                'latency'    : latency,
+                'samples'    : self.samples}
+
+def messageId(body):
+    # the message_id is early in both an OCM body and a crate, no need to decode all of it
+    found = MESSAGE_ID.search(body, 0, 4096) or MESSAGE_ID.search(body)
+    return found.group(1).decode('utf-8').strip() if found else None
+
+#########################################################################################
+#########################################################################################
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,47 @@
+#
+# kfstats.py - show the webhook volume for the monitoring windows (1, 5, 10, 30 minutes, 1, 4, 8 hours,
+#              today and yesterday) from the per minute rollups, for all subscriptions or for one, and
+#              the top 10 subscriptions by volume, successes and failures
+#
+#########################################################################################
+USAGE = """
+Usage: kfstats.py [-sub <sub_id>] [-window <window>] [-types]
+"""
+import sys, os
+
+from app.utils.confenv import setVariables
+setVariables('environment/dev.env.yml')
+
+from app.helpers.rollups import WINDOW_NAMES, windowTotals, windowTotalsByType, topSubscriptions
+
+#########################################################################################
+
+def main(args):
+    if '-h' in args or '-help' in args:
+        sys.stderr.write(USAGE)
+        sys.exit(1)
+    by_type = '-types' in args
+    args = [arg for arg in args if arg != '-types']
+    options = dict(zip(args[::2], args[1::2]))
+    sub_id  = int(options['-sub']) if '-sub' in options else None
+    windows = [options['-window']] if '-window' in options else WINDOW_NAMES
+
+    print(f"{'window':>10}  {'total':>8}  {'success':>8}  {'failure':>8}  {'retried':>8}")
+    for window in windows:
+        totals = windowTotals(window, sub_id=sub_id)
+        print(f"{window:>10}  {totals['total']:>8}  {totals['successes']:>8}  {totals['failures']:>8}  {totals['retried']:>8}")
+        if by_type:
+            for object_type, type_totals in sorted(windowTotalsByType(window, sub_id=sub_id).items()):
+                print(f"{object_type:>20}  {type_totals['total']:>8}  {type_totals['successes']:>8}  {type_totals['failures']:>8}")
+
+    if sub_id is None:
+        window = windows[-1] if '-window' in options else 'today'
+        for measure in ['volume', 'successes', 'failures']:
+            top = ', '.join(f'{sub}: {count}' for sub, count in topSubscriptions(window, measure=measure))
+            print(f"top 10 by {measure} {window}: {top}")
+
+#########################################################################################
+#########################################################################################
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
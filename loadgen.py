@@ -0,0 +1,215 @@
+#
+# loadgen.py - drive an HTTP function with OCMs at a constant arrival rate, open loop: every message has
+#              an intended send time fixed up front (rate / producers apart, the producers interleaved)
+#              and is sent then whether or not earlier ones have been answered.  Latency is measured from
+#              the intended send time, so a stalled endpoint shows up as the wait it causes for the messages
+#              behind it rather than as fewer, faster samples (coordinated omission), the service time from
+#              the actual send is kept too.
+#
+#              Each producer is a process with a keep-alive requests.Session and enough threads for the
+#              requests in flight.  Every message gets a unique (producer id, sequence) tag, as the
+#              X-KF-Producer / X-KF-Sequence headers and in the OCM transaction with the message_id built from it.
+#              The OCMs come from the memory mapped corpus made by ocmcorpus.py, those fields and the
+#              subscription_ids are patched into the pre-encoded bytes so producing a message costs no parsing.
+#              The subscription_ids of a synthocm.py corpus (which has no slots for them) are sent as written.
+#
+#              Reports p50/p90/p99/p99.9/max latency and, with -out, writes the histograms and the per
+#              second sent / ok / error series as JSON.
+#
+#########################################################################################
+USAGE = """
+Usage: loadgen.py <total_messages> <rate_per_second> [-producers <1|2|4|10>] [-endpoint <ingest|inbound|url>]
+                  [-concurrency <requests in flight per producer>] [-timeout <seconds>] [-out <results.json>]
+                  [-data <ocm_corpus_file>]
+"""
+import sys, os
+import time
+import json
+import uuid
+from random import randint
+from collections import Counter
+from multiprocessing import Process, Queue
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ocmcorpus import OCMCorpus
+
+#########################################################################################
+
+GCP_PROJECT = "saas-rally-dev-integrations"
+OCM_DATA    = "data/ocm-messages.jsonl"   # made from data/ocm-messages-3.raw by ocmcorpus.py
+SUB_ID_MULT = 100
+
+ENDPOINTS = {'ingest'  : f"https://us-central1-{GCP_PROJECT}.cloudfunctions.net/kf_ingester",
+             'inbound' : f"https://us-central1-{GCP_PROJECT}.cloudfunctions.net/kf_inbound",
+            }
+
+EXAMPLE_HEADERS = {'X-TransitionSpectrum' : "Blue4600a", 'Content-Type' : 'application/json'}
+
+PERCENTILES = [50, 90, 99, 99.9]
+START_DELAY = 2.0   # seconds for the producer processes to get going before the first intended send
+
+#########################################################################################
+
+def main(args):
+    if len(args) < 2:
+        sys.stderr.write(USAGE)
+        sys.exit(1)
+    total_messages = int(args.pop(0))
+    rate           = float(args.pop(0))
+    options = dict(zip(args[::2], args[1::2]))
+    producers   = int(options.get('-producers', 1))
+    endpoint    = ENDPOINTS.get(options.get('-endpoint', 'ingest'), options.get('-endpoint'))
+    concurrency = int(options.get('-concurrency', 50))
+    timeout     = float(options.get('-timeout', 30))
+    ocm_data    = options.get('-data', OCM_DATA)
+
+    run_id   = uuid.uuid4().hex[:8]
+    start_at = time.time() + START_DELAY
+    results  = Queue()
+    workers  = []
+    for index in range(producers):
+        count = total_messages // producers + (1 if index < total_messages % producers else 0)
+        worker = Process(target=producerProcess,
+                         args=(run_id, index, producers, count, rate, endpoint, start_at, concurrency, timeout, ocm_data, results))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    stats = LoadStats()
+    for worker in workers:
+        stats.merge(results.get())
+    for worker in workers:
+        worker.join()
+
+    elapsed = time.time() - start_at
+    report = stats.report(elapsed)
+    print(f"run {run_id}: {stats.sent} sent by {producers} producers at {rate}/s target to {endpoint}")
+    print(f"  achieved {report['throughput']}/s over {round(elapsed, 1)} seconds, {stats.errors} errors, "
+          f"{stats.late} sent more than 100 ms late")
+    for kind in ['corrected', 'service']:
+        print(f"  {kind:>9} latency ms  " + '  '.join(f"p{p}: {v}" for p, v in report[kind].items()))
+    if '-out' in options:
+        with open(options['-out'], 'w') as out:
+            json.dump(dict(report, run_id=run_id, producers=producers, target_rate=rate, endpoint=endpoint,
+                           histograms=stats.histograms(), series=stats.seriesList()), out, indent=2)
+
+#########################################################################################
+
+class LoadStats:
+    """
+        Latency histograms (counts per millisecond) and per second counts of sent / ok / error,
+        the seconds being offsets from the start of the run.
+    """
+    def __init__(self):
+        self.corrected = Counter()
+        self.service   = Counter()
+        self.series    = {}
+        self.sent = self.errors = self.late = 0
+        self.lock = Lock()
+
+    def record(self, second, corrected_ms, service_ms, ok, late):
+        with self.lock:
+            self.corrected[corrected_ms] += 1
+            self.service[service_ms]     += 1
+            counts = self.series.setdefault(second, [0, 0, 0])
+            counts[0] += 1
+            counts[1 if ok else 2] += 1
+            self.sent   += 1
+            self.errors += 0 if ok else 1
+            self.late   += 1 if late else 0
+
+    def export(self):
+        return {'corrected' : dict(self.corrected), 'service' : dict(self.service), 'series' : self.series,
+                'sent' : self.sent, 'errors' : self.errors, 'late' : self.late}
+
+    def merge(self, exported):
+        self.corrected.update(exported['corrected'])
+        self.service.update(exported['service'])
+        for second, counts in exported['series'].items():
+            merged = self.series.setdefault(second, [0, 0, 0])
+            for ix in range(3):
+                merged[ix] += counts[ix]
+        self.sent   += exported['sent']
+        self.errors += exported['errors']
+        self.late   += exported['late']
+
+    def report(self, elapsed):
+        return {'throughput' : round(self.sent / elapsed, 1) if elapsed > 0 else 0,
+                'sent' : self.sent, 'errors' : self.errors, 'late' : self.late,
+                'corrected' : percentiles(self.corrected), 'service' : percentiles(self.service)}
+
+    def histograms(self):
+        return {'corrected' : sorted(self.corrected.items()), 'service' : sorted(self.service.items())}
+
+    def seriesList(self):
+        return [{'second' : second, 'sent' : sent, 'ok' : ok, 'errors' : errors}
+                for second, (sent, ok, errors) in sorted(self.series.items())]
+
+def percentiles(histogram):
+    total = sum(histogram.values())
+    values = {}
+    if not total:
+        return values
+    ordered = sorted(histogram.items())
+    for p in PERCENTILES:
+        wanted = total * p / 100
+        seen = 0
+        for millis, count in ordered:
+            seen += count
+            if seen >= wanted:
+                values[p] = millis
+                break
+    values['max'] = ordered[-1][0]
+    return values
+
+#########################################################################################
+
+def producerProcess(run_id, index, producers, count, rate, endpoint, start_at, concurrency, timeout, ocm_data, results):
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=concurrency))
+    session.mount('http://',  HTTPAdapter(pool_connections=1, pool_maxsize=concurrency))
+    session.headers.update(EXAMPLE_HEADERS)
+    ocms = OCMCorpus(ocm_data)
+    producer_id = f'{run_id}-P{index}'
+    stats = LoadStats()
+
+    def send(sequence, intended, body):
+        sent_at = time.time()
+        try:
+            response = session.post(endpoint, data=body, timeout=timeout,
+                                    headers={'X-KF-Producer' : producer_id, 'X-KF-Sequence' : str(sequence)})
+            ok = 200 <= response.status_code < 300
+        except requests.RequestException:
+            ok = False
+        done = time.time()
+        stats.record(int(intended - start_at), int((done - intended) * 1000), int((done - sent_at) * 1000), ok,
+                     sent_at - intended > 0.1)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for sequence in range(count):
+            # the producers' messages interleave so the combined arrivals are 1/rate apart
+            intended = start_at + (sequence * producers + index) / rate
+            delay = intended - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            body = taggedOCM(ocms, sequence % len(ocms), producer_id, sequence)
+            pool.submit(send, sequence, intended, body)
+
+    results.put(stats.export())
+
+def taggedOCM(ocms, ix, producer_id, sequence):
+    tags = {'producer_id' : producer_id, 'sequence' : sequence, 'message_id' : f'{producer_id}-{sequence:08d}'}
+    entities = ocms.subscriptionSlots(ix)
+    if entities:
+        tags['subscription_id'] = [randint(1, 100) * SUB_ID_MULT for entity in range(entities)]  # 1 -> 100, 95 -> 9500
+    return bytes(ocms.patched(ix, **tags))
+
+#########################################################################################
+#########################################################################################
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
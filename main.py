@@ -1,4 +1,4 @@
 
-from app.functions import kf_ingest, kf_evaluateOCM
+from app.functions import kf_ingest, kf_evaluateOCM, kf_fireWebhook, kf_maintainPartitions
 from app.functions import kf_inbound
 from app.functions import kf_doorman
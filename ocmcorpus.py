@@ -0,0 +1,196 @@
+#
+# ocmcorpus.py - a pre-encoded OCM corpus for the load drivers.  The corpus is a JSON lines file, one OCM
+#                per line already encoded as the request body, with an index alongside (<corpus>.idx) of
+#                each line's byte offset and length and the offsets of its patchable slots (lines encoded
+#                from the same OCM share one entry in the index's list of slot offsets).
+#
+#                A slot is a value written space padded to a fixed width (JSON allows whitespace after a
+#                value) so it can be overwritten in place, the subscription_id of every entity and the
+#                transaction's message_id, producer_id and sequence.  The drivers memory map the corpus and
+#                send a copy of the line with its slots patched, no literal_eval / json.dumps per message.
+#                A corpus whose sub_ids matter (synthocm.py) is written without subscription_id slots.
+#
+#                Run as a script it converts a .raw / .dat file (python repr OCMs with a dashed separator)
+#                into a corpus, optionally repeating the OCMs up to a count like puffdata.py.
+#
+#########################################################################################
+USAGE = """
+Usage: ocmcorpus.py <source .raw|.dat file> [<corpus file>] [-repeat <count>]
+"""
+import sys, os
+import re
+import ast
+import json
+import mmap
+
+#########################################################################################
+
+OCM_SOURCE  = "data/ocm-messages-3.raw"
+OCM_CORPUS  = "data/ocm-messages.jsonl"
+
+OCM_SEPARATOR = "-" * 80 + "\n"
+
+# widths of the slots in bytes, including the quotes of a string value
+SLOT_WIDTHS = {'subscription_id' : 12,
+               'message_id'      : 48,
+               'producer_id'     : 32,
+               'sequence'        : 12,
+              }
+TRANSACTION_SLOTS = ['message_id', 'producer_id', 'sequence']
+
+SLOT_MARKER = re.compile(r'"@@slot:(\w+)@@"')
+
+#########################################################################################
+
+def main(args):
+    if not args or args[0] in ['-h', '-help']:
+        sys.stderr.write(USAGE)
+        sys.exit(1)
+    source_file = args.pop(0)
+    corpus_file = args.pop(0) if args and not args[0].startswith('-') else OCM_CORPUS
+    options = dict(zip(args[::2], args[1::2]))
+    repeat = int(options['-repeat']) if '-repeat' in options else None
+
+    items = readOCMSource(source_file)
+    written = writeCorpus(items, corpus_file, repeat)
+    print(f"{written} OCMs from {len(items)} in {source_file} written to {corpus_file} and {indexFile(corpus_file)}")
+
+#########################################################################################
+
+def readOCMSource(source_file):
+    """
+        Return the list of OCM dicts in a .raw or .dat file of python repr OCMs each followed by the dashed separator.
+    """
+    with open(source_file, 'r') as ocmf:
+        ocm_blob = ocmf.read()
+    return [ast.literal_eval(item) for item in ocm_blob.split(OCM_SEPARATOR) if item.strip()]
+
+def indexFile(corpus_file):
+    return corpus_file + '.idx'
+
+def encodeOCM(item_dict):
+    """
+        Return the OCM as a line of JSON bytes and a dict of slot name : [offsets of the slots in the line].
+        The slot values are written in place of markers, padded to the slot width.
+    """
+    value = dict(item_dict['value'])
+    originals = {'subscription_id' : [], 'message_id' : [], 'producer_id' : [], 'sequence' : []}
+    entities = {}
+    for entity_id, entity in value['entities'].items():
+        originals['subscription_id'].append(entity.get('subscription_id'))
+        entities[entity_id] = dict(entity, subscription_id='@@slot:subscription_id@@')
+    transaction = dict(value.get('transaction', {}))
+    for slot in TRANSACTION_SLOTS:
+        originals[slot].append(transaction.get(slot))
+        transaction[slot] = f'@@slot:{slot}@@'
+    value.update(entities=entities, transaction=transaction)
+    marked = json.dumps(dict(item_dict, value=value))
+
+    line = []
+    slots = {slot : [] for slot in originals}
+    position = 0   # byte offset in the line of the end of the last piece
+    last = 0
+    for match in SLOT_MARKER.finditer(marked):
+        slot = match.group(1)
+        before = marked[last:match.start()].encode('utf-8')
+        line.append(before)
+        position += len(before)
+        slots[slot].append(position)
+        filled = slotBytes(slot, originals[slot][len(slots[slot]) - 1])
+        line.append(filled)
+        position += len(filled)
+        last = match.end()
+    line.append(marked[last:].encode('utf-8'))
+    return b''.join(line), slots
+
+def slotBytes(slot, value):
+    encoded = json.dumps(value).encode('utf-8')
+    width = SLOT_WIDTHS[slot]
+    if len(encoded) > width:
+        raise ValueError(f"{slot} value {encoded} is wider than the {width} byte slot")
+    return encoded.ljust(width)
+
+def writeCorpus(items, corpus_file, repeat=None):
+    """
+        Write the OCMs (repeated up to repeat lines when given) to the corpus and its index,
+        returns the number of lines written.
+    """
+    encoded = [encodeOCM(item_dict) for item_dict in items]
+    count = repeat or len(encoded)
+    lines = ((encoded[ix % len(encoded)][0], ix % len(encoded)) for ix in range(count))
+    return writeLines(lines, [slots for line, slots in encoded], corpus_file)
+
+def writeLines(lines, slots, corpus_file):
+    """
+        Write the (encoded line, slot_ix) pairs to the corpus and the index, slots being the list of slot offset
+        dicts and slot_ix the position in it of the line's slots.  Returns the number of lines written.
+    """
+    entries = []
+    offset = 0
+    with open(corpus_file, 'wb') as corpus:
+        for line, slot_ix in lines:
+            corpus.write(line + b'\n')
+            entries.append([offset, len(line), slot_ix])
+            offset += len(line) + 1
+    with open(indexFile(corpus_file), 'w') as index:
+        json.dump({'slot_widths' : SLOT_WIDTHS, 'slots' : slots, 'entries' : entries}, index)
+    return len(entries)
+
+#########################################################################################
+
+class OCMCorpus:
+    """
+        A memory mapped corpus, corpus[ix] is the ix'th OCM's bytes as written and
+        patched(ix, ...) a copy of them with the given slots overwritten, ready to POST.
+    """
+    def __init__(self, corpus_file=OCM_CORPUS):
+        with open(indexFile(corpus_file), 'r') as index:
+            index_data = json.load(index)
+        self.slot_widths = index_data['slot_widths']
+        self.slots       = index_data['slots']
+        self.entries     = index_data['entries']
+        self.corpus      = open(corpus_file, 'rb')
+        self.data        = mmap.mmap(self.corpus.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, ix):
+        offset, length, slot_ix = self.entries[ix % len(self.entries)]
+        return self.data[offset:offset + length]
+
+    def patched(self, ix, **values):
+        """
+            Return a bytearray copy of the ix'th OCM with the named slots set, subscription_id is set in every
+            entity (or entity by entity when it's a list), e.g. patched(7, subscription_id=500, message_id='A-7').
+        """
+        offset, length, slot_ix = self.entries[ix % len(self.entries)]
+        slots = self.slots[slot_ix]
+        body = bytearray(self.data[offset:offset + length])
+        for slot, value in values.items():
+            width = self.slot_widths[slot]
+            places = slots[slot]
+            slot_values = value if isinstance(value, list) else [value] * len(places)
+            for place, slot_value in zip(places, slot_values):
+                encoded = json.dumps(slot_value).encode('utf-8')
+                if len(encoded) > width:
+                    raise ValueError(f"{slot} value {encoded} is wider than the {width} byte slot")
+                body[place:place + width] = encoded.ljust(width)
+        return body
+
+    def subscriptionSlots(self, ix):
+        """
+            Return the number of subscription_id slots in the ix'th OCM, one per entity, or 0 when the corpus
+            was written with its sub_ids fixed (synthocm.py).
+        """
+        return len(self.slots[self.entries[ix % len(self.entries)][2]].get('subscription_id', []))
+
+    def close(self):
+        self.data.close()
+        self.corpus.close()
+
+#########################################################################################
+#########################################################################################
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,18 +1,17 @@
 import itertools
 
+from ocmcorpus import OCMCorpus
 
-OCM_DATA    = "data/ocm-messages.dat"
+OCM_DATA    = "data/ocm-messages.jsonl"
 
 def getOCMItems(source_file):
-    OCM_SEPARATOR = "-" * 80 + "\n"
-    with open(source_file, 'r') as ocmf:
-        ocm_blob = ocmf.read()
-    return ocm_blob.split(OCM_SEPARATOR)
+    return OCMCorpus(source_file)
 
 ocms = getOCMItems(OCM_DATA)
 
 count = 0
-for raw_ocm in itertools.cycle(ocms):
+for ix in itertools.cycle(range(len(ocms))):
+    raw_ocm = ocms[ix]
     count += 1
     if count % 100 == 0:
         print(count)
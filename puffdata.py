@@ -27,8 +27,8 @@ def main(args):
     uniq_data_lines = extractUniqueLines(ORIG_OCM_DATA_FILE, 3)
     mf = open(BULK_OCM_DATA_FILE, 'w')
     emitted = 0
-    while emitted < 1000:
-        ix = emitted % 3
+    while emitted < limit:
+        ix = emitted % len(uniq_data_lines)
         mf.write(uniq_data_lines[ix])
         emitted += 1
 
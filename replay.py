@@ -0,0 +1,113 @@
+#
+# replay.py - run kf-ocm-evaluate packages through the evaluator in batches rather than one
+#             function invocation per OCM, either draining the backlog on the evaluate
+#             subscription or replaying packages recorded in a file with one JSON package per line
+#             (a line may also be a Pub/Sub message with the package base64 encoded in 'data')
+#
+#########################################################################################
+USAGE = """
+Usage: replay.py -subscription [<subscription_name>] [-batch <size>] [-limit <total>]
+       replay.py -file <replay_file> [-batch <size>] [-limit <total>]
+"""
+import sys, os
+import json
+import base64
+import time
+
+from app.utils.confenv import setVariables
+setVariables('environment/dev.env.yml')
+
+from google.cloud import pubsub_v1
+
+from app.functions.kf_evaluator import evaluateOCMBatch
+
+#########################################################################################
+
+BATCH_SIZE    = 500
+BATCH_TIMEOUT = 60    # seconds allowed for the publishes of a batch
+LEASE_TIME    = 180   # seconds the messages of a pull are leased for, evaluating a batch and its publishes fit well inside
+
+#########################################################################################
+
+def main(args):
+    if len(args) < 1 or args[0] not in ['-subscription', '-file']:
+        sys.stderr.write(USAGE)
+        sys.exit(1)
+
+    source = args.pop(0)
+    target = None
+    if args and not args[0].startswith('-'):
+        target = args.pop(0)
+    options = dict(zip(args[::2], args[1::2]))
+    batch_size = int(options.get('-batch', BATCH_SIZE))
+    limit      = int(options.get('-limit', 0)) or None
+
+    started = time.time()
+    if source == '-file':
+        if not target:
+            sys.stderr.write(USAGE)
+            sys.exit(1)
+        replayed = replayFile(target, batch_size, limit)
+    else:
+        replayed = drainSubscription(target or os.getenv('KF_OCM_EVALUATE_SUB'), batch_size, limit)
+
+    elapsed = round(time.time() - started, 1)
+    print(f"{replayed} packages evaluated in {elapsed} seconds")
+
+#########################################################################################
+
+def replayFile(replay_file, batch_size, limit):
+    replayed = 0
+    batch = []
+    with open(replay_file, 'r') as rf:
+        for line in rf:
+            if not line.strip():
+                continue
+            batch.append(decodePackage(json.loads(line)))
+            if len(batch) >= batch_size:
+                evaluateOCMBatch(batch)
+                replayed += len(batch)
+                batch = []
+            if limit and replayed + len(batch) >= limit:
+                break
+    if batch:
+        evaluateOCMBatch(batch)
+        replayed += len(batch)
+    return replayed
+
+def decodePackage(item):
+    if 'data' in item and 'message_id' not in item:
+        return json.loads(base64.b64decode(item['data']).decode('utf-8'))
+    return item
+
+#########################################################################################
+
+def drainSubscription(subscription_name, batch_size, limit):
+    """
+        Pull from the subscription until it comes back empty, evaluating each pull as a batch
+        and acknowledging the messages of a batch once the batch has been evaluated.  The lease on a
+        pull is extended to LEASE_TIME first, so a batch isn't redelivered while it is being evaluated.
+    """
+    subscriber = pubsub_v1.SubscriberClient()
+    subscription_path = subscriber.subscription_path(os.getenv('GCP_PROJECT'), subscription_name)
+    drained = 0
+    while not limit or drained < limit:
+        wanted = min(batch_size, limit - drained) if limit else batch_size
+        response = subscriber.pull(subscription_path, max_messages=wanted, return_immediately=True)
+        if not response.received_messages:
+            break
+        ack_ids = [received.ack_id for received in response.received_messages]
+        subscriber.modify_ack_deadline(subscription_path, ack_ids, LEASE_TIME)
+        packages = [json.loads(received.message.data.decode('utf-8')) for received in response.received_messages]
+        evaluateOCMBatch(packages, timeout=BATCH_TIMEOUT)
+        subscriber.acknowledge(subscription_path, ack_ids)
+        drained += len(packages)
+        print(f'{drained} packages drained from {subscription_name}')
+        sys.stdout.flush()
+    return drained
+
+#########################################################################################
+#########################################################################################
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,109 @@
+#
+# retrier.py - hold the READY messages published to kf-webhook-retry until they are eligible and then
+#              republish them to kf-webhook-ready for another attempt.  Runs as a long lived process
+#              (a GCE VM or a container) so waiting costs nothing per message, the messages are kept in
+#              a heap ordered by their eligible time and each is acknowledged once it has been republished.
+#              Messages held for coalescing are collapsed by target_url and object, only the latest of
+#              them is republished and the others are acknowledged as they are superseded.
+#
+#########################################################################################
+USAGE = """
+Usage: retrier.py [<retry_subscription_name>] [-max <messages held at once>]
+"""
+import sys, os
+import json
+import time
+
+from app.utils.confenv import setVariables
+setVariables('environment/dev.env.yml')
+
+from google.cloud import pubsub_v1
+
+from app.helpers.kflog    import getLogger
+from app.helpers.pubsub   import publishEncoded, awaitPublished
+from app.helpers.retry    import RetryScheduler
+from app.helpers.coalesce import Coalescer, coalesceKey
+
+#########################################################################################
+
+MAX_HELD   = 10000   # messages leased from the subscription and waiting in the scheduler
+STATS_TIME = 60      # seconds between logging the number of messages held
+
+log = getLogger('retrier')
+
+#########################################################################################
+
+def main(args):
+    if args and args[0] in ['-h', '-help', '--help']:
+        sys.stderr.write(USAGE)
+        sys.exit(1)
+    subscription_name = os.getenv('KF_WEBHOOK_RETRY_SUB')
+    if args and not args[0].startswith('-'):
+        subscription_name = args.pop(0)
+    options  = dict(zip(args[::2], args[1::2]))
+    max_held = int(options.get('-max', MAX_HELD))
+
+    scheduler  = RetryScheduler()
+    coalescer  = Coalescer()
+    subscriber = pubsub_v1.SubscriberClient()
+    subscription_path = subscriber.subscription_path(os.getenv('GCP_PROJECT'), subscription_name)
+
+    def hold(message):
+        ready = json.loads(message.data.decode('utf-8'))
+        key = coalesceKey(ready) if ready.get('coalesce') else None
+        if key is None:
+            scheduler.add(message, ready.get('eligible', 0))
+            return
+        first, dropped = coalescer.offer(key, message, ready)
+        if first:
+            scheduler.add(key, ready.get('eligible', 0))
+        if dropped is not None:
+            dropped.ack()
+
+    # the client keeps extending the lease on the messages it has handed to hold until they are acked
+    flow_control = pubsub_v1.types.FlowControl(max_messages=max_held)
+    streaming_pull = subscriber.subscribe(subscription_path, callback=hold, flow_control=flow_control)
+    log.info('holding retries from %s until eligible for %s', subscription_name, os.getenv('KF_WEBHOOK_READY'))
+
+    last_stats = time.time()
+    try:
+        while True:
+            republish([released(coalescer, item) for item in scheduler.take(timeout=STATS_TIME)])
+            if time.time() - last_stats >= STATS_TIME:
+                log.info('%d retries held, %d coalescing, next one due in %s seconds', len(scheduler), len(coalescer), scheduler.nextDue())
+                last_stats = time.time()
+    except KeyboardInterrupt:
+        streaming_pull.cancel()
+
+def released(coalescer, item):
+    """
+        Return the (message, data) to republish for an item that has come due, for a coalesce key the
+        latest message for the key marked with the number of messages it stands for.
+    """
+    if isinstance(item, tuple):
+        message, ready, count = coalescer.release(item)
+        ready = dict(ready, coalesced=count)
+        ready.pop('coalesce', None)
+        return message, json.dumps(ready).encode()
+    return item, item.data
+
+def republish(due):
+    """
+        Publish the (message, data) pairs that have come due to the ready topic and ack each message that
+        was published, one that couldn't be is nacked so Pub/Sub redelivers it to be held again.
+    """
+    if not due:
+        return
+    pending = [(message, publishEncoded(os.getenv('KF_WEBHOOK_READY'), data)) for message, data in due]
+    for message, result, exception in awaitPublished(pending):
+        if exception:
+            log.error('unable to republish a retry to %s, %s', os.getenv('KF_WEBHOOK_READY'), exception)
+            message.nack()
+        else:
+            message.ack()
+
+#########################################################################################
+#########################################################################################
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,374 @@
+#
+# synthocm.py - synthesize OCMs for the round-2 evaluation mix from the rules in data/csv/webhook.csv and
+#               condition.csv:  by default 40% with no applicable webhooks, 30% for which every applicable
+#               webhook has a condition that isn't met (NOGO) and 30% with a webhook whose conditions are all
+#               met (READY).  The shares are held exactly, at every point the count of each kind is within
+#               one of its share of the messages so far.
+#
+#               For every (sub_id, object_type) that can produce a kind an OCM is built once from the entity
+#               in ocm-messages-3.raw, its state and changes set to meet or miss the conditions, padded to
+#               the payload size, and checked with the compiled predicates of a RuleIndex (the evaluator's
+#               own decision code).  Each message is a copy of one of those encoded templates with a fresh
+#               entity uuid and message_id patched in (uuids are all the same length), so millions can be
+#               written at disk speed.
+#
+#               The output is a corpus for ocmcorpus.OCMCorpus (and so loadgen.py / flingem.py) written without
+#               subscription_id slots, the sub_id is part of what makes a message the kind it is so the drivers
+#               send it as written rather than patching in random ones.
+#               The sub_ids are drawn uniformly or with a Zipf skew (sub_id rank 1 the most frequent), the
+#               object_types by the weights given, both within the (sub_id, object_type)s that can produce
+#               the kind of message being made.  -verify decodes every message written and evaluates it again.
+#
+#########################################################################################
+USAGE = """
+Usage: synthocm.py <count> [<corpus file>] [-mix <no_webhooks,nogo,ready percentages>] [-types <type:weight,...>]
+                   [-changes <changed attributes>] [-size <payload bytes>] [-subs <uniform|zipf>] [-zipf <exponent>]
+                   [-seed <n>] [-verify]
+"""
+import sys, os
+import csv
+import json
+import copy
+import uuid
+import random
+import itertools
+from datetime import datetime, timedelta
+
+from ocmcorpus import readOCMSource, encodeOCM, writeLines, OCMCorpus, OCM_SOURCE
+from app.helpers.rules import RuleIndex, CHANGE_RELATIONS
+
+#########################################################################################
+
+OCM_CORPUS     = "data/ocm-synthetic.jsonl"
+WEBHOOK_CSV    = "data/csv/webhook.csv"
+CONDITION_CSV  = "data/csv/condition.csv"
+
+KINDS          = ['no_webhooks', 'nogo', 'ready']
+DEFAULT_MIX    = [40, 30, 30]
+OBJECT_TYPES   = ['Defect', 'Story', 'Task', 'Feature', 'TestCase']
+PAYLOAD_SIZE   = 20000
+CHANGED_ATTRS  = 5
+ZIPF_EXPONENT  = 1.1
+COMBINATIONS   = 500     # most choices of the condition to miss per webhook tried when building a NOGO template
+
+# placeholders in the templates, each patched with a fresh uuid4 (the same length) for every message
+ENTITY_MARKER  = '00000000-5eed-4000-8000-00000000e171'
+MESSAGE_MARKER = '00000000-5eed-4000-8000-0000000003e5'
+DATE_FORMAT    = '%Y-%m-%d'
+
+#########################################################################################
+
+def main(args):
+    if not args or args[0] in ['-h', '-help']:
+        sys.stderr.write(USAGE)
+        sys.exit(1)
+    count = int(args.pop(0))
+    corpus_file = args.pop(0) if args and not args[0].startswith('-') else OCM_CORPUS
+    verify = '-verify' in args
+    args = [arg for arg in args if arg != '-verify']
+    options = dict(zip(args[::2], args[1::2]))
+
+    mix = [float(share) for share in options.get('-mix', ','.join(map(str, DEFAULT_MIX))).split(',')]
+    object_types = dict((name, float(weight)) for name, weight in
+                        (item.split(':') for item in options['-types'].split(','))) if '-types' in options \
+                   else dict.fromkeys(OBJECT_TYPES, 1.0)
+    exponent = float(options.get('-zipf', ZIPF_EXPONENT)) if options.get('-subs', 'uniform') == 'zipf' else 0.0
+    random.seed(options.get('-seed'))
+
+    synth = OCMSynthesizer(mix=mix, object_types=object_types, exponent=exponent,
+                           changed=int(options.get('-changes', CHANGED_ATTRS)),
+                           size=int(options.get('-size', PAYLOAD_SIZE)))
+    print(f"templates {synth.describe()}")
+    written = synth.writeCorpus(count, corpus_file)
+    print(f"{written} OCMs written to {corpus_file}: " +
+          ', '.join(f"{kind} {synth.emitted[kind]}" for kind in KINDS))
+    if verify:
+        print(f"verified {synth.verifyCorpus(corpus_file)} OCMs, no mismatches")
+
+#########################################################################################
+
+def readRules(webhook_csv=WEBHOOK_CSV, condition_csv=CONDITION_CSV):
+    """
+        Return a dict of sub_id : (webhooks, conditions) in the shapes the evaluator gets them, a webhook being
+        (id, sub_id, name, target_url, [object_types], [cond_ids]) and a condition the row of condition.csv.
+    """
+    def pgArray(text):
+        return [item for item in text.strip('{}').split(',') if item]
+
+    conditions = {}
+    with open(condition_csv, newline='') as csvf:
+        for cond_id, sub_id, attr_uuid, attr_name, relation, value in csv.reader(csvf):
+            conditions[int(cond_id)] = (int(cond_id), int(sub_id), attr_uuid, attr_name, relation, value)
+
+    rules = {}
+    with open(webhook_csv, newline='') as csvf:
+        for wh_id, sub_id, name, target_url, object_types, cond_ids in csv.reader(csvf):
+            webhook = (int(wh_id), int(sub_id), name, target_url, pgArray(object_types), [int(ix) for ix in pgArray(cond_ids)])
+            rules.setdefault(int(sub_id), ([], {}))[0].append(webhook)
+            for cond_id in webhook[-1]:
+                if cond_id in conditions:
+                    rules[int(sub_id)][1][cond_id] = conditions[cond_id]
+    return {sub_id : (webhooks, list(conds.values())) for sub_id, (webhooks, conds) in rules.items()}
+
+def evaluate(index, entity):
+    """
+        The kind of message the evaluator makes of the entity, as evaluatePackage decides it.
+        index is the RuleIndex for the entity's sub_id, None when it has no rules.
+    """
+    if index is None:
+        return 'no_webhooks'
+    decisions, status = index.decide(entity['object_type'], entity['state'], entity['changes'])
+    if not decisions:
+        return 'no_webhooks'
+    return 'ready' if any(qualified for webhook, qualified in decisions) else 'nogo'
+
+#########################################################################################
+#  values that meet or miss a condition
+
+ABSENT = object()   # for a changed* condition, the attribute not being in the changes
+
+def different(operand):
+    return operand + 1 if isinstance(operand, (int, float)) else f'{operand} (other)'
+
+def shifted(operand, step):
+    if isinstance(operand, (int, float)):
+        moved = operand + step
+        return moved if moved else step / 2   # a value of 0 is taken as no value
+    try:
+        return (datetime.strptime(operand, DATE_FORMAT) + timedelta(days=step)).strftime(DATE_FORMAT)
+    except ValueError:
+        return operand + '~' if step > 0 else operand[:-1] or ' '
+
+def candidateValues(compiled, wanted):
+    """
+        Values for the condition's attribute likely to make the condition evaluate to wanted, state values
+        for a condition on the value of the attribute, change dicts (or ABSENT) for a changed* condition.
+    """
+    relation, operand = compiled.relation, compiled.operand
+    if relation in CHANGE_RELATIONS:
+        other = different(operand)
+        if relation == 'changed-to':
+            hits = [{'value' : operand, 'old_value' : other}]
+        elif relation == 'changed-from':
+            hits = [{'value' : other, 'old_value' : operand}]
+        else:
+            hits = [{'value' : operand, 'old_value' : None}]
+        return hits if wanted else [ABSENT, {'value' : other, 'old_value' : other}]
+    meets = {'='   : [operand],                 '~'   : [operand],
+             '!='  : [different(operand)],      '!~'  : [different(operand)],
+             '<'   : [shifted(operand, -1)],    '<='  : [operand, shifted(operand, -1)],
+             '>'   : [shifted(operand, 1)],     '>='  : [operand, shifted(operand, 1)],
+             'has' : [True],                    '!has': [None]}
+    misses = {'='  : [different(operand)],      '~'   : [different(operand)],
+              '!=' : [operand],                 '!~'  : [operand],
+              '<'  : [operand],                 '<='  : [shifted(operand, 1)],
+              '>'  : [operand],                 '>='  : [shifted(operand, -1)],
+              'has': [None],                    '!has': [True]}
+    return (meets if wanted else misses).get(relation, []) + [None]
+
+def holds(compiled, value):
+    if compiled.relation in CHANGE_RELATIONS:
+        changes = {} if value is ABSENT else {compiled.attr_uuid : value}
+        return compiled.test({}, changes)
+    return compiled.test({compiled.attr_uuid : {'value' : value}}, {})
+
+def solve(requirements):
+    """
+        Given (compiled condition, wanted) pairs return (state values, changes), dicts of attr_uuid : value and
+        attr_uuid : change dict, making every condition evaluate to its wanted outcome, None if no value found does.
+    """
+    by_attribute = {}
+    for compiled, wanted in requirements:
+        is_change = compiled.relation in CHANGE_RELATIONS
+        by_attribute.setdefault((compiled.attr_uuid, is_change), []).append((compiled, wanted))
+
+    values, changes = {}, {}
+    for (attr_uuid, is_change), wants in by_attribute.items():
+        candidates = [value for compiled, wanted in wants for value in candidateValues(compiled, wanted)]
+        for value in candidates:
+            if all(holds(compiled, value) == wanted for compiled, wanted in wants):
+                break
+        else:
+            return None
+        if is_change:
+            if value is not ABSENT:
+                changes[attr_uuid] = value
+        else:
+            values[attr_uuid] = value
+    return values, changes
+
+#########################################################################################
+
+class OCMSynthesizer:
+    """
+        Templates of encoded OCMs for each kind of message and the draws of sub_id / object_type for them.
+    """
+    def __init__(self, mix=DEFAULT_MIX, object_types=None, exponent=0.0, changed=CHANGED_ATTRS, size=PAYLOAD_SIZE,
+                 rules=None, source_file=OCM_SOURCE):
+        self.shares       = [share / sum(mix) for share in mix]
+        self.object_types = object_types or dict.fromkeys(OBJECT_TYPES, 1.0)
+        self.changed      = changed
+        self.size         = size
+        self.rules        = rules or readRules()
+        self.indexes      = {sub_id : RuleIndex(webhooks, conditions) for sub_id, (webhooks, conditions) in self.rules.items()}
+        self.base         = readOCMSource(source_file)[0]
+        self.emitted      = dict.fromkeys(KINDS, 0)
+
+        # sub_ids by rank for the Zipf weights, a sub_id without rules after those with them (always no_webhooks)
+        sub_ids = sorted(self.rules) + [max(self.rules) + min(self.rules)]
+        sub_weights = {sub_id : 1.0 / (rank ** exponent) for rank, sub_id in enumerate(sub_ids, 1)}
+
+        self.templates = []             # (line, slots, [(marker offset, marker)], kind)
+        self.cells = {kind : ([], []) for kind in KINDS}  # kind : ([template numbers for each cell], cumulative weights)
+        for sub_id in sub_ids:
+            for object_type, type_weight in self.object_types.items():
+                for kind in KINDS:
+                    made = self.makeTemplates(sub_id, object_type, kind)
+                    if made:
+                        cell_templates, weights = self.cells[kind]
+                        cell_templates.append(made)
+                        weights.append((weights[-1] if weights else 0.0) + sub_weights[sub_id] * type_weight)
+        for kind, share in zip(KINDS, self.shares):
+            if share and not self.cells[kind][0]:
+                raise ValueError(f"the rules can't produce any {kind} OCMs for object_types {list(self.object_types)}")
+
+    def describe(self):
+        return ', '.join(f"{kind} {sum(len(made) for made in self.cells[kind][0])}" for kind in KINDS)
+
+    #########################################################################################
+
+    def makeTemplates(self, sub_id, object_type, kind):
+        index = self.indexes.get(sub_id)
+        relevant = index.webhooksFor(object_type) if index else []
+        if kind == 'no_webhooks':
+            assignments = [({}, {})] if not relevant else []
+        elif kind == 'ready':
+            assignments = self.readyAssignments(index, relevant)
+        else:
+            assignments = self.nogoAssignments(index, relevant)
+
+        made = []
+        for values, changes in assignments:
+            entity = self.buildEntity(sub_id, object_type, index, relevant, values, changes)
+            if evaluate(index, entity) != kind:
+                continue
+            made.append(self.encodeTemplate(entity, kind))
+        return made
+
+    def readyAssignments(self, index, relevant):
+        # one for each webhook whose conditions can all be met at once, a condition that doesn't exist is never met
+        assignments = []
+        for webhook in relevant:
+            if not all(cond_id in index.compiled for cond_id in webhook[-1]):
+                continue
+            solved = solve([(index.compiled[cond_id], True) for cond_id in webhook[-1]])
+            if solved is not None:
+                assignments.append(solved)
+        return assignments
+
+    def nogoAssignments(self, index, relevant):
+        # one condition of every applicable webhook missed, a webhook without conditions always qualifies
+        # and one referring to a condition that doesn't exist never does
+        choices = [webhook[-1] for webhook in relevant if all(cond_id in index.compiled for cond_id in webhook[-1])]
+        if not relevant or not all(choices):
+            return []
+        for picked in itertools.islice(itertools.product(*choices), COMBINATIONS):
+            solved = solve([(index.compiled[cond_id], False) for cond_id in set(picked)])
+            if solved is not None:
+                return [solved]
+        return []
+
+    def buildEntity(self, sub_id, object_type, index, relevant, values, changes):
+        entity = copy.deepcopy(list(self.base['value']['entities'].values())[0])
+        kind_path = object_type.lower()
+        entity.update(action='Updated', subscription_id=sub_id, object_type=object_type,
+                      ref=f"http://stack.local:8999/slm/webservice/v2.x/{kind_path}/{ENTITY_MARKER}")
+        state = entity['state']
+
+        # every attribute a relevant condition looks at is in the state, None unless the assignment sets it
+        conditions = index.conditionsFor(relevant).values() if index else []
+        for compiled in conditions:
+            if compiled.relation not in CHANGE_RELATIONS or compiled.attr_uuid not in state:
+                state[compiled.attr_uuid] = {'value' : values.get(compiled.attr_uuid), 'type' : 'String',
+                                             'name' : compiled.attr_name, 'display_name' : compiled.attr_name, 'ref' : None}
+
+        # the changes the assignment needs and then others, on attributes no condition looks at, up to self.changed
+        entity['changes'] = {}
+        for attr_uuid, change in changes.items():
+            entity['changes'][attr_uuid] = dict(change, added=None, removed=None, type=state[attr_uuid]['type'],
+                                                name=state[attr_uuid]['name'], display_name=state[attr_uuid]['display_name'], ref=None)
+        watched = set(compiled.attr_uuid for compiled in (index.compiled.values() if index else []))
+        for attr_uuid, info in state.items():
+            if len(entity['changes']) >= self.changed:
+                break
+            if attr_uuid not in watched and attr_uuid not in entity['changes']:
+                entity['changes'][attr_uuid] = dict(info, old_value=None, added=None, removed=None)
+        return entity
+
+    def encodeTemplate(self, entity, kind):
+        item_dict = {'value' : {'entities' : {ENTITY_MARKER : entity},
+                                'transaction' : dict(self.base['value']['transaction'], message_id=MESSAGE_MARKER)}}
+        line, slots = encodeOCM(item_dict)
+        shortfall = self.size - len(line)
+        if shortfall > 0:
+            # the padding goes into the Description, which no condition looks at
+            description = [attr_uuid for attr_uuid, info in entity['state'].items() if info.get('name') == 'Description']
+            if description:
+                entity['state'][description[0]]['value'] = 'x' * shortfall
+                line, slots = encodeOCM(item_dict)
+        # no subscription_id slot, a patched sub_id would break the mix
+        slots = dict(slots, subscription_id=[])
+        places = []
+        for marker in [ENTITY_MARKER, MESSAGE_MARKER]:
+            start = line.find(marker.encode('utf-8'))
+            while start >= 0:
+                places.append((start, marker))
+                start = line.find(marker.encode('utf-8'), start + 1)
+        self.templates.append((line, slots, places, kind))
+        return len(self.templates) - 1
+
+    #########################################################################################
+
+    def nextKind(self, made):
+        # the kind furthest behind its share of made + 1 messages
+        return max(KINDS, key=lambda kind: self.shares[KINDS.index(kind)] * (made + 1) - self.emitted[kind])
+
+    def messages(self, count):
+        """
+            Generate (encoded OCM bytes, template number) for count messages.
+        """
+        for made in range(count):
+            kind = self.nextKind(made)
+            self.emitted[kind] += 1
+            cell_templates, weights = self.cells[kind]
+            template = random.choice(random.choices(cell_templates, cum_weights=weights)[0])
+            line, slots, places, kind = self.templates[template]
+            body = bytearray(line)
+            fresh = {ENTITY_MARKER : str(uuid.uuid4()).encode('utf-8'), MESSAGE_MARKER : str(uuid.uuid4()).encode('utf-8')}
+            for place, marker in places:
+                body[place:place + len(marker)] = fresh[marker]
+            yield bytes(body), template
+
+    def writeCorpus(self, count, corpus_file):
+        # the template number of a line is its slot_ix, the templates' slots being the corpus's slot list
+        return writeLines(self.messages(count), [slots for line, slots, places, kind in self.templates], corpus_file)
+
+    def verifyCorpus(self, corpus_file):
+        """
+            Decode and evaluate every OCM in a corpus written by writeCorpus, raising ValueError on one
+            that isn't of the kind its template was made for.  Returns the number of OCMs checked.
+        """
+        corpus = OCMCorpus(corpus_file)
+        for ix in range(len(corpus)):
+            entity = list(json.loads(corpus[ix])['value']['entities'].values())[0]
+            wanted = self.templates[corpus.entries[ix][2]][3]
+            found  = evaluate(self.indexes.get(entity['subscription_id']), entity)
+            if found != wanted:
+                raise ValueError(f"OCM {ix} in {corpus_file} made as {wanted} evaluates as {found}")
+        return len(corpus)
+
+#########################################################################################
+#########################################################################################
+
+if __name__ == '__main__':
+    main(sys.argv[1:])